@@ -0,0 +1,132 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-memory caches that survive across warm invocations of a Lambda function (module level state is kept while
+# the container is reused). Each cache is a thread safe, size bounded LRU with a time to live per entry, and
+# counts hits and misses. S3 objects are revalidated with conditional (If-None-Match) GETs once they expire,
+# so an unchanged object is not downloaded again.
+# This module has no dependency on the other indexer modules.
+
+import time
+import threading
+import collections
+from botocore.exceptions import ClientError
+
+import logging
+logger = logging.getLogger()
+
+# all caches, for log_cache_stats()
+CACHES = []
+
+class CacheEntry:
+    def __init__(self, value, expires, etag=None, version=None):
+        self.value = value
+        self.expires = expires
+        self.etag = etag
+        self.version = version
+
+class Cache:
+    # Size bounded LRU cache. Entries expire ttl_secs after they are stored (ttl_secs can be set per entry), but
+    # expired entries are kept until evicted, so they can be revalidated (see get_s3_object).
+    def __init__(self, name, max_entries=1000, ttl_secs=300):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        CACHES.append(self)
+
+    def get_entry(self, key):
+        # Returns the entry for key (fresh or expired), or None, and marks it as most recently used
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value, ttl_secs=None, etag=None, version=None):
+        ttl_secs = self.ttl_secs if ttl_secs is None else ttl_secs
+        entry = CacheEntry(value, time.monotonic() + ttl_secs, etag, version)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, key=None):
+        # Removes the entry for key, or all entries
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def count(self, hit, revalidated=False):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if revalidated:
+                self.revalidated += 1
+
+    def get(self, key, load, ttl_secs=None):
+        # Returns the cached value for key, or calls load() and caches the result if there is no fresh entry
+        entry = self.get_entry(key)
+        if entry is not None and entry.expires > time.monotonic():
+            self.count(hit=True)
+            return entry.value
+        self.count(hit=False)
+        value = load()
+        self.put(key, value, ttl_secs)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'evictions': self.evictions
+            }
+
+def get_s3_object(cache, s3, bucket, key, version=None, ttl_secs=None, max_bytes=1024 * 1024):
+    """Returns the content (bytes) of an S3 object, cached in cache. A cached object is used without a request
+    while its entry is fresh, or if version (e.g. the LastModified time the caller expects) matches the version
+    it was cached with. Otherwise it is revalidated with a conditional GET, and only downloaded if it has changed.
+    Objects larger than max_bytes are not cached."""
+    cache_key = f"s3://{bucket}/{key}"
+    entry = cache.get_entry(cache_key)
+    if entry is not None and (entry.expires > time.monotonic() or (version is not None and version == entry.version)):
+        cache.count(hit=True)
+        return entry.value
+    get_args = {'Bucket': bucket, 'Key': key}
+    if entry is not None and entry.etag:
+        get_args['IfNoneMatch'] = entry.etag
+    try:
+        result = s3.get_object(**get_args)
+    except ClientError as e:
+        if entry is not None and e.response['Error']['Code'] in ['304', 'NotModified']:
+            # unchanged since it was cached
+            cache.count(hit=True, revalidated=True)
+            cache.put(cache_key, entry.value, ttl_secs, entry.etag, version if version is not None else entry.version)
+            return entry.value
+        raise
+    cache.count(hit=False)
+    data = result["Body"].read()
+    if len(data) <= max_bytes:
+        cache.put(cache_key, data, ttl_secs, result.get('ETag'), version)
+    else:
+        cache.invalidate(cache_key)
+    return data
+
+def log_cache_stats():
+    for cache in CACHES:
+        logger.info(f"Cache {cache.name}: {cache.stats()}")
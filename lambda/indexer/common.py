@@ -2,11 +2,22 @@
 # SPDX-License-Identifier: MIT-0
 
 import os
+import re
 import boto3
 import json
+import hashlib
 import time
+import random
 import urllib
+import zlib
+import threading
+import queue
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from botocore.config import Config
+from cache import Cache, get_s3_object
 
 import logging
 logger = logging.getLogger()
@@ -18,14 +29,185 @@ INDEX_ID = os.environ['INDEX_ID']
 DS_ID = os.environ['DS_ID']
 STACK_NAME = os.environ['STACK_NAME']
 MEDIA_FILE_TABLE = os.environ['MEDIA_FILE_TABLE']
+# Optional cap on DynamoDB status table requests per second (0 = no limit)
+DYNAMODB_MAX_TPS = float(os.environ.get('DYNAMODB_MAX_TPS', '0'))
+# Cap on Kendra BatchDeleteDocument calls per second, and number of calls in parallel, when deleting documents
+KENDRA_DELETE_MAX_TPS = float(os.environ.get('KENDRA_DELETE_MAX_TPS', '5'))
+KENDRA_DELETE_CONCURRENCY = int(os.environ.get('KENDRA_DELETE_CONCURRENCY', '4'))
+# Number of times a throttled or failed BatchDeleteDocument call is retried, with exponential backoff
+KENDRA_DELETE_MAX_RETRIES = int(os.environ.get('KENDRA_DELETE_MAX_RETRIES', '6'))
+# Number of segments (threads) used to scan the status table - see iter_status_table_pages()
+SCAN_SEGMENTS = int(os.environ.get('SCAN_SEGMENTS', '4'))
+# Seconds that metadata and Transcribe options JSON files are used from the cache before they are revalidated
+# with a conditional GET (0 - always revalidate), and the number of files cached
+S3JSON_CACHE_TTL_SECS = int(os.environ.get('S3JSON_CACHE_TTL_SECS', '0'))
+S3JSON_CACHE_MAX_ENTRIES = int(os.environ.get('S3JSON_CACHE_MAX_ENTRIES', '2000'))
+# Seconds that the metadata field configuration of the Kendra index is cached
+INDEX_CONFIG_CACHE_TTL_SECS = int(os.environ.get('INDEX_CONFIG_CACHE_TTL_SECS', '3600'))
+# Seconds after which the index schema is compared with the index again, even if it has not changed
+INDEX_SCHEMA_RECHECK_SECS = int(os.environ.get('INDEX_SCHEMA_RECHECK_SECS', '86400'))
+# Bucket that Transcribe writes transcripts to, as <TRANSCRIPT_PREFIX><job name>.json (empty - transcripts are kept
+# by Transcribe, and can only be read while it keeps the job)
+TRANSCRIPT_BUCKET = os.environ.get('TRANSCRIPT_BUCKET', '')
+TRANSCRIPT_PREFIX = os.environ.get('TRANSCRIPT_PREFIX', 'transcripts/')
+# Size of the connection pool of the S3 client, shared by all threads
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '25'))
 
 # AWS clients
-S3 = boto3.client('s3')
+S3 = boto3.client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
 TRANSCRIBE = boto3.client('transcribe')
 KENDRA = boto3.client('kendra')
 DYNAMODB = boto3.resource('dynamodb')
 TABLE = DYNAMODB.Table(MEDIA_FILE_TABLE)
 
+# Concurrency helpers
+
+class RateLimiter:
+    # Thread safe rate limiter - acquire() blocks so that callers, across all threads, 
+    # make no more than 'rate' calls per second. A rate of 0 (or less) disables the limit.
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(self.next_time, now) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+DYNAMODB_LIMITER = RateLimiter(DYNAMODB_MAX_TPS)
+KENDRA_DELETE_LIMITER = RateLimiter(KENDRA_DELETE_MAX_TPS)
+
+# Caches kept across warm invocations - see cache.py
+S3JSON_CACHE = Cache("s3json", max_entries=S3JSON_CACHE_MAX_ENTRIES, ttl_secs=S3JSON_CACHE_TTL_SECS)
+INDEX_CONFIG_CACHE = Cache("index_config", max_entries=10, ttl_secs=INDEX_CONFIG_CACHE_TTL_SECS)
+
+def map_concurrently(func, items, max_workers, should_stop=None):
+    """Apply func to each item using a pool of max_workers threads.
+    Yields (item, result, exception) tuples in the same order as items, so callers get deterministic 
+    output and an exception raised for one item does not affect the others. At most 2*max_workers 
+    items are in flight at a time. If should_stop() returns True no further items are submitted."""
+    if max_workers <= 1:
+        for item in items:
+            if should_stop and should_stop():
+                break
+            try:
+                yield (item, func(item), None)
+            except Exception as e:
+                yield (item, None, e)
+        return
+    def get_result(item, future):
+        try:
+            return (item, future.result(), None)
+        except Exception as e:
+            return (item, None, e)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            if should_stop and should_stop():
+                break
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= 2 * max_workers:
+                yield get_result(*pending.popleft())
+        while pending:
+            yield get_result(*pending.popleft())
+
+# boto3 resources are not thread safe, so worker threads each get their own Table resource 
+_thread_local = threading.local()
+
+def get_status_table():
+    if threading.current_thread() is threading.main_thread():
+        return TABLE
+    if not hasattr(_thread_local, 'table'):
+        _thread_local.table = boto3.session.Session().resource('dynamodb').Table(MEDIA_FILE_TABLE)
+    return _thread_local.table
+
+# Status table scans
+
+def iter_status_table_pages(scan_args, segments=None):
+    """Yield the response pages of a scan of the status table with scan_args. With segments > 1 the table is read
+    with a DynamoDB parallel scan, one thread per segment, and pages are yielded as they arrive - not in key order.
+    Only a few pages are buffered, so memory use does not depend on the size of the table."""
+    segments = SCAN_SEGMENTS if segments is None else segments
+    if segments <= 1:
+        scan_args = dict(scan_args)
+        while True:
+            DYNAMODB_LIMITER.acquire()
+            response = get_status_table().scan(**scan_args)
+            yield response
+            if not response.get("LastEvaluatedKey"):
+                return
+            scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    pages = queue.Queue(maxsize=2 * segments)
+    stop = threading.Event()
+    done = object()
+    def put(page):
+        # returns False if the consumer has stopped reading pages
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    def scan_segment(segment):
+        segment_args = dict(scan_args, Segment=segment, TotalSegments=segments)
+        try:
+            while not stop.is_set():
+                DYNAMODB_LIMITER.acquire()
+                response = get_status_table().scan(**segment_args)
+                if not put(response) or not response.get("LastEvaluatedKey"):
+                    break
+                segment_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except Exception as e:
+            put(e)
+        put(done)
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        for segment in range(segments):
+            executor.submit(scan_segment, segment)
+        try:
+            remaining = segments
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            stop.set()
+
+def get_projection_args(attributes):
+    # attribute names are aliased since some (e.g. 'status') are DynamoDB reserved words
+    names = {f"#a{i}": attr for i, attr in enumerate(attributes)}
+    return {
+        "ProjectionExpression": ", ".join(names.keys()),
+        "ExpressionAttributeNames": names
+    }
+
+def scan_status_items(attributes=None, filter_expression=None, segments=None):
+    """Yield the status table items matching filter_expression (a boto3 condition, e.g. Attr('status').eq('DELETED')),
+    with only the given attributes if attributes is set. Items are streamed from a parallel scan - see
+    iter_status_table_pages()."""
+    scan_args = get_projection_args(attributes) if attributes else {}
+    if filter_expression is not None:
+        scan_args["FilterExpression"] = filter_expression
+    for page in iter_status_table_pages(scan_args, segments):
+        yield from page["Items"]
+
+def count_status_items(filter_expression=None, segments=None):
+    # Number of status table items matching filter_expression, from a parallel scan
+    scan_args = {"Select": "COUNT"}
+    if filter_expression is not None:
+        scan_args["FilterExpression"] = filter_expression
+    return sum(page["Count"] for page in iter_status_table_pages(scan_args, segments))
+
 # Common functions
 
 def parse_s3url(s3url):
@@ -35,12 +217,28 @@ def parse_s3url(s3url):
     file_name = key.split("/")[-1]
     return [bucket, key, file_name]
     
-def get_s3jsondata(s3json_url):
+def head_s3_object(bucket, key):
+    # Returns object details in the same form as list_objects_v2 'Contents' entries, or None if the object does not exist
+    try:
+        response = S3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return None
+        raise
+    return {
+        'Key': key,
+        'LastModified': response['LastModified'],
+        'Size': response['ContentLength'],
+        'ETag': response['ETag']
+    }
+
+def get_s3jsondata(s3json_url, version=None):
+    # version - e.g. the LastModified time of the file recorded in the status table - lets a cached copy of the
+    # same version be used without checking S3
     if s3json_url:
         bucket, key, file_name = parse_s3url(s3json_url)
         logger.info(f"{bucket}, {key}, {file_name}")
-        result = S3.get_object(Bucket=bucket, Key=key)
-        data = result["Body"].read().decode()
+        data = get_s3_object(S3JSON_CACHE, S3, bucket, key, version=version).decode()
         try:
             dict = json.loads(data)
         except Exception as e:
@@ -52,64 +250,128 @@ def get_s3jsondata(s3json_url):
     return dict
 
 
-def make_category_facetable(indexId):
-    logger.info(f"make_file_type_facetable(indexId={indexId})")
-    resp = KENDRA.update_index(Id=indexId, 
-               DocumentMetadataConfigurationUpdates=[{
-                   'Name': '_category',
-                   'Type': 'STRING_VALUE',
-                   'Search': {
-                       'Facetable': True,
-                       'Searchable': True,
-                       'Displayable': True,
-                       'Sortable': True
-                   }
-               }
-           ])
-    logger.info(f"response:" + json.dumps(resp))
-
-def create_newfacets_youtube(indexId):
-    logger.info(f"create_newfacets_youtube(indexId={indexId})")
-    resp = KENDRA.update_index(Id=indexId, 
-               DocumentMetadataConfigurationUpdates=[{
-                   'Name': 'ytauthor',
-                   'Type': 'STRING_VALUE',
-                   'Search': {
-                       'Facetable': False,
-                       'Searchable': True,
-                       'Displayable': True,
-                       'Sortable': True
-                   }
-               },{
-                   'Name': 'ytsource',
-                   'Type': 'STRING_VALUE',
-                   'Search': {
-                       'Facetable': False,
-                       'Searchable': False,
-                       'Displayable': False,
-                       'Sortable': False
-                   }
-            },{
-                   'Name': 'video_length',
-                   'Type': 'LONG_VALUE',
-                   'Search': {
-                       'Facetable': False,
-                       'Searchable': False,
-                       'Displayable': False,
-                       'Sortable': True
-                   }
-            },{
-                   'Name': 'video_view_count',
-                   'Type': 'LONG_VALUE',
-                   'Search': {
-                       'Facetable': False,
-                       'Searchable': False,
-                       'Displayable': False,
-                       'Sortable': True
-                   }
-            }
-           ])
-    logger.info(f"response:" + json.dumps(resp))
+# Index schema - the metadata fields that the indexer configures in the Kendra index
+
+CATEGORY_FIELDS = [{
+    'Name': '_category',
+    'Type': 'STRING_VALUE',
+    'Search': {
+        'Facetable': True,
+        'Searchable': True,
+        'Displayable': True,
+        'Sortable': True
+    }
+}]
+
+YOUTUBE_FIELDS = [{
+    'Name': 'ytauthor',
+    'Type': 'STRING_VALUE',
+    'Search': {
+        'Facetable': False,
+        'Searchable': True,
+        'Displayable': True,
+        'Sortable': True
+    }
+},{
+    'Name': 'ytsource',
+    'Type': 'STRING_VALUE',
+    'Search': {
+        'Facetable': False,
+        'Searchable': False,
+        'Displayable': False,
+        'Sortable': False
+    }
+},{
+    'Name': 'video_length',
+    'Type': 'LONG_VALUE',
+    'Search': {
+        'Facetable': False,
+        'Searchable': False,
+        'Displayable': False,
+        'Sortable': True
+    }
+},{
+    'Name': 'video_view_count',
+    'Type': 'LONG_VALUE',
+    'Search': {
+        'Facetable': False,
+        'Searchable': False,
+        'Displayable': False,
+        'Sortable': True
+    }
+}]
+
+def get_index_schema(make_category_facetable, index_youtube_videos):
+    # declared metadata field configuration, for the indexer settings
+    schema = []
+    if make_category_facetable:
+        schema += CATEGORY_FIELDS
+    if index_youtube_videos:
+        schema += YOUTUBE_FIELDS
+    return schema
+
+def get_index_schema_item_id(name):
+    return f"{name}#index_schema"
+
+def get_index_schema_hash(indexId, schema):
+    return hashlib.sha256(json.dumps([indexId, schema], sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_index_metadata_configurations(indexId):
+    # metadata field configuration of the index, cached for INDEX_CONFIG_CACHE_TTL_SECS
+    def describe_index():
+        return KENDRA.describe_index(Id=indexId).get('DocumentMetadataConfigurations', [])
+    return INDEX_CONFIG_CACHE.get(indexId, describe_index)
+
+def diff_index_schema(configurations, schema):
+    # Compares the metadata field configuration of the index with the declared schema. Returns [updates, conflicts]
+    # - the declared fields that are missing or have different search settings, and the declared fields that
+    # exist with a different type (which Kendra can't change)
+    configured = {config['Name']: config for config in configurations}
+    updates = []
+    conflicts = []
+    for field in schema:
+        config = configured.get(field['Name'])
+        if config is None:
+            updates.append(field)
+        elif config.get('Type') != field['Type']:
+            conflicts.append(field)
+        elif any(config.get('Search', {}).get(k) != v for k, v in field['Search'].items()):
+            updates.append(field)
+    return [updates, conflicts]
+
+def reconcile_index_schema(name, indexId, schema):
+    """Makes the metadata field configuration of the index match the declared schema, with a single update_index
+    call for the fields that differ (and none if the index is up to date). The hash of the last reconciled schema
+    is kept in the status table, so the index is only read again when the schema changes, or after
+    INDEX_SCHEMA_RECHECK_SECS (to notice changes made outside the indexer). Returns the updated fields."""
+    logger.info(f"reconcile_index_schema(indexId={indexId}, fields={[field['Name'] for field in schema]})")
+    if not schema:
+        return []
+    schema_hash = get_index_schema_hash(indexId, schema)
+    item = get_statusTableItem(get_index_schema_item_id(name)) or {}
+    if item.get('schema_hash') == schema_hash and time.time() - int(item.get('reconciled_at', 0)) < INDEX_SCHEMA_RECHECK_SECS:
+        logger.info("Index schema already reconciled - no update needed")
+        return []
+    updates, conflicts = diff_index_schema(get_index_metadata_configurations(indexId), schema)
+    for field in conflicts:
+        logger.error(f"Index field {field['Name']} exists with a different type - expected {field['Type']}")
+    if updates:
+        logger.info(f"Update index fields: {[field['Name'] for field in updates]}")
+        resp = KENDRA.update_index(Id=indexId, DocumentMetadataConfigurationUpdates=updates)
+        logger.info(f"response:" + json.dumps(resp))
+        INDEX_CONFIG_CACHE.invalidate(indexId)
+    else:
+        logger.info("Index fields match the schema - no update needed")
+    DYNAMODB_LIMITER.acquire()
+    get_status_table().put_item(
+        Item={
+            'id': get_index_schema_item_id(name),
+            'schema_hash': schema_hash,
+            'reconciled_at': int(time.time()),
+            'fields': [field['Name'] for field in schema]
+        }
+    )
+    return updates
 
 
 def is_kendra_sync_running(dsId, indexId):
@@ -121,10 +383,29 @@ def is_kendra_sync_running(dsId, indexId):
                 return h['Status']
     return False
                 
+def get_running_kendra_sync_job_id(dsId, indexId):
+    # ExecutionId of the running sync job that new documents can be added to, or None
+    resp = KENDRA.list_data_source_sync_jobs(Id=dsId, IndexId=indexId)
+    for h in resp.get('History', []):
+        if h['Status'] == 'SYNCING':
+            return h['ExecutionId']
+    return None
+                
+def get_or_start_kendra_sync_job(dsId, indexId):
+    # Use the running sync job if there is one, otherwise start a new one
+    logger.info(f"get_or_start_kendra_sync_job(dsId={dsId}, indexId={indexId})")
+    kendra_sync_job_id = get_running_kendra_sync_job_id(dsId, indexId)
+    if kendra_sync_job_id:
+        return kendra_sync_job_id
+    logger.info(f"start data source sync job")
+    response = KENDRA.start_data_source_sync_job(Id=dsId, IndexId=indexId)
+    logger.info(f"response:" + json.dumps(response))
+    return response['ExecutionId']
+
 def start_kendra_sync_job(dsId, indexId):
     logger.info(f"start_kendra_sync_job(dsId={dsId}, indexId={indexId})")
     # If all jobs are done ensure sync job is stopped.
-    stop_kendra_sync_job_when_all_done(dsId=dsId, indexId=indexId)
+    stop_kendra_sync_job_when_all_done(dsId=dsId, indexId=indexId, wait=True)
     # Check if sync job is still running
     if is_kendra_sync_running(dsId, indexId):
         return None
@@ -134,20 +415,22 @@ def start_kendra_sync_job(dsId, indexId):
     logger.info(f"response:" + json.dumps(response))
     return response['ExecutionId']
 
-def stop_kendra_sync_job_when_all_done(dsId, indexId):
-    logger.info(f"stop_kendra_sync_job_when_all_done(dsId={dsId}, indexId={indexId})")
-    response = TABLE.scan(
-                Select="COUNT",
-                FilterExpression=Attr('sync_state').eq('RUNNING')
-            )
-    logger.info("DynamoDB scan result: " + json.dumps(response))
-    if (response['Count'] == 0):
+def stop_kendra_sync_job_when_all_done(dsId, indexId, wait=False):
+    # Stops the data source sync job if no media files are being transcribed or indexed. Only waits for the sync job
+    # to stop if wait is True (e.g. before starting a new one) - otherwise it stops in the background.
+    logger.info(f"stop_kendra_sync_job_when_all_done(dsId={dsId}, indexId={indexId}, wait={wait})")
+    count = get_sync_running_count()
+    if count is None:
+        # no counter yet (e.g. stack upgraded since the last crawl) - count the files and create it
+        count = count_sync_running_files()
+        reset_sync_running_count(count, None)
+    if (count <= 0):
         #All DONE
         logger.info("No media files currently being transcribed. Stop Data Source Sync.")
         logger.info(f"KENDRA.stop_data_source_sync_job(Id={dsId}, IndexId={indexId})")
         KENDRA.stop_data_source_sync_job(Id=dsId, IndexId=indexId)
         i = 0
-        while True: 
+        while wait: 
             logger.info(f"waiting 5sec for sync job to stop")
             time.sleep(5)
             kendra_sync_running = is_kendra_sync_running(dsId, indexId)
@@ -162,9 +445,74 @@ def stop_kendra_sync_job_when_all_done(dsId, indexId):
                 break
             i += 1
     else:
-        logger.info(f"Can't stop Data Source since Transcribe jobs are still running - count: {response['Count']}")
+        logger.info(f"Can't stop Data Source since Transcribe jobs are still running - count: {count}")
     return True
 
+# Count of media files with sync_state RUNNING, kept up to date by put_statusTableItem() from the previous state of
+# each item it replaces, so checking whether all files are done is a single read rather than a table scan.
+# The crawler corrects any drift at the start of each crawl.
+SYNC_COUNT_ITEM_ID = f"{STACK_NAME}#sync_running"
+
+def update_sync_running_count(old_sync_state, new_sync_state):
+    delta = int(new_sync_state == "RUNNING") - int(old_sync_state == "RUNNING")
+    if delta == 0:
+        return False
+    DYNAMODB_LIMITER.acquire()
+    get_status_table().update_item(
+        Key={'id': SYNC_COUNT_ITEM_ID},
+        UpdateExpression="ADD files_syncing :delta",
+        ExpressionAttributeValues={':delta': delta}
+    )
+    return True
+
+def get_sync_running_count():
+    # Number of files being transcribed or indexed, or None if there is no counter item
+    DYNAMODB_LIMITER.acquire()
+    response = get_status_table().get_item(Key={'id': SYNC_COUNT_ITEM_ID}, ConsistentRead=True)
+    if 'files_syncing' not in response.get('Item', {}):
+        return None
+    return int(response['Item']['files_syncing'])
+
+def reset_sync_running_count(count, previous_count):
+    # Sets the count, only if the counter still holds previous_count (None if there was no counter) - the value read
+    # before the files were counted - so that changes made by other functions while counting are not lost.
+    # Returns False if the counter changed.
+    logger.info(f"reset_sync_running_count({count}, previous_count={previous_count})")
+    update_args = {
+        "Key": {'id': SYNC_COUNT_ITEM_ID},
+        "UpdateExpression": "SET files_syncing = :count",
+        "ConditionExpression": "attribute_not_exists(files_syncing)",
+        "ExpressionAttributeValues": {':count': count}
+    }
+    if previous_count is not None:
+        update_args["ConditionExpression"] = "files_syncing = :previous"
+        update_args["ExpressionAttributeValues"][':previous'] = previous_count
+    try:
+        DYNAMODB_LIMITER.acquire()
+        get_status_table().update_item(**update_args)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Sync running count changed while the files were counted - not reset")
+        return False
+    return True
+
+def count_sync_running_files(status_items=None):
+    # Number of media files with sync_state RUNNING, from preloaded status items or a table scan
+    if status_items is not None:
+        return sum(1 for item in status_items.values() if item.get('sync_state') == 'RUNNING')
+    return count_status_items(Attr('sync_state').eq('RUNNING'))
+
+def correct_sync_running_count():
+    # Recounts the files being transcribed or indexed before a crawl starts a sync job, correcting any drift (e.g. a
+    # crash between a status write and the counter update) - a count too high would keep every crawl from starting,
+    # and one too low would stop the sync job while files are still being indexed. The counter is left alone if it
+    # changed during the scan, and corrected by the next crawl instead.
+    count = get_sync_running_count()
+    files_syncing = count_sync_running_files()
+    if files_syncing != count:
+        logger.info(f"Sync running count was {count} - correct to {files_syncing}")
+        reset_sync_running_count(files_syncing, count)
 
 def get_s3urls(response):
     s3urls=[]
@@ -175,71 +523,153 @@ def get_s3urls(response):
     
 def get_all_indexed_files():
     logger.info(f"get_all_indexed_files()")
-    scan_args={
-        "Select":"SPECIFIC_ATTRIBUTES",
-        "ProjectionExpression":'id',
-        "FilterExpression":Attr('status').ne(None) & Attr('status').ne('DELETED')        
-    }
-    logger.info("Initial page scan")
-    response = TABLE.scan(**scan_args)
-    files=get_s3urls(response)
-    exclusiveStartKey = response.get("LastEvaluatedKey")
-    # handle possible pagination (boto3 paginator not available for table api)
-    while exclusiveStartKey:
-        logger.info("Subsequent page scan")
-        scan_args["ExclusiveStartKey"] = exclusiveStartKey
-        response = TABLE.scan(**scan_args)
-        exclusiveStartKey = response.get("LastEvaluatedKey")
-        files = files + get_s3urls(response)
-    return files
+    items = scan_status_items(attributes=['id'], filter_expression=Attr('status').ne(None) & Attr('status').ne('DELETED'))
+    return [item['id'] for item in items]
     
 def batches(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
         
-def delete_kendra_docs(dsId, indexId, kendra_sync_job_id, deletions):
-    logger.info(f"delete_kendra_docs(dsId={dsId}, indexId={indexId}, deletions[{len(deletions)} docs..])")
-    deletion_batches = list(batches(deletions,10))
-    for deletion_batch in deletion_batches:
+# Kendra errors that mean 'try again later' - the call is retried with backoff
+KENDRA_RETRYABLE_ERRORS = ['ThrottlingException', 'InternalServerException']
+
+def get_backoff_secs(attempt):
+    # exponential backoff with jitter: ~0.5, 1, 2, 4.. seconds, at most 20
+    return min(20, 0.5 * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+# A media file indexed in segments (see TRANSCRIPT_SEGMENT_SECS in jobcomplete.py) has one Kendra document per
+# segment, with id <s3url>#segment=<window>, instead of one document with id <s3url>
+SEGMENT_ID_SEPARATOR = "#segment="
+SEGMENT_ID_PATTERN = re.compile(r"^(.*)" + re.escape(SEGMENT_ID_SEPARATOR) + r"\d+$", re.DOTALL)
+
+def get_segment_document_id(s3url, window):
+    return f"{s3url}{SEGMENT_ID_SEPARATOR}{window}"
+
+def get_document_ids(s3url, item):
+    # ids of the Kendra documents of a media file, from its status item - the id of the single document is included
+    # for a file indexed in segments too, since it may have been indexed before segments were enabled
+    segment_hashes = (item or {}).get('segment_hashes') or {}
+    return [s3url] + [get_segment_document_id(s3url, window) for window in segment_hashes]
+
+def get_document_s3url(document_id):
+    # media file of a Kendra document id
+    m = SEGMENT_ID_PATTERN.match(document_id)
+    return m.group(1) if m else document_id
+
+def delete_kendra_doc_batch(dsId, indexId, kendra_sync_job_id, deletion_batch):
+    # Deletes a batch of up to 10 documents from the index. Throttled calls, and documents that failed with an
+    # internal error, are retried with backoff. Returns [failures, retries] - failures maps the id of each
+    # document that could not be deleted to the reason.
+    pending = list(deletion_batch)
+    failures = {}
+    retries = 0
+    for attempt in range(KENDRA_DELETE_MAX_RETRIES + 1):
+        if attempt:
+            retries += 1
+            time.sleep(get_backoff_secs(attempt))
+        logger.info(f"KENDRA.batch_delete_document - {len(pending)} documents, first few: {pending[0:2]}")
+        KENDRA_DELETE_LIMITER.acquire()
         try:
-            logger.info(f"KENDRA.batch_delete_document - {len(deletion_batch)} documents, first few: {deletion_batch[0:2]}")
             response = KENDRA.batch_delete_document(
                 IndexId=indexId,
-                DocumentIdList=deletion_batch,
+                DocumentIdList=pending,
                 DataSourceSyncJobMetricTarget={
                     'DataSourceId': dsId,
                     'DataSourceSyncJobId': kendra_sync_job_id
                     }
                 )
-            if "FailedDocuments" in response:
-                for failedDocument in response["FailedDocuments"]:
-                    logger.error(f"Failed to delete doc from index: {failedDocument['Id']}. Reason {failedDocument['ErrorMessage']}")
-                    put_statusTableItem(id=failedDocument['Id'], status="DELETED", sync_state="FAILED TO DELETE FROM INDEX")
+        except ClientError as e:
+            if e.response['Error']['Code'] in KENDRA_RETRYABLE_ERRORS and attempt < KENDRA_DELETE_MAX_RETRIES:
+                logger.info(f"KENDRA.batch_delete_document - retry after {e.response['Error']['Code']}")
+                continue
+            logger.error("Exception in KENDRA.batch_delete_document: " + str(e))
+            failures.update({s3url: str(e) for s3url in pending})
+            return [failures, retries]
         except Exception as e:
             logger.error("Exception in KENDRA.batch_delete_document: " + str(e))
-            for s3url in deletions:
-                put_statusTableItem(id=s3url, status="DELETED", sync_state="FAILED TO DELETE FROM INDEX")
-            return False
-    return True
+            failures.update({s3url: str(e) for s3url in pending})
+            return [failures, retries]
+        pending = []
+        for failedDocument in response.get("FailedDocuments", []):
+            reason = f"{failedDocument.get('ErrorCode')}: {failedDocument.get('ErrorMessage')}"
+            if failedDocument.get('ErrorCode') == 'InternalError' and attempt < KENDRA_DELETE_MAX_RETRIES:
+                pending.append(failedDocument['Id'])
+            else:
+                failures[failedDocument['Id']] = reason
+        if not pending:
+            break
+    return [failures, retries]
+
+def delete_kendra_docs(dsId, indexId, kendra_sync_job_id, deletions):
+    # Deletes documents from the index in batches of 10, with up to KENDRA_DELETE_CONCURRENCY batches in parallel and
+    # at most KENDRA_DELETE_MAX_TPS calls per second. A batch that fails does not stop the others - documents that
+    # could not be deleted are recorded in the status table. Returns True if all the documents were deleted.
+    logger.info(f"delete_kendra_docs(dsId={dsId}, indexId={indexId}, deletions[{len(deletions)} docs..])")
+    start_time = time.time()
+    def delete_batch(deletion_batch):
+        return delete_kendra_doc_batch(dsId, indexId, kendra_sync_job_id, deletion_batch)
+    failures = {}
+    retries = 0
+    batch_count = 0
+    for deletion_batch, result, exception in map_concurrently(delete_batch, batches(deletions, 10), KENDRA_DELETE_CONCURRENCY):
+        batch_count += 1
+        if exception:
+            failures.update({s3url: str(exception) for s3url in deletion_batch})
+            continue
+        failures.update(result[0])
+        retries += result[1]
+    for document_id, reason in failures.items():
+        logger.error(f"Failed to delete doc from index: {document_id}. Reason {reason}")
+        put_statusTableItem(id=get_document_s3url(document_id), status="DELETED", sync_state="FAILED TO DELETE FROM INDEX")
+    logger.info(f"Kendra document deletion summary - requested: {len(deletions)}, deleted: {len(deletions) - len(failures)}, failed: {len(failures)}, batches: {batch_count}, retries: {retries}, seconds: {round(time.time() - start_time, 1)}")
+    return not failures
 
-def process_deletions(dsId, indexId, kendra_sync_job_id, s3files):
+def process_deletions(dsId, indexId, kendra_sync_job_id, s3files, indexed_files=None):
     logger.info(f"process_deleted_files(dsId={dsId}, indexId={indexId}, s3files[])")
-    # get list of indexed files from the DynamoDB table
-    indexed_files = get_all_indexed_files()
+    # get list of indexed files from the DynamoDB table, unless already provided by the caller
+    if indexed_files is None:
+        indexed_files = get_all_indexed_files()
     logger.info(f"s3 file count: {len(s3files)}, first few: {s3files[0:2]}")
     logger.info(f"indexed file count: {len(indexed_files)}, first few: {indexed_files[0:2]}")
     # identify indexed_files not in the list of current s3files
     deletions = list(set(indexed_files) - set((s3files)))
     if deletions:
         logger.info(f"Deleted file count: {len(deletions)}, first few: {deletions[0:2]}...")
-        for s3url in deletions:
-            put_statusTableItem(id=s3url, status="DELETED", sync_state="DELETED")
-        delete_kendra_docs(dsId, indexId, kendra_sync_job_id, deletions)
+        delete_files(dsId, indexId, kendra_sync_job_id, deletions)
     else:
         logger.info("No deleted files.. nothing to do")
     return True
+
+def delete_files(dsId, indexId, kendra_sync_job_id, deletions):
+    # mark deleted media files in the DynamoDB table and remove their documents from the index
+    document_ids = []
+    for s3url in deletions:
+        response = put_statusTableItem(id=s3url, status="DELETED", sync_state="DELETED")
+        document_ids += get_document_ids(s3url, response.get('Attributes'))
+    return delete_kendra_docs(dsId, indexId, kendra_sync_job_id, document_ids)
     
+# Media file status attributes loaded by get_all_file_status() 
+FILE_STATUS_ATTRIBUTES = ['id', 'lastModified', 'size_bytes', 'duration_secs', 'status', 
+                          'metadata_url', 'metadata_lastModified', 'transcribeopts_url', 'transcribeopts_lastModified', 
+                          'transcribe_job_id', 'transcribe_state', 'transcribe_secs', 'sync_job_id', 'sync_state', 'fingerprint', 'backlog_rank', 'crawl_generation', 'segment_hashes']
+
+def get_all_file_status():
+    # Load the status of all tracked media files with a single parallel scan, so the crawler
+    # does not need a get_item per file. Returns a dict of status items keyed by s3url.
+    logger.info(f"get_all_file_status()")
+    items = {}
+    for item in scan_status_items(attributes=FILE_STATUS_ATTRIBUTES):
+        # skip items that do not track a media file (e.g. the crawler state item)
+        if item.get('status') is not None:
+            items[item['id']] = item
+    logger.info(f"Loaded status of {len(items)} media files")
+    return items
+
+def get_indexed_files(status_items):
+    # list of indexed files, from status items loaded by get_all_file_status()
+    return [s3url for s3url, item in status_items.items() if item.get('status') != 'DELETED']
+
 def get_crawler_state(name):
     logger.info(f"get_crawler_state({name})")
     item = get_statusTableItem(name)
@@ -247,6 +677,13 @@ def get_crawler_state(name):
         return item['crawler_state']
     return None
     
+def get_crawler_checkpoint(name):
+    logger.info(f"get_crawler_checkpoint({name})")
+    item = get_statusTableItem(name)
+    if item and item.get('crawler_state') == 'RUNNING' and item.get('crawler_checkpoint'):
+        return item['crawler_checkpoint']
+    return None
+
 def get_file_status(s3url):
     logger.info(f"get_file_status({s3url})")
     return get_statusTableItem(s3url)
@@ -255,7 +692,8 @@ def get_file_status(s3url):
 def get_statusTableItem(id):
     item=None
     try:
-        response = TABLE.get_item(Key={'id': id})
+        DYNAMODB_LIMITER.acquire()
+        response = get_status_table().get_item(Key={'id': id})
     except Exception as e:
         logger.error(e)
         return None
@@ -268,38 +706,166 @@ def get_statusTableItem(id):
 def put_crawler_state(name, status):
     logger.info(f"put_crawler_status({name}, status={status})")
     return put_statusTableItem(id=name, crawler_state=status)
+
+# Save the position and counters of a running crawl, so it can be continued by another invocation.
+# Replaces the crawler state item with crawler_state RUNNING. Setting crawler state STOPPED clears the checkpoint. 
+def put_crawler_checkpoint(name, checkpoint):
+    checkpoint['heartbeat'] = int(time.time())
+    logger.info(f"put_crawler_checkpoint({name}, checkpoint={json.dumps(checkpoint, default=str)})")
+    DYNAMODB_LIMITER.acquire()
+    return get_status_table().put_item(
+        Item={
+            'id': name,
+            'crawler_state': 'RUNNING',
+            'crawler_checkpoint': checkpoint
+        }
+    )
     
+def update_file_status(s3url, expected=None, **attributes):
+    """Update only the given status attributes of a tracked media file, e.g.
+    update_file_status(s3url, expected={'transcribe_job_id': job_name}, transcribe_state="DONE", transcribe_secs=12)
+    Attributes set to None are removed. The update is conditional on the file being tracked, and on each attribute
+    in expected having the given value (or not set, if the value is None), so a file that has moved on (e.g.
+    modified and transcribed again) is not changed. Returns True if the item was updated, or False if a condition failed."""
+    logger.info(f"update_file_status({s3url}, expected={expected}, attributes={attributes})")
+    attributes = dict(attributes)
+    if attributes.get('crawl_generation'):
+        attributes['crawl_shard'] = get_crawl_shard(s3url)
+    names = {}
+    values = {}
+    set_actions = []
+    remove_actions = []
+    for i, (attr, value) in enumerate(attributes.items()):
+        names[f"#a{i}"] = attr
+        if value is None:
+            remove_actions.append(f"#a{i}")
+        else:
+            values[f":a{i}"] = value
+            set_actions.append(f"#a{i} = :a{i}")
+    update_expression = ""
+    if set_actions:
+        update_expression += "SET " + ", ".join(set_actions)
+    if remove_actions:
+        update_expression += " REMOVE " + ", ".join(remove_actions)
+    conditions = ["attribute_exists(id)"]
+    for i, (attr, value) in enumerate((expected or {}).items()):
+        names[f"#e{i}"] = attr
+        if value is None:
+            values[":null"] = "NULL"
+            conditions.append(f"(attribute_not_exists(#e{i}) OR attribute_type(#e{i}, :null))")
+        else:
+            values[f":e{i}"] = value
+            conditions.append(f"#e{i} = :e{i}")
+    update_args = {
+        "Key": {'id': s3url},
+        "UpdateExpression": update_expression.strip(),
+        "ConditionExpression": " AND ".join(conditions),
+        "ExpressionAttributeNames": names,
+        "ReturnValues": "UPDATED_OLD"
+    }
+    if values:
+        update_args["ExpressionAttributeValues"] = values
+    try:
+        DYNAMODB_LIMITER.acquire()
+        response = get_status_table().update_item(**update_args)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info(f"Status of {s3url} not updated - it is no longer in the expected state: {expected}")
+        return False
+    if 'sync_state' in attributes:
+        update_sync_running_count(response.get('Attributes', {}).get('sync_state'), attributes['sync_state'])
+    return True
+
 def put_file_status(s3url, lastModified, size_bytes, duration_secs, status,
                     metadata_url, metadata_lastModified,
                     transcribeopts_url, transcribeopts_lastModified,
                     transcribe_job_id, transcribe_state, transcribe_secs, 
-                    sync_job_id, sync_state):
-    logger.info(f"put_file_status({s3url}, lastModified={lastModified}, size_bytes={size_bytes}, duration_secs={duration_secs}, status={status}, metadata_url={metadata_url}, metadata_lastModified={metadata_lastModified}, transcribeopts_url={transcribeopts_url}, transcribeopts_lastModified={transcribeopts_lastModified}, transcribe_job_id={transcribe_job_id}, transcribe_state={transcribe_state}, transcribe_secs={transcribe_secs}, sync_job_id={sync_job_id}, sync_state={sync_state})")
-    return put_statusTableItem(s3url, lastModified, size_bytes, duration_secs, status, metadata_url, metadata_lastModified, transcribeopts_url, transcribeopts_lastModified, transcribe_job_id, transcribe_state, transcribe_secs, sync_job_id, sync_state)
+                    sync_job_id, sync_state, fingerprint=None, backlog_rank=None, crawl_generation=None, segment_hashes=None):
+    logger.info(f"put_file_status({s3url}, lastModified={lastModified}, size_bytes={size_bytes}, duration_secs={duration_secs}, status={status}, metadata_url={metadata_url}, metadata_lastModified={metadata_lastModified}, transcribeopts_url={transcribeopts_url}, transcribeopts_lastModified={transcribeopts_lastModified}, transcribe_job_id={transcribe_job_id}, transcribe_state={transcribe_state}, transcribe_secs={transcribe_secs}, sync_job_id={sync_job_id}, sync_state={sync_state}, fingerprint={fingerprint}, backlog_rank={backlog_rank}, crawl_generation={crawl_generation}, segments={len(segment_hashes or [])})")
+    return put_statusTableItem(s3url, lastModified, size_bytes, duration_secs, status, metadata_url, metadata_lastModified, transcribeopts_url, transcribeopts_lastModified, transcribe_job_id, transcribe_state, transcribe_secs, sync_job_id, sync_state, fingerprint=fingerprint, backlog_rank=backlog_rank, crawl_generation=crawl_generation, segment_hashes=segment_hashes)
 
 # Currently use same DynamoDB table to track status of indexer (id=stackname) as well as each S3 media file (id=s3url)
-def put_statusTableItem(id, lastModified=None, size_bytes=None, duration_secs=None, status=None, metadata_url=None, metadata_lastModified=None, transcribeopts_url=None, transcribeopts_lastModified=None, transcribe_job_id=None, transcribe_state=None, transcribe_secs=None, sync_job_id=None, sync_state=None, crawler_state=None):
-    response = TABLE.put_item(
-       Item={
-            'id': id,
-            'lastModified': lastModified,
-            'size_bytes': size_bytes,
-            'duration_secs': duration_secs,
-            'status': status,
-            'metadata_url': metadata_url,
-            'metadata_lastModified': metadata_lastModified,
-            'transcribeopts_url': transcribeopts_url,
-            'transcribeopts_lastModified': transcribeopts_lastModified,
-            'transcribe_job_id': transcribe_job_id,
-            'transcribe_state': transcribe_state,
-            'transcribe_secs': transcribe_secs,
-            'sync_job_id': sync_job_id,
-            'sync_state': sync_state,
-            'crawler_state': crawler_state
-        }
+def put_statusTableItem(id, lastModified=None, size_bytes=None, duration_secs=None, status=None, metadata_url=None, metadata_lastModified=None, transcribeopts_url=None, transcribeopts_lastModified=None, transcribe_job_id=None, transcribe_state=None, transcribe_secs=None, sync_job_id=None, sync_state=None, crawler_state=None, fingerprint=None, backlog_rank=None, crawl_generation=None, segment_hashes=None):
+    DYNAMODB_LIMITER.acquire()
+    response = get_status_table().put_item(
+       Item=get_statusTableItemDict(id, lastModified, size_bytes, duration_secs, status, metadata_url, metadata_lastModified, transcribeopts_url, transcribeopts_lastModified, transcribe_job_id, transcribe_state, transcribe_secs, sync_job_id, sync_state, crawler_state, fingerprint, backlog_rank, crawl_generation, segment_hashes),
+       ReturnValues="ALL_OLD"
     )
+    update_sync_running_count(response.get('Attributes', {}).get('sync_state'), sync_state)
     return response
-    
+
+def get_statusTableItemDict(id, lastModified=None, size_bytes=None, duration_secs=None, status=None, metadata_url=None, metadata_lastModified=None, transcribeopts_url=None, transcribeopts_lastModified=None, transcribe_job_id=None, transcribe_state=None, transcribe_secs=None, sync_job_id=None, sync_state=None, crawler_state=None, fingerprint=None, backlog_rank=None, crawl_generation=None, segment_hashes=None):
+    item = {
+        'id': id,
+        'lastModified': lastModified,
+        'size_bytes': size_bytes,
+        'duration_secs': duration_secs,
+        'status': status,
+        'metadata_url': metadata_url,
+        'metadata_lastModified': metadata_lastModified,
+        'transcribeopts_url': transcribeopts_url,
+        'transcribeopts_lastModified': transcribeopts_lastModified,
+        'transcribe_job_id': transcribe_job_id,
+        'transcribe_state': transcribe_state,
+        'transcribe_secs': transcribe_secs,
+        'sync_job_id': sync_job_id,
+        'sync_state': sync_state,
+        'crawler_state': crawler_state
+    }
+    # fingerprint, backlog and crawl generation attributes are secondary index keys, so they are omitted rather than stored as null
+    if fingerprint:
+        item['fingerprint'] = fingerprint
+    if backlog_rank:
+        # file is queued for transcription - see transcription.py
+        item['backlog'] = 'QUEUED'
+        item['backlog_rank'] = backlog_rank
+    if crawl_generation and status != "DELETED":
+        # last crawl that found the file - see get_stale_files()
+        item['crawl_generation'] = crawl_generation
+        item['crawl_shard'] = get_crawl_shard(id)
+    if segment_hashes and status != "DELETED":
+        # file is indexed in segments - see get_document_ids()
+        item['segment_hashes'] = segment_hashes
+    return item
+
+def is_file_status_unchanged(stored_item, item):
+    # True if the stored status item already holds the same media file status attributes as item. The crawl
+    # generation changes on every crawl, so it is not compared - callers stamp it with stamp_crawl_generation()
+    if stored_item is None:
+        return False
+    return all(stored_item.get(attr) == item.get(attr) for attr in FILE_STATUS_ATTRIBUTES if attr != 'crawl_generation')
+
+def put_unchanged_file_status(item):
+    # Writes the status item of a file found unchanged by a crawl. The item is built from status read before the
+    # crawl, so the put is conditional on the stored file not having moved to RUNNING since then - a file whose
+    # transcription or indexing started meanwhile keeps its status, and as neither the stored nor the written item
+    # is RUNNING, the sync running count is unchanged. Returns False if the file is RUNNING.
+    try:
+        DYNAMODB_LIMITER.acquire()
+        get_status_table().put_item(
+            Item=item,
+            ConditionExpression="attribute_not_exists(sync_state) OR sync_state <> :running",
+            ExpressionAttributeValues={':running': 'RUNNING'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Transcription or indexing started since the status was read, skipping write: " + item['id'])
+        return False
+    return True
+
+class StatusWriteCounts:
+    # Counts the status writes for unchanged files from any thread, for the crawl summary: 'written' (whole item),
+    # 'stamped' (crawl generation only), 'skipped' (no write) and 'rejected' (file started running meanwhile)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
 def get_transcription_job(job_name):
     logger.info(f"get_transcription_job({job_name})")
     try:
@@ -311,6 +877,188 @@ def get_transcription_job(job_name):
     logger.info("get_transcription_job response: " + json.dumps(response, default=str))
     return response
 
+def get_transcript_s3url(job_name):
+    # Location of the transcript of a job started with an output bucket - see get_transcribe_args()
+    if not TRANSCRIPT_BUCKET:
+        return None
+    return f"s3://{TRANSCRIPT_BUCKET}/{TRANSCRIPT_PREFIX}{job_name}.json"
+
+def parse_transcript_uri(transcript_uri):
+    # Returns the s3url of a TranscriptFileUri in an output bucket (https://s3.<region>.amazonaws.com/<bucket>/<key>),
+    # or None for a presigned URI of a transcript kept by Transcribe
+    r = urllib.parse.urlparse(transcript_uri)
+    if r.scheme != "https" or r.query or not r.netloc.endswith(".amazonaws.com"):
+        return None
+    if r.netloc.startswith("s3.") or r.netloc.startswith("s3-"):
+        # path style
+        bucket, _, key = r.path.lstrip("/").partition("/")
+    elif ".s3." in r.netloc or ".s3-" in r.netloc:
+        # virtual hosted style
+        bucket, key = r.netloc.split(".s3")[0], r.path.lstrip("/")
+    else:
+        return None
+    if not bucket or not key:
+        return None
+    return f"s3://{bucket}/{urllib.parse.unquote(key)}"
+
+def is_transcript_available(job_name):
+    # True if the transcript of a completed job can still be read - from the output bucket, where it is kept, or
+    # from Transcribe, which deletes jobs (and their transcripts) after 90 days
+    transcript_s3url = get_transcript_s3url(job_name)
+    if transcript_s3url:
+        bucket, key, file_name = parse_s3url(transcript_s3url)
+        if head_s3_object(bucket, key):
+            return True
+    transcription_job = get_transcription_job(job_name)
+    return bool(transcription_job) and transcription_job['TranscriptionJob']['TranscriptionJobStatus'] == 'COMPLETED'
+
+# Media file content fingerprint (ETag, size and Transcribe options ETag) - files with the same 
+# fingerprint have the same transcript, so an existing transcription can be reused
+FINGERPRINT_INDEX = "fingerprint-index"
+
+def get_fingerprint(s3object, s3transcribeoptsobject=None):
+    if not s3object.get('ETag'):
+        return None
+    fingerprint = s3object['ETag'].strip('"') + ":" + str(s3object['Size'])
+    if s3transcribeoptsobject:
+        if not s3transcribeoptsobject.get('ETag'):
+            return None
+        fingerprint += ":" + s3transcribeoptsobject['ETag'].strip('"')
+    return fingerprint
+
+def get_reusable_transcription_job(fingerprint):
+    # Returns the name of a completed transcription job for a media file with the same fingerprint, or None
+    logger.info(f"get_reusable_transcription_job({fingerprint})")
+    DYNAMODB_LIMITER.acquire()
+    response = get_status_table().query(
+        IndexName=FINGERPRINT_INDEX,
+        KeyConditionExpression=Key('fingerprint').eq(fingerprint)
+    )
+    for item in response['Items']:
+        if item.get('status') == 'DELETED' or item.get('transcribe_state') != 'DONE' or not item.get('transcribe_job_id'):
+            continue
+        # transcripts are available for as long as Transcribe keeps the job, or the output bucket keeps the transcript
+        if is_transcript_available(item['transcribe_job_id']):
+            logger.info(f"Reusable transcription job: {item['transcribe_job_id']} (from {item['id']})")
+            return item['transcribe_job_id']
+    return None
+
+# Crawl generations - mark and sweep deletion detection
+# Each crawl has a new generation number, and stamps it on the status items of the media files it finds. Files
+# that are still indexed but have an older generation at the end of the crawl were not found, and are deleted.
+# Stamped items are in the generation index, spread over GENERATION_SHARDS partitions by a hash of their s3url,
+# so the stale files are found with one query per shard, without scanning the table.
+GENERATION_INDEX = "generation-index"
+GENERATION_SHARDS = 16
+
+def get_crawl_generation_item_id(name):
+    return f"{name}#crawl_generation"
+
+def get_crawl_shard(s3url):
+    return zlib.crc32(s3url.encode()) % GENERATION_SHARDS
+
+def start_crawl_generation(name):
+    # Starts a new crawl generation. Returns [generation, swept] - swept is True if a previous crawl completed
+    # its sweep, i.e. all indexed files have been stamped with a generation
+    DYNAMODB_LIMITER.acquire()
+    response = get_status_table().update_item(
+        Key={'id': get_crawl_generation_item_id(name)},
+        UpdateExpression="ADD crawl_generation :one",
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues="ALL_NEW"
+    )
+    item = response['Attributes']
+    logger.info(f"start_crawl_generation({name}) - generation={item['crawl_generation']}, last swept={item.get('swept_generation')}")
+    return [int(item['crawl_generation']), 'swept_generation' in item]
+
+def get_crawl_generation(name):
+    # Generation of the current (or last) crawl, or None if there has been no crawl
+    item = get_statusTableItem(get_crawl_generation_item_id(name))
+    if item and 'crawl_generation' in item:
+        return int(item['crawl_generation'])
+    return None
+
+def put_swept_generation(name, generation):
+    DYNAMODB_LIMITER.acquire()
+    get_status_table().update_item(
+        Key={'id': get_crawl_generation_item_id(name)},
+        UpdateExpression="SET swept_generation = :generation",
+        ExpressionAttributeValues={':generation': generation}
+    )
+    return True
+
+def stamp_crawl_generation(s3url, generation):
+    # Stamp the generation on an existing status item without rewriting it, e.g. for a file found by the crawl
+    # that is still being transcribed, or that failed to process
+    try:
+        DYNAMODB_LIMITER.acquire()
+        get_status_table().update_item(
+            Key={'id': s3url},
+            UpdateExpression="SET crawl_generation = :generation, crawl_shard = :shard",
+            ConditionExpression="attribute_exists(id) AND #status <> :deleted",
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':generation': generation, ':shard': get_crawl_shard(s3url), ':deleted': 'DELETED'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # file is not tracked, or is deleted
+        return False
+    return True
+
+def get_stale_files(generation):
+    # Returns the indexed files stamped with a generation older than generation - read units and memory
+    # are proportional to the number of stale files, not the number of indexed files
+    logger.info(f"get_stale_files(generation={generation})")
+    def query_shard(shard):
+        files = []
+        query_args = {
+            "IndexName": GENERATION_INDEX,
+            "KeyConditionExpression": Key('crawl_shard').eq(shard) & Key('crawl_generation').lt(generation)
+        }
+        while True:
+            DYNAMODB_LIMITER.acquire()
+            response = get_status_table().query(**query_args)
+            files += get_s3urls(response)
+            if not response.get("LastEvaluatedKey"):
+                return files
+            query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    files = []
+    for shard, shard_files, exception in map_concurrently(query_shard, range(GENERATION_SHARDS), GENERATION_SHARDS):
+        if exception:
+            raise exception
+        files += shard_files
+    logger.info(f"Stale file count: {len(files)}")
+    return files
+
+def delete_stale_files(dsId, indexId, kendra_sync_job_id, generation, stale_files):
+    # Like delete_files(), but each file is only marked deleted if it still has a generation older than generation,
+    # since the index is eventually consistent and a file may have been found again since it was queried
+    deletions = []
+    document_ids = []
+    for s3url in stale_files:
+        try:
+            DYNAMODB_LIMITER.acquire()
+            response = get_status_table().put_item(
+                Item=get_statusTableItemDict(id=s3url, status="DELETED", sync_state="DELETED"),
+                ConditionExpression=Attr('crawl_generation').lt(generation),
+                ReturnValues="ALL_OLD"
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            logger.info(f"File found again by crawl generation {generation} - not deleted: {s3url}")
+            continue
+        update_sync_running_count(response.get('Attributes', {}).get('sync_state'), "DELETED")
+        deletions.append(s3url)
+        document_ids += get_document_ids(s3url, response.get('Attributes'))
+    if deletions:
+        logger.info(f"Deleted file count: {len(deletions)}, first few: {deletions[0:2]}...")
+        delete_kendra_docs(dsId, indexId, kendra_sync_job_id, document_ids)
+    else:
+        logger.info("No deleted files.. nothing to do")
+    return True
+
 if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.INFO)
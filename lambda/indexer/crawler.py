@@ -2,8 +2,8 @@
 # SPDX-License-Identifier: MIT-0
 import os
 import json
-import re
 import time
+import collections
 import cfnresponse
 import boto3
 
@@ -12,11 +12,23 @@ SUPPORTED_MEDIA_TYPES = ["mp3","mp4","wav","flac","ogg","amr","webm"]
 
 from common import logger
 from common import INDEX_ID, DS_ID, STACK_NAME
-from common import S3, TRANSCRIBE
-from common import start_kendra_sync_job, stop_kendra_sync_job_when_all_done, process_deletions, make_category_facetable, create_newfacets_youtube
-from common import get_crawler_state, put_crawler_state, get_file_status, put_file_status
-from common import get_transcription_job
-from common import parse_s3url, get_s3jsondata
+from common import S3
+from common import start_kendra_sync_job, stop_kendra_sync_job_when_all_done, is_kendra_sync_running, process_deletions
+from common import get_index_schema, reconcile_index_schema
+from common import get_crawler_state, put_crawler_state, get_file_status, put_file_status, update_file_status
+from common import get_crawler_checkpoint, put_crawler_checkpoint
+from common import get_all_file_status, get_indexed_files, get_all_indexed_files
+from common import correct_sync_running_count
+from common import start_crawl_generation, put_swept_generation, stamp_crawl_generation, get_stale_files, delete_stale_files
+from common import get_statusTableItemDict, is_file_status_unchanged, put_unchanged_file_status, StatusWriteCounts
+from common import is_transcript_available, get_fingerprint, get_reusable_transcription_job
+from common import parse_s3url, head_s3_object
+from common import map_concurrently
+from transcription import submit_media_transcription
+from transcription import get_transcription_slots, count_running_transcriptions, reset_transcription_slots, drain_transcription_backlog
+from transcription import MAX_TRANSCRIBE_JOBS_IN_FLIGHT, is_priority_scheduling
+import inventory
+from cache import log_cache_stats
 
 MEDIA_BUCKET = os.environ['MEDIA_BUCKET']
 YTMEDIA_BUCKET = os.environ['YTMEDIA_BUCKET']
@@ -26,66 +38,45 @@ TRANSCRIBEOPTS_FOLDER_PREFIX = os.environ['TRANSCRIBEOPTS_FOLDER_PREFIX']
 MAKE_CATEGORY_FACETABLE = os.environ['MAKE_CATEGORY_FACETABLE']
 INDEX_YOUTUBE_VIDEOS = os.environ['INDEX_YOUTUBE_VIDEOS']
 JOBCOMPLETE_FUNCTION = os.environ['JOBCOMPLETE_FUNCTION']
+# Queue of the jobcomplete function - files to reindex with an existing transcription are sent here, so they are
+# indexed in batches (empty - the jobcomplete function is invoked once per file)
+JOBCOMPLETE_QUEUE_URL = os.environ.get('JOBCOMPLETE_QUEUE_URL', '')
 TRANSCRIBE_ROLE = os.environ['TRANSCRIBE_ROLE']
+# Number of media files processed in parallel by the crawler (1 = process files serially)
+CRAWLER_CONCURRENCY = int(os.environ.get('CRAWLER_CONCURRENCY', '10'))
+# Load the status of all media files with one table scan at crawl start, instead of a get_item per file
+PRELOAD_FILE_STATUS = os.environ.get('PRELOAD_FILE_STATUS', 'true')
+# Checkpoint the crawl and continue in a new invocation when less than this many seconds remain
+CRAWLER_CHECKPOINT_SECS = int(os.environ.get('CRAWLER_CHECKPOINT_SECS', '120'))
+# A RUNNING crawl that has not saved a checkpoint for this many seconds is assumed to have stopped
+CRAWLER_STALE_SECS = int(os.environ.get('CRAWLER_STALE_SECS', '1800'))
+# Number of sub-prefixes listed in parallel (1 = list each prefix with a single sequential listing)
+LISTING_CONCURRENCY = int(os.environ.get('LISTING_CONCURRENCY', '1'))
+# Crawl source - LIST (list_objects_v2) or INVENTORY (latest S3 Inventory report under INVENTORY_MANIFEST)
+CRAWL_SOURCE = os.environ.get('CRAWL_SOURCE', 'LIST').upper()
+# S3 Inventory manifest file, or destination folder containing inventory reports (s3://bucket/prefix/ or local path)
+INVENTORY_MANIFEST = os.environ.get('INVENTORY_MANIFEST', '')
+# Reuse the transcript of identical media (same ETag, size and Transcribe options) instead of transcribing it again
+DEDUPE_TRANSCRIPTS = os.environ.get('DEDUPE_TRANSCRIPTS', 'true')
+# With a transcription priority policy, start the highest priority queued files after every this many files processed
+PRIORITY_DRAIN_INTERVAL = int(os.environ.get('PRIORITY_DRAIN_INTERVAL', '200'))
 LAMBDA = boto3.client('lambda')
+SQS = boto3.client('sqs')
 
-# generate a unique job name for transcribe satisfying the naming regex requirements 
-def transcribe_job_name(*args):
-    timestamp=time.time()
-    job_name = "__".join(args) + "_" + str(timestamp)
-    job_name = re.sub(r"[^0-9a-zA-Z._-]+","--",job_name)
-    return job_name
-
-def get_transcribe_args(job_name, job_uri, role, transcribeopts_url):
-    transcribeopts = None
-    args = {
-        'TranscriptionJobName':job_name,
-        'Media':{'MediaFileUri': job_uri},
-        'IdentifyLanguage':True,
-        'JobExecutionSettings':{
-            'AllowDeferredExecution': True,
-            'DataAccessRoleArn': role
-        }
-    }
-    if transcribeopts_url:
-        logger.info(f"Merging Transcribe options data from: {transcribeopts_url}")
-        opts = get_s3jsondata(transcribeopts_url)
-        for key, value in opts.items():
-            if key in ['TranscriptionJobName', 'Media']:
-                logger.error(f"Transcribe options may not override reserved argument: {key}")
-            else:
-                # all other options are assigned as arguments
-                args[key] = value
-            if key == 'LanguageCode':
-                args['IdentifyLanguage'] = False
-    return args
-
-
-def start_media_transcription(name, job_uri, role, transcribeopts_url):
-    logger.info(f"start_media_transcription(name={name}, job_uri={job_uri}, role={role}, transcribeopts_url={transcribeopts_url})")
-    job_name = transcribe_job_name(name, job_uri)
-    args = get_transcribe_args(job_name, job_uri, role, transcribeopts_url)
-    logger.info(f"Starting media transcription job: {job_name} - Arguments {args}")
-    try:
-        response = TRANSCRIBE.start_transcription_job(**args)
-    except Exception as e:
-        logger.error("Exception while starting: " + job_name)
-        logger.error(e)
-        return False
-    return job_name
-
-def restart_media_transcription(name, job_uri, role, transcribeopts_url):
-    logger.info(f"restart_media_transcription(name={name}, job_uri={job_uri}, role={role}, transcribeopts_url={transcribeopts_url})")
-    return start_media_transcription(name, job_uri, role, transcribeopts_url)
-    
-def reindex_existing_doc_with_new_metadata(transcribe_job_id):
+def reindex_existing_doc_with_new_metadata(transcribe_job_id, s3url, descr="Metadata modified - reindex existing transcription"):
+    # MediaS3Url identifies the media file to index, since the job may have transcribed an identical copy
     event = json.dumps({
         'detail':{
             'TranscriptionJobName':transcribe_job_id, 
+            'MediaS3Url':s3url,
             'Source': "Crawler Lambda",
-            'Descr': "Metadata modified - reindex existing transcription"
+            'Descr': descr
             }
         })
+    if JOBCOMPLETE_QUEUE_URL:
+        logger.info(f"Existing transcript is still available.. queueing reindex of existing transcription: Event={event}")
+        SQS.send_message(QueueUrl=JOBCOMPLETE_QUEUE_URL, MessageBody=event)
+        return True
     logger.info(f"Existing transcript is still available.. invoking JobComplete function directly to reindex existing transcription: Event={event}")
     LAMBDA.invoke_async(
         FunctionName=JOBCOMPLETE_FUNCTION,
@@ -93,7 +84,18 @@ def reindex_existing_doc_with_new_metadata(transcribe_job_id):
         )
     return True
 
-def process_s3_media_object(crawlername, bucketname, s3url, s3object, s3metadataobject, s3transcribeoptsobject, kendra_sync_job_id, role):
+def get_reusable_transcription(s3url, fingerprint):
+    # Returns the name of a completed transcription job for identical media, or None
+    if DEDUPE_TRANSCRIPTS != 'true' or not fingerprint:
+        return None
+    try:
+        return get_reusable_transcription_job(fingerprint)
+    except Exception as e:
+        # never let a failed lookup stop the file being transcribed
+        logger.error(f"Unable to look up transcriptions of identical media for {s3url}: " + str(e))
+        return None
+
+def process_s3_media_object(crawlername, bucketname, s3url, s3object, s3metadataobject, s3transcribeoptsobject, kendra_sync_job_id, role, status_items=None, write_counts=None, crawl_generation=None):
     logger.info(f"process_s3_media_object() - Key: {s3url}")
     lastModified = s3object['LastModified'].strftime("%m:%d:%Y:%H:%M:%S")
     size_bytes = s3object['Size']
@@ -107,63 +109,140 @@ def process_s3_media_object(crawlername, bucketname, s3url, s3object, s3metadata
     if s3transcribeoptsobject:
         transcribeopts_url = f"s3://{bucketname}/{s3transcribeoptsobject['Key']}"
         transcribeopts_lastModified = s3transcribeoptsobject['LastModified'].strftime("%m:%d:%Y:%H:%M:%S")
-    item = get_file_status(s3url)
+    fingerprint = get_fingerprint(s3object, s3transcribeoptsobject)
+    if status_items is not None:
+        # status preloaded at crawl start
+        item = status_items.get(s3url)
+    else:
+        item = get_file_status(s3url)
     job_name=None
+    transcribe_state=None
     if (item == None or item.get("status") == "DELETED"):
         logger.info("NEW:" + s3url)
-        job_name = start_media_transcription(crawlername, s3url, role, transcribeopts_url)
-        if job_name:
+        result = "NEW"
+        reused_job_name = get_reusable_transcription(s3url, fingerprint)
+        if reused_job_name:
+            result = "NEW-REUSED"
             put_file_status(
                 s3url, lastModified, size_bytes, duration_secs=None, status="ACTIVE-NEW", 
                 metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
                 transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
-                transcribe_job_id=job_name, transcribe_state="RUNNING", transcribe_secs=None, 
-                sync_job_id=kendra_sync_job_id, sync_state="RUNNING"
+                transcribe_job_id=reused_job_name, transcribe_state="DONE", transcribe_secs=None, 
+                sync_job_id=kendra_sync_job_id, sync_state="RUNNING", fingerprint=fingerprint, crawl_generation=crawl_generation
                 )
+            reindex_existing_doc_with_new_metadata(reused_job_name, s3url, "Identical media - index existing transcription")
+        else:
+            job_name, transcribe_state, backlog_rank = submit_media_transcription(crawlername, s3url, role, transcribeopts_url, metadata_url, s3object)
+            if transcribe_state:
+                put_file_status(
+                    s3url, lastModified, size_bytes, duration_secs=None, status="ACTIVE-NEW", 
+                    metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
+                    transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
+                    transcribe_job_id=job_name, transcribe_state=transcribe_state, transcribe_secs=None, 
+                    sync_job_id=kendra_sync_job_id, sync_state="RUNNING", fingerprint=fingerprint, backlog_rank=backlog_rank, crawl_generation=crawl_generation
+                    )
     elif (lastModified != item['lastModified'] or transcribeopts_lastModified != item.get('transcribeopts_lastModified')):
         logger.info("MODIFIED:" + s3url)
-        job_name = restart_media_transcription(crawlername, s3url, role, transcribeopts_url)
-        if job_name:
+        result = "MODIFIED"
+        # e.g. file uploaded again with the same content, or replaced by a copy of another file
+        reused_job_name = get_reusable_transcription(s3url, fingerprint)
+        if reused_job_name:
+            result = "MODIFIED-REUSED"
             put_file_status(
                 s3url, lastModified, size_bytes, duration_secs=None, status="ACTIVE-MODIFIED", 
                 metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
                 transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
-                transcribe_job_id=job_name, transcribe_state="RUNNING", transcribe_secs=None,
-                sync_job_id=kendra_sync_job_id, sync_state="RUNNING"
+                transcribe_job_id=reused_job_name, transcribe_state="DONE", transcribe_secs=None,
+                sync_job_id=kendra_sync_job_id, sync_state="RUNNING", fingerprint=fingerprint, crawl_generation=crawl_generation,
+                segment_hashes=item.get('segment_hashes')
                 )
+            reindex_existing_doc_with_new_metadata(reused_job_name, s3url, "Identical media - index existing transcription")
+        else:
+            job_name, transcribe_state, backlog_rank = submit_media_transcription(crawlername, s3url, role, transcribeopts_url, metadata_url, s3object)
+            if transcribe_state:
+                put_file_status(
+                    s3url, lastModified, size_bytes, duration_secs=None, status="ACTIVE-MODIFIED", 
+                    metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
+                    transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
+                    transcribe_job_id=job_name, transcribe_state=transcribe_state, transcribe_secs=None,
+                    sync_job_id=kendra_sync_job_id, sync_state="RUNNING", fingerprint=fingerprint, backlog_rank=backlog_rank, crawl_generation=crawl_generation,
+                    segment_hashes=item.get('segment_hashes')
+                    )
+            elif crawl_generation:
+                # the job could not be started - the file keeps its status (and documents) until the next crawl
+                # retries it, so it must not be found stale at the end of this crawl
+                stamp_crawl_generation(s3url, crawl_generation)
     elif (metadata_lastModified != item.get('metadata_lastModified')):
         logger.info("METADATA_MODIFIED:" + s3url)
-        if get_transcription_job(item['transcribe_job_id']):
-            # reindex existing transcription with new metadata
-            reindex_existing_doc_with_new_metadata(item['transcribe_job_id'])
+        result = "METADATA_MODIFIED"
+        if item.get('transcribe_state') in ["RUNNING", "QUEUED"]:
+            # transcription in progress or queued - the new metadata is used when the job completes
+            if not update_file_status(
+                    s3url, expected={'transcribe_state': item['transcribe_state']},
+                    metadata_url=metadata_url, metadata_lastModified=metadata_lastModified, fingerprint=fingerprint, crawl_generation=crawl_generation
+                    ):
+                # the job state changed since the status was read - the new metadata is picked up by the next crawl
+                if crawl_generation:
+                    stamp_crawl_generation(s3url, crawl_generation)
+        elif is_transcript_available(item['transcribe_job_id']):
+            # reindex existing transcription with new metadata - once the status is written, since jobcomplete
+            # only indexes files that are waiting to be indexed
             put_file_status(
                 s3url, lastModified, size_bytes, duration_secs=None, status="ACTIVE-METADATA_MODIFIED", 
                 metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
                 transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
                 transcribe_job_id=item['transcribe_job_id'], transcribe_state="DONE", transcribe_secs=item['transcribe_secs'],
-                sync_job_id=kendra_sync_job_id, sync_state="RUNNING"
+                sync_job_id=kendra_sync_job_id, sync_state="RUNNING", fingerprint=fingerprint, crawl_generation=crawl_generation,
+                segment_hashes=item.get('segment_hashes')
                 )
+            reindex_existing_doc_with_new_metadata(item['transcribe_job_id'], s3url)
         else:
             # previous transcription gone - retranscribe 
-            job_name = restart_media_transcription(crawlername, s3url, role, transcribeopts_url)
-            if job_name:
+            job_name, transcribe_state, backlog_rank = submit_media_transcription(crawlername, s3url, role, transcribeopts_url, metadata_url, s3object)
+            if transcribe_state:
                 put_file_status(
                     s3url, lastModified, size_bytes, duration_secs=None, status="ACTIVE-METADATA_MODIFIED", 
                     metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
                     transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
-                    transcribe_job_id=job_name, transcribe_state="RUNNING", transcribe_secs=None,
-                    sync_job_id=kendra_sync_job_id, sync_state="RUNNING"
+                    transcribe_job_id=job_name, transcribe_state=transcribe_state, transcribe_secs=None,
+                    sync_job_id=kendra_sync_job_id, sync_state="RUNNING", fingerprint=fingerprint, backlog_rank=backlog_rank, crawl_generation=crawl_generation,
+                    segment_hashes=item.get('segment_hashes')
                     )
+            elif crawl_generation:
+                # the job could not be started - the file keeps its status (and documents) until the next crawl
+                # retries it, so it must not be found stale at the end of this crawl
+                stamp_crawl_generation(s3url, crawl_generation)
     else:
         logger.info("UNCHANGED:" + s3url)
-        put_file_status(
+        result = "UNCHANGED"
+        status_item = get_statusTableItemDict(
             s3url, lastModified, size_bytes, duration_secs=item['duration_secs'], status="ACTIVE-UNCHANGED", 
             metadata_url=metadata_url, metadata_lastModified=metadata_lastModified,
             transcribeopts_url=transcribeopts_url, transcribeopts_lastModified=transcribeopts_lastModified,
             transcribe_job_id=item['transcribe_job_id'], transcribe_state="DONE", transcribe_secs=item['transcribe_secs'],
-            sync_job_id=item['sync_job_id'], sync_state="DONE"
+            sync_job_id=item['sync_job_id'], sync_state="DONE", fingerprint=fingerprint, crawl_generation=crawl_generation,
+            segment_hashes=item.get('segment_hashes')
             )
-    return s3url
+        if item.get('sync_state') == "RUNNING" or is_file_status_unchanged(item, status_item):
+            # file seen again while it is still being transcribed or indexed (e.g. a repeated S3 event) - keep its
+            # state - or stored status already up to date: skip the write, and only stamp the generation
+            logger.info("Status item unchanged or in progress, skipping write: " + s3url)
+            if crawl_generation and item.get('crawl_generation') != crawl_generation:
+                stamp_crawl_generation(s3url, crawl_generation)
+                write_type = "stamped"
+            else:
+                write_type = "skipped"
+        else:
+            write_type = "written" if put_unchanged_file_status(status_item) else "rejected"
+        if write_counts:
+            write_counts.add(write_type)
+    if result != "UNCHANGED" and job_name is False:
+        # transcription job could not be started - file will be retried on the next crawl
+        result = result + "-NOT_STARTED"
+    elif result != "UNCHANGED" and job_name is None and transcribe_state == "QUEUED":
+        # no free transcription slot - job is started from the backlog when a running job completes
+        result = result + "-QUEUED"
+    return result
 
 def is_supported_media_file(s3key):
     suffix = s3key.rsplit(".",1)[-1]
@@ -209,77 +288,262 @@ def get_transcribeopts_ref_file_key(s3key, media_prefix, transcribeopts_prefix):
         ref_key = s3key.replace(".transcribeopts.json","").replace(transcribeopts_prefix,"")
     return ref_key
 
-def list_s3_objects(bucketname, media_prefix, metadata_prefix, transcribeopts_prefix):
-    logger.info(f"list_s3_media_objects(bucketname{bucketname}, media_prefix={media_prefix}, metadata_prefix={metadata_prefix})")
-    s3mediaobjects={}
-    s3metadataobjects={}
-    s3transcribeoptsobjects={}
-    logger.info(f"Find media and metadata files under media_prefix: {media_prefix}")
+def get_metadata_file_key(media_key, metadata_prefix):
+    # inverse of get_metadata_ref_file_key - the key of the metadata file for a media file
+    return metadata_prefix + media_key + ".metadata.json"
+
+def get_transcribeopts_file_key(media_key, transcribeopts_prefix):
+    # inverse of get_transcribeopts_ref_file_key - the key of the Transcribe options file for a media file
+    return transcribeopts_prefix + media_key + ".transcribeopts.json"
+
+def iter_s3_prefix(bucketname, prefix, start_after=None):
+    # Yields the objects under prefix in key order, one page at a time
     paginator = S3.get_paginator("list_objects_v2")
-    pages = paginator.paginate(Bucket=bucketname, Prefix=media_prefix)
+    if start_after:
+        pages = paginator.paginate(Bucket=bucketname, Prefix=prefix, StartAfter=start_after)
+    else:
+        pages = paginator.paginate(Bucket=bucketname, Prefix=prefix)
     for page in pages:
-        if "Contents" in page:
-            for s3object in page["Contents"]:
-                if is_supported_media_file(s3object['Key']):
-                    logger.info("Supported media file type: " + s3object['Key'])
-                    media_url = f"s3://{bucketname}/{s3object['Key']}"
-                    s3mediaobjects[media_url]=s3object
-                elif metadata_prefix=="" and is_supported_metadata_file(s3object['Key']):
-                    ref_media_key = get_metadata_ref_file_key(s3object['Key'], media_prefix, metadata_prefix)
-                    logger.info(f"Metadata file: {s3object['Key']}. References media file: {ref_media_key}")
-                    media_url = f"s3://{bucketname}/{ref_media_key}"
-                    s3metadataobjects[media_url]=s3object
-                elif transcribeopts_prefix=="" and is_supported_transcribeopts_file(s3object['Key']):
-                    ref_media_key = get_transcribeopts_ref_file_key(s3object['Key'], media_prefix, transcribeopts_prefix)
-                    logger.info(f"Transcribe options file: {s3object['Key']}. References media file: {ref_media_key}")
-                    media_url = f"s3://{bucketname}/{ref_media_key}"
-                    s3transcribeoptsobjects[media_url]=s3object
-                else:
-                    logger.info("File type not supported. Skipping: " + s3object['Key'])
+        for s3object in page.get("Contents", []):
+            yield s3object
+
+def list_s3_prefix(bucketname, prefix, start_after=None):
+    logger.info(f"List objects in {bucketname}/{prefix}")
+    return list(iter_s3_prefix(bucketname, prefix, start_after))
+
+def iter_s3_listing(bucketname, prefix, start_after=None):
+    # Yields the objects under prefix in key order. When LISTING_CONCURRENCY > 1, the sub-prefixes of prefix
+    # are discovered with Delimiter='/' and listed in parallel, and their objects are yielded in key order.
+    if LISTING_CONCURRENCY <= 1:
+        for s3object in iter_s3_prefix(bucketname, prefix, start_after):
+            yield s3object
+        return
+    logger.info(f"Discover sub-prefixes of {bucketname}/{prefix}")
+    # entries are objects directly under prefix, and sub-prefixes - each sub-prefix sorts in the
+    # same position relative to the objects as all the keys it contains
+    entries = []
+    paginator = S3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucketname, Prefix=prefix, Delimiter='/'):
+        for s3object in page.get("Contents", []):
+            if not start_after or s3object['Key'] > start_after:
+                entries.append((s3object['Key'], s3object))
+        for common_prefix in page.get("CommonPrefixes", []):
+            # keep sub-prefixes that contain keys after start_after
+            if not start_after or common_prefix['Prefix'] > start_after or start_after.startswith(common_prefix['Prefix']):
+                entries.append((common_prefix['Prefix'], None))
+    entries.sort(key=lambda entry: entry[0])
+    logger.info(f"Found {sum(1 for entry in entries if entry[1] is None)} sub-prefixes and {sum(1 for entry in entries if entry[1])} objects in {bucketname}/{prefix}")
+    def list_entry(entry):
+        key, s3object = entry
+        if s3object:
+            return [s3object]
+        return list_s3_prefix(bucketname, key, start_after if (start_after and start_after > key) else None)
+    for entry, s3objects, exception in map_concurrently(list_entry, entries, LISTING_CONCURRENCY):
+        if exception:
+            raise exception
+        for s3object in s3objects:
+            yield s3object
+
+class CompanionFileListing:
+    # Metadata or Transcribe options files stored under their own prefix. The listing is read on demand, 
+    # in key order, and the objects are filed by the key of the media file they reference.
+    def __init__(self, bucketname, prefix, description, is_companion_file, get_companion_file_key, get_ref_file_key, media_prefix, start_after=None):
+        self.prefix = prefix
+        self.description = description
+        self.is_companion_file = is_companion_file
+        self.get_companion_file_key = get_companion_file_key
+        self.get_ref_file_key = get_ref_file_key
+        self.media_prefix = media_prefix
+        if start_after and not prefix.startswith(media_prefix):
+            # companion files of media files after start_after all sort after prefix + start_after
+            self.s3objects = iter_s3_listing(bucketname, prefix, prefix + start_after)
         else:
-            logger.info(f"No files found in {bucketname}/{media_prefix}")
-    # if media files were found, AND metadataprefix is defined, then find metadata files under metadataprefix
-    if s3mediaobjects and metadata_prefix:
-        logger.info(f"Find Kendra metadata files under metadata_prefix: {metadata_prefix}")
-        pages = paginator.paginate(Bucket=bucketname, Prefix=metadata_prefix)
-        for page in pages:
-            if "Contents" in page:
-                for s3object in page["Contents"]:
-                    if is_supported_metadata_file(s3object['Key']):
-                        ref_media_key = get_metadata_ref_file_key(s3object['Key'], media_prefix, metadata_prefix)
-                        logger.info(f"Kendra metadata file: {s3object['Key']}. References media file: {ref_media_key}")
-                        media_url = f"s3://{bucketname}/{ref_media_key}"
-                        s3metadataobjects[media_url]=s3object
-                    else:
-                        logger.info("not a Kendra metadatafile. Skipping: " + s3object['Key'])
-            else:
-                logger.info(f"No metadata files found in {bucketname}/{metadata_prefix}")  
-    # if media files were found, AND transcribeopts_prefix is defined, then find transcribe options files under transcribeopts_prefix
-    if s3mediaobjects and transcribeopts_prefix:
-        logger.info(f"Find Transcribe job options files under transcribeopts_prefix: {transcribeopts_prefix}")
-        pages = paginator.paginate(Bucket=bucketname, Prefix=transcribeopts_prefix)
-        for page in pages:
-            if "Contents" in page:
-                for s3object in page["Contents"]:
-                    if is_supported_transcribeopts_file(s3object['Key']):
-                        ref_media_key = get_transcribeopts_ref_file_key(s3object['Key'], media_prefix, transcribeopts_prefix)
-                        logger.info(f"Transcribe options file: {s3object['Key']}. References media file: {ref_media_key}")
-                        media_url = f"s3://{bucketname}/{ref_media_key}"
-                        s3transcribeoptsobjects[media_url]=s3object
-                    else:
-                        logger.info("not a Transcribe options file. Skipping: " + s3object['Key'])
+            self.s3objects = iter_s3_listing(bucketname, prefix)
+        self.last_key = None
+        self.exhausted = False
+        self.found = {}
+
+    def read_past(self, key):
+        while not self.exhausted and (self.last_key is None or self.last_key <= key):
+            s3object = next(self.s3objects, None)
+            if s3object is None:
+                self.exhausted = True
+                break
+            self.last_key = s3object['Key']
+            if self.is_companion_file(s3object['Key']):
+                ref_media_key = self.get_ref_file_key(s3object['Key'], self.media_prefix, self.prefix)
+                logger.info(f"{self.description} file: {s3object['Key']}. References media file: {ref_media_key}")
+                self.found[ref_media_key] = s3object
             else:
-                logger.info(f"No Transcribe options files found in {bucketname}/{transcribeopts_prefix}")   
-    return [s3mediaobjects, s3metadataobjects, s3transcribeoptsobjects]
+                logger.info(f"not a {self.description} file. Skipping: " + s3object['Key'])
+
+    def get(self, media_key):
+        # read the listing until it is past every key that could reference media_key, then return the matching object, if any
+        key = self.get_companion_file_key(media_key, self.prefix)
+        if media_key.startswith(self.prefix):
+            # get_ref_file_key maps keys that are also under the media prefix differently
+            key = max(key, self.get_companion_file_key(media_key, ""))
+        self.read_past(key)
+        return self.found.pop(media_key, None)
+
+def iter_s3_objects(bucketname, media_prefix, metadata_prefix, transcribeopts_prefix, start_after=None):
+    # Streaming listing of media files, joined with their Kendra metadata and Transcribe options files.
+    # Yields [s3url, s3object, s3metadataobject, s3transcribeoptsobject] for each media file in key order, 
+    # as soon as its metadata and options files (if any) have been listed.
+    logger.info(f"iter_s3_objects(bucketname={bucketname}, media_prefix={media_prefix}, metadata_prefix={metadata_prefix}, transcribeopts_prefix={transcribeopts_prefix}, start_after={start_after})")
+    metadata_listing = None
+    transcribeopts_listing = None
+    if metadata_prefix:
+        metadata_listing = CompanionFileListing(bucketname, metadata_prefix, "Kendra metadata", is_supported_metadata_file, get_metadata_file_key, get_metadata_ref_file_key, media_prefix, start_after)
+    if transcribeopts_prefix:
+        transcribeopts_listing = CompanionFileListing(bucketname, transcribeopts_prefix, "Transcribe options", is_supported_transcribeopts_file, get_transcribeopts_file_key, get_transcribeopts_ref_file_key, media_prefix, start_after)
+    # metadata and options files stored with the media files, filed by referenced media key
+    s3metadataobjects={}
+    s3transcribeoptsobjects={}
+    def joined(s3object):
+        media_key = s3object['Key']
+        if metadata_listing:
+            s3metadataobject = metadata_listing.get(media_key)
+        else:
+            s3metadataobject = s3metadataobjects.pop(media_key, None)
+        if transcribeopts_listing:
+            s3transcribeoptsobject = transcribeopts_listing.get(media_key)
+        else:
+            s3transcribeoptsobject = s3transcribeoptsobjects.pop(media_key, None)
+        return [f"s3://{bucketname}/{media_key}", s3object, s3metadataobject, s3transcribeoptsobject]
+    # media files wait here until the listing is past their .metadata.json and .transcribeopts.json keys
+    pending = collections.deque()
+    found = False
+    for s3object in iter_s3_listing(bucketname, media_prefix, start_after):
+        found = True
+        while pending and s3object['Key'] > pending[0]['Key'] + ".transcribeopts.json":
+            yield joined(pending.popleft())
+        if is_supported_media_file(s3object['Key']):
+            logger.info("Supported media file type: " + s3object['Key'])
+            pending.append(s3object)
+        elif metadata_prefix=="" and is_supported_metadata_file(s3object['Key']):
+            ref_media_key = get_metadata_ref_file_key(s3object['Key'], media_prefix, metadata_prefix)
+            logger.info(f"Metadata file: {s3object['Key']}. References media file: {ref_media_key}")
+            s3metadataobjects[ref_media_key]=s3object
+        elif transcribeopts_prefix=="" and is_supported_transcribeopts_file(s3object['Key']):
+            ref_media_key = get_transcribeopts_ref_file_key(s3object['Key'], media_prefix, transcribeopts_prefix)
+            logger.info(f"Transcribe options file: {s3object['Key']}. References media file: {ref_media_key}")
+            s3transcribeoptsobjects[ref_media_key]=s3object
+        else:
+            logger.info("File type not supported. Skipping: " + s3object['Key'])
+    if not found:
+        logger.info(f"No files found in {bucketname}/{media_prefix}")
+    while pending:
+        yield joined(pending.popleft())
+
+def get_inventory_manifest(bucketname):
+    # Returns the latest inventory report manifest for the bucket, or None if the bucket is to be listed
+    if CRAWL_SOURCE != 'INVENTORY':
+        return None
+    manifest = None
+    if INVENTORY_MANIFEST:
+        manifest = inventory.get_latest_manifest(INVENTORY_MANIFEST, bucketname)
+    if manifest == None:
+        logger.info(f"No inventory report found for bucket {bucketname} - list bucket instead")
+    return manifest
+
+def iter_inventory_objects(manifest, media_prefix, metadata_prefix, transcribeopts_prefix, start_position=0):
+    # Inventory report equivalent of iter_s3_objects. Reports are not ordered by key, so a first pass over
+    # the report collects the metadata and options files, and a second pass yields
+    # [s3url, s3object, s3metadataobject, s3transcribeoptsobject] for each media file, in report order,
+    # skipping the first start_position media files.
+    bucketname = manifest['sourceBucket']
+    logger.info(f"iter_inventory_objects(manifest={manifest['location']}, bucket={bucketname}, media_prefix={media_prefix}, metadata_prefix={metadata_prefix}, transcribeopts_prefix={transcribeopts_prefix}, start_position={start_position})")
+    s3metadataobjects={}
+    s3transcribeoptsobjects={}
+    for s3object in inventory.iter_inventory_objects(manifest):
+        key = s3object['Key']
+        if is_supported_metadata_file(key):
+            if (metadata_prefix == "" and key.startswith(media_prefix)) or (metadata_prefix and key.startswith(metadata_prefix)):
+                s3metadataobjects[get_metadata_ref_file_key(key, media_prefix, metadata_prefix)] = s3object
+        elif is_supported_transcribeopts_file(key):
+            if (transcribeopts_prefix == "" and key.startswith(media_prefix)) or (transcribeopts_prefix and key.startswith(transcribeopts_prefix)):
+                s3transcribeoptsobjects[get_transcribeopts_ref_file_key(key, media_prefix, transcribeopts_prefix)] = s3object
+    logger.info(f"Found {len(s3metadataobjects)} metadata files and {len(s3transcribeoptsobjects)} options files in inventory report")
+    position = 0
+    for s3object in inventory.iter_inventory_objects(manifest, media_prefix):
+        if not is_supported_media_file(s3object['Key']):
+            continue
+        if position >= start_position:
+            media_key = s3object['Key']
+            yield [f"s3://{bucketname}/{media_key}", s3object, s3metadataobjects.get(media_key), s3transcribeoptsobjects.get(media_key)]
+        position += 1
+
+def get_current_s3_objects(bucketname, s3objectlist, status_items=None):
+    # Inventory reports can be up to a day old. Media files that look new or changed are read from S3
+    # before they are processed, so files modified or deleted after the report was produced are not 
+    # transcribed using stale details. Returns None if the media file no longer exists.
+    [s3url, s3object, s3metadataobject, s3transcribeoptsobject] = s3objectlist
+    item = status_items.get(s3url) if status_items is not None else get_file_status(s3url)
+    def lastModified(s3object):
+        return s3object['LastModified'].strftime("%m:%d:%Y:%H:%M:%S") if s3object else None
+    if (item and item.get("status") != "DELETED" and lastModified(s3object) == item.get('lastModified')
+            and lastModified(s3metadataobject) == item.get('metadata_lastModified')
+            and lastModified(s3transcribeoptsobject) == item.get('transcribeopts_lastModified')):
+        return s3objectlist
+    media_key = s3object['Key']
+    s3object = head_s3_object(bucketname, media_key)
+    if s3object == None:
+        return None
+    s3metadataobject = head_s3_object(bucketname, get_metadata_file_key(media_key, METADATA_FOLDER_PREFIX))
+    s3transcribeoptsobject = head_s3_object(bucketname, get_transcribeopts_file_key(media_key, TRANSCRIBEOPTS_FOLDER_PREFIX))
+    return [s3url, s3object, s3metadataobject, s3transcribeoptsobject]
+
+def get_existing_files(s3urls):
+    # Returns the s3urls of the files that exist in S3 - used to confirm deletions detected from an inventory 
+    # report, since files created after the report was produced are not listed in it
+    existing = []
+    def exists(s3url):
+        bucket, key, file_name = parse_s3url(s3url)
+        return head_s3_object(bucket, key) != None
+    for s3url, result, exception in map_concurrently(exists, s3urls, CRAWLER_CONCURRENCY):
+        # keep files that could not be checked - they are checked again by the next crawl
+        if result or exception:
+            existing.append(s3url)
+    return existing
 
 def exit_status(event, context, status):
     logger.info(f"exit_status({status})")
+    log_cache_stats()
     if ('ResourceType' in event):
         if (event['ResourceType'].find('CustomResource') > 0):
             logger.info("cfnresponse:" + status)
             cfnresponse.send(event, context, status, {}, None)
     return status       
     
+def time_is_running_out(context):
+    # True when the remaining invocation time is too short to keep processing files
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < CRAWLER_CHECKPOINT_SECS * 1000
+
+def continue_crawl(context):
+    logger.info(f"Invoking {context.function_name} asynchronously to continue crawl from checkpoint")
+    LAMBDA.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=bytes(json.dumps({'crawler_resume': True}), "utf8")
+        )
+    return True
+
+def list_s3_media_urls(bucketname, media_prefix, manifest=None):
+    # list urls of all supported media files, used to detect deletions when a crawl spans several invocations
+    logger.info(f"list_s3_media_urls(bucketname={bucketname}, media_prefix={media_prefix})")
+    s3urls=[]
+    if manifest:
+        s3objects = inventory.iter_inventory_objects(manifest, media_prefix)
+    else:
+        s3objects = iter_s3_listing(bucketname, media_prefix)
+    for s3object in s3objects:
+        if is_supported_media_file(s3object['Key']):
+            s3urls.append(f"s3://{bucketname}/{s3object['Key']}")
+    return s3urls
+    
 def lambda_handler(event, context):
     logger.info("Received event: %s" % json.dumps(event))
     
@@ -289,32 +553,80 @@ def lambda_handler(event, context):
         logger.info("Cfn Delete event - no action - return Success")
         return exit_status(event, context, cfnresponse.SUCCESS)
     
-    # exit if crawler is already running
-    crawler_state = get_crawler_state(STACK_NAME)
-    if (crawler_state):
-        logger.info(f"crawler sync state: {crawler_state}")
-        if (crawler_state == "RUNNING"):
-            logger.info("Previous crawler invocation is running. Exiting")
+    checkpoint = None
+    if event.get('crawler_resume'):
+        # invoked by a previous crawler invocation to continue from the saved checkpoint
+        checkpoint = get_crawler_checkpoint(STACK_NAME)
+        if checkpoint == None:
+            logger.info("No crawl checkpoint to resume from. Exiting")
             return exit_status(event, context, cfnresponse.SUCCESS)
-            
-    #Make _category facetable if needed
-    if (MAKE_CATEGORY_FACETABLE == 'true'):
-        logger.info("Make _catetory facetable")
-        make_category_facetable(indexId=INDEX_ID)
-    #Add YT attributes if INDEX_YOUTUBE_VIDEOS = true
-    if (INDEX_YOUTUBE_VIDEOS == 'true'):
-        logger.info("Create YT facets in  Kendra Index")
-        create_newfacets_youtube(indexId=INDEX_ID)
-    # Start crawler, and set status in DynamoDB table
-    logger.info("** Start crawler **")
-    kendra_sync_job_id = start_kendra_sync_job(dsId=DS_ID, indexId=INDEX_ID)
-    if (kendra_sync_job_id == None):
-        logger.info("Previous sync job still running. Exiting")
-        return exit_status(event, context, cfnresponse.SUCCESS)
-    put_crawler_state(STACK_NAME,'RUNNING')  
+        logger.info("Resuming crawl from checkpoint")
+    else:
+        # exit if crawler is already running, unless it stopped updating its checkpoint (e.g. it timed out)
+        crawler_state = get_crawler_state(STACK_NAME)
+        if (crawler_state):
+            logger.info(f"crawler sync state: {crawler_state}")
+            if (crawler_state == "RUNNING"):
+                checkpoint = get_crawler_checkpoint(STACK_NAME)
+                if checkpoint and int(time.time()) - int(checkpoint['heartbeat']) < CRAWLER_STALE_SECS:
+                    logger.info("Previous crawler invocation is running. Exiting")
+                    return exit_status(event, context, cfnresponse.SUCCESS)
+                if checkpoint:
+                    logger.info("Previous crawler invocation stopped without completing. Resuming crawl from checkpoint")
+                else:
+                    logger.info("Previous crawler invocation stopped without a checkpoint. Starting new crawl")
+    
+    if checkpoint == None:
+        # Make _category facetable, and add YT attributes if INDEX_YOUTUBE_VIDEOS = true - only if the index doesn't have them yet
+        reconcile_index_schema(STACK_NAME, INDEX_ID, get_index_schema(MAKE_CATEGORY_FACETABLE == 'true', INDEX_YOUTUBE_VIDEOS == 'true'))
+        # Start crawler, and set status in DynamoDB table
+        logger.info("** Start crawler **")
+        correct_sync_running_count()
+        kendra_sync_job_id = start_kendra_sync_job(dsId=DS_ID, indexId=INDEX_ID)
+        if (kendra_sync_job_id == None):
+            logger.info("Previous sync job still running. Exiting")
+            return exit_status(event, context, cfnresponse.SUCCESS)
+        checkpoint = {
+            'sync_job_id': kendra_sync_job_id,
+            'bucket_index': 0,
+            'start_after': None,
+            'inventory_manifest': None,
+            'inventory_position': 0,
+            'invocations': 0,
+            'results': {}
+            }
+    elif not is_kendra_sync_running(dsId=DS_ID, indexId=INDEX_ID):
+        # the sync job used by the crawl so far has been stopped - start a new one
+        logger.info("Data source sync job for resumed crawl is no longer running - start a new one")
+        correct_sync_running_count()
+        checkpoint['sync_job_id'] = start_kendra_sync_job(dsId=DS_ID, indexId=INDEX_ID)
+        if (checkpoint['sync_job_id'] == None):
+            logger.info("Previous sync job still running. Exiting")
+            return exit_status(event, context, cfnresponse.SUCCESS)
+    kendra_sync_job_id = checkpoint['sync_job_id']
+    if checkpoint.get('crawl_generation') is None:
+        # new crawl, or a crawl checkpointed by an earlier version of the crawler
+        [generation, swept] = start_crawl_generation(STACK_NAME)
+        checkpoint['crawl_generation'] = generation
+        # deletions can only be detected from generations if every indexed file has been stamped by a completed crawl
+        checkpoint['sweep'] = swept and int(checkpoint['invocations']) == 0
+    crawl_generation = int(checkpoint['crawl_generation'])
+    checkpoint['invocations'] = int(checkpoint['invocations']) + 1
+    put_crawler_checkpoint(STACK_NAME, checkpoint)
         
     # process S3 media objects
     s3files=[]
+    correct_slots = MAX_TRANSCRIBE_JOBS_IN_FLIGHT > 0 and checkpoint['invocations'] == 1
+    if correct_slots:
+        # read before the status is loaded - the correction below is skipped if a slot is claimed or released meanwhile
+        jobs_in_flight = get_transcription_slots()
+    status_items = None
+    if (PRELOAD_FILE_STATUS == 'true'):
+        logger.info("** Load media file status **")
+        status_items = get_all_file_status()
+    if correct_slots:
+        # correct any drift in the jobs in flight count at the start of each crawl
+        reset_transcription_slots(count_running_transcriptions(status_items), jobs_in_flight)
 
      
     if (MEDIA_BUCKET):
@@ -322,25 +634,123 @@ def lambda_handler(event, context):
     else:
         BUCKET_LIST=[YTMEDIA_BUCKET]
     
-    for bucket in BUCKET_LIST: 
-        try:
+    results = collections.Counter({k: int(v) for k, v in checkpoint['results'].items()})
+    failed_files = []
+    write_counts = StatusWriteCounts()
+    for bucket_index, bucket in enumerate(BUCKET_LIST): 
+        if bucket_index < int(checkpoint['bucket_index']):
+            # bucket already crawled by a previous invocation
+            continue
+        start_after = checkpoint['start_after'] if bucket_index == int(checkpoint['bucket_index']) else None
+        start_position = int(checkpoint.get('inventory_position') or 0) if bucket_index == int(checkpoint['bucket_index']) else 0
+        if bucket_index == int(checkpoint['bucket_index']) and checkpoint.get('inventory_manifest'):
+            # resumed crawl continues with the same inventory report
+            manifest = inventory.read_manifest(checkpoint['inventory_manifest'])
+        else:
+            manifest = get_inventory_manifest(bucket)
+        checkpoint['inventory_manifest'] = manifest['location'] if manifest else None
+        if manifest:
+            logger.info("** Read inventory report and process S3 media objects **")
+            s3objects = iter_inventory_objects(manifest, MEDIA_FOLDER_PREFIX, METADATA_FOLDER_PREFIX, TRANSCRIBEOPTS_FOLDER_PREFIX, start_position)
+        else:
             logger.info("** List and process S3 media objects **")
-            
-            [s3mediaobjects, s3metadataobjects, s3transcribeoptsobjects] = list_s3_objects(bucket, MEDIA_FOLDER_PREFIX, METADATA_FOLDER_PREFIX, TRANSCRIBEOPTS_FOLDER_PREFIX)
-            for s3url in s3mediaobjects.keys():
-                process_s3_media_object(STACK_NAME, bucket, s3url, s3mediaobjects.get(s3url), s3metadataobjects.get(s3url), s3transcribeoptsobjects.get(s3url), kendra_sync_job_id, TRANSCRIBE_ROLE)
-                s3files.append(s3url)
+            s3objects = iter_s3_objects(bucket, MEDIA_FOLDER_PREFIX, METADATA_FOLDER_PREFIX, TRANSCRIBEOPTS_FOLDER_PREFIX, start_after)
+        def process(s3objectlist):
+            if manifest:
+                s3objectlist = get_current_s3_objects(bucket, s3objectlist, status_items)
+                if s3objectlist == None:
+                    return "NOT_FOUND"
+            [s3url, s3object, s3metadataobject, s3transcribeoptsobject] = s3objectlist
+            return process_s3_media_object(STACK_NAME, bucket, s3url, s3object, s3metadataobject, s3transcribeoptsobject, kendra_sync_job_id, TRANSCRIBE_ROLE, status_items, write_counts, crawl_generation)
+        # the listing is consumed as it is processed. Files are processed concurrently, but results are
+        # returned in listing order, so the key of the last result is a safe position to resume from
+        stopped_early = []
+        def should_stop():
+            if time_is_running_out(context):
+                stopped_early.append(True)
+                return True
+            return False
+        processed = 0
+        try:
+            for s3objectlist, result, exception in map_concurrently(process, s3objects, CRAWLER_CONCURRENCY, should_stop=should_stop):
+                s3url = s3objectlist[0]
+                # a file that failed to process still exists in S3, so it must not be treated as deleted
+                if result != "NOT_FOUND" and not checkpoint['sweep']:
+                    s3files.append(s3url)
+                processed += 1
+                if manifest:
+                    checkpoint['inventory_position'] = start_position + processed
+                else:
+                    checkpoint['start_after'] = s3objectlist[1]['Key']
+                if exception:
+                    logger.error(f"Exception processing {s3url}: " + str(exception))
+                    failed_files.append(s3url)
+                    result = "FAILED"
+                    stamp_crawl_generation(s3url, crawl_generation)
+                results[result] += 1
+                if is_priority_scheduling() and processed % PRIORITY_DRAIN_INTERVAL == 0:
+                    # files found so far are queued - start them in priority order, without waiting for the crawl to finish
+                    drain_transcription_backlog(STACK_NAME, TRANSCRIBE_ROLE, max_jobs=MAX_TRANSCRIBE_JOBS_IN_FLIGHT)
         except Exception as e:
             logger.error("Exception: " + str(e))
             put_crawler_state(STACK_NAME, 'STOPPED')            
             stop_kendra_sync_job_when_all_done(dsId=DS_ID, indexId=INDEX_ID)
             return exit_status(event, context, cfnresponse.FAILED)
+        checkpoint['results'] = dict(results)
+        if stopped_early:
+            # save position and continue in a new invocation
+            logger.info(f"Time limit approaching after {processed} files in {bucket}. Checkpoint crawl.")
+            drain_transcription_backlog(STACK_NAME, TRANSCRIBE_ROLE, max_jobs=MAX_TRANSCRIBE_JOBS_IN_FLIGHT)
+            put_crawler_checkpoint(STACK_NAME, checkpoint)
+            continue_crawl(context)
+            return exit_status(event, context, cfnresponse.SUCCESS)
+        checkpoint['bucket_index'] = bucket_index + 1
+        checkpoint['start_after'] = None
+        checkpoint['inventory_manifest'] = None
+        checkpoint['inventory_position'] = 0
+        put_crawler_checkpoint(STACK_NAME, checkpoint)
+    logger.info(f"Processed {sum(results.values())} media files in {checkpoint['invocations']} invocation(s): {dict(results)}")
+    logger.info(f"Status writes for unchanged files in this invocation: {dict(write_counts.counts)}")
+    if failed_files:
+        logger.error(f"Failed to process {len(failed_files)} media files, first few: {failed_files[0:10]}")
 
     # detect and delete indexed docs where files that are no longer in the source bucket location
     # reasons: file deleted, or indexer config updated to crawl a new location
     logger.info("** Process deletions **")
-    process_deletions(DS_ID, INDEX_ID, kendra_sync_job_id=kendra_sync_job_id, s3files=s3files)
+    if checkpoint['sweep']:
+        # indexed files not stamped with this crawl's generation were not found
+        stale_files = get_stale_files(crawl_generation)
+        if CRAWL_SOURCE == 'INVENTORY':
+            # files created after the inventory report was produced are not in the report - keep those that exist
+            existing_files = get_existing_files(stale_files)
+            for s3url in existing_files:
+                stamp_crawl_generation(s3url, crawl_generation)
+            stale_files = list(set(stale_files) - set(existing_files))
+        delete_stale_files(DS_ID, INDEX_ID, kendra_sync_job_id, crawl_generation, stale_files)
+    else:
+        # first crawl with crawl generations - compare the indexed files with the files found
+        if checkpoint['invocations'] > 1:
+            # files processed by earlier invocations are not in s3files - list all media files again
+            s3files = []
+            for bucket in BUCKET_LIST:
+                s3files += list_s3_media_urls(bucket, MEDIA_FOLDER_PREFIX, get_inventory_manifest(bucket))
+        indexed_files = get_indexed_files(status_items) if status_items is not None else None
+        if CRAWL_SOURCE == 'INVENTORY':
+            # files created after the inventory report was produced are not in s3files - keep those that exist
+            if indexed_files is None:
+                indexed_files = get_all_indexed_files()
+            existing_files = get_existing_files(list(set(indexed_files) - set(s3files)))
+            for s3url in existing_files:
+                stamp_crawl_generation(s3url, crawl_generation)
+            s3files += existing_files
+        process_deletions(DS_ID, INDEX_ID, kendra_sync_job_id=kendra_sync_job_id, s3files=s3files, indexed_files=indexed_files)
+    # every indexed file has been stamped by this crawl, so the next crawl can detect deletions from generations
+    put_swept_generation(STACK_NAME, crawl_generation)
     
+    # Start queued transcription jobs if there are free slots (e.g. after the jobs in flight count was corrected,
+    # or files queued by the priority policy)
+    drain_transcription_backlog(STACK_NAME, TRANSCRIBE_ROLE, max_jobs=MAX_TRANSCRIBE_JOBS_IN_FLIGHT)
+
     # Stop crawler
     logger.info("** Stop crawler **")
     put_crawler_state(STACK_NAME, 'STOPPED')
@@ -0,0 +1,180 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Reads S3 Inventory reports, so very large buckets can be crawled without paging through list_objects_v2.
+# Report data files are streamed and decompressed chunk by chunk, and objects are returned in the same form
+# as list_objects_v2 'Contents' entries. Manifests and data files can be in S3, or on the local file system
+# for testing. See https://docs.aws.amazon.com/AmazonS3/latest/userguide/storage-inventory.html
+# This module has no dependency on the other indexer modules, so it can be run locally, e.g.
+#   python inventory.py ./2024-01-01T01-00Z/manifest.json [prefix]
+
+import os
+import io
+import csv
+import gzip
+import json
+import urllib
+import datetime
+import tempfile
+import boto3
+
+import logging
+logger = logging.getLogger()
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    # only needed for Parquet reports (e.g. provided by a Lambda layer) - CSV reports need no extra packages
+    pyarrow = None
+
+S3 = boto3.client('s3')
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+# Parquet report column names, mapped to the CSV report field names
+PARQUET_FIELDS = {
+    'bucket': 'Bucket',
+    'key': 'Key',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker'
+}
+
+def split_s3url(s3url):
+    r = urllib.parse.urlparse(s3url, allow_fragments=False)
+    return [r.netloc, r.path.lstrip("/")]
+
+def find_latest_manifests(location):
+    # Returns the location of the latest manifest of each inventory configuration under location.
+    # location is a manifest file, or a folder (s3://bucket/prefix/ or a local directory) containing
+    # inventory reports in the S3 Inventory destination layout: <source-bucket>/<config-id>/<YYYY-MM-DDTHH-MMZ>/manifest.json
+    if location.endswith(MANIFEST_FILE_NAME):
+        return [location]
+    manifests = []
+    if location.startswith("s3://"):
+        bucket, prefix = split_s3url(location)
+        paginator = S3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for s3object in page.get("Contents", []):
+                if s3object['Key'].endswith("/" + MANIFEST_FILE_NAME):
+                    manifests.append(f"s3://{bucket}/{s3object['Key']}")
+    else:
+        for dirpath, dirnames, filenames in os.walk(location):
+            if MANIFEST_FILE_NAME in filenames:
+                manifests.append(os.path.join(dirpath, MANIFEST_FILE_NAME))
+    # report folders are named by date, so the last one in key order is the latest
+    latest = {}
+    for manifest in sorted(manifests):
+        config_folder = manifest.rsplit("/", 2)[0] if manifest.startswith("s3://") else os.path.dirname(os.path.dirname(manifest))
+        latest[config_folder] = manifest
+    return list(latest.values())
+
+def read_manifest(manifest_location):
+    logger.info(f"read_manifest({manifest_location})")
+    if manifest_location.startswith("s3://"):
+        bucket, key = split_s3url(manifest_location)
+        manifest = json.loads(S3.get_object(Bucket=bucket, Key=key)["Body"].read().decode())
+    else:
+        with open(manifest_location) as f:
+            manifest = json.load(f)
+    manifest['location'] = manifest_location
+    return manifest
+
+def get_latest_manifest(location, bucket):
+    # Returns the latest inventory manifest for source bucket under location, or None if there is none
+    for manifest_location in find_latest_manifests(location):
+        manifest = read_manifest(manifest_location)
+        if manifest.get('sourceBucket') == bucket:
+            logger.info(f"Latest inventory report for bucket {bucket}: {manifest_location}")
+            return manifest
+    return None
+
+def get_local_data_file(manifest_location, data_key):
+    # Local copies of reports keep the data files either in the sibling 'data' folder of the report
+    # folder (as in the S3 destination layout), or in the same folder as the manifest
+    manifest_folder = os.path.dirname(manifest_location)
+    file_name = data_key.split("/")[-1]
+    for path in [os.path.join(manifest_folder, "..", "data", file_name), os.path.join(manifest_folder, file_name)]:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"Inventory data file {file_name} not found for manifest {manifest_location}")
+
+def open_data_file(manifest, data_key):
+    # Returns a binary file object for a report data file - S3 objects are streamed, not downloaded
+    if manifest['location'].startswith("s3://"):
+        bucket = manifest['destinationBucket'].split(":::")[-1]
+        return S3.get_object(Bucket=bucket, Key=data_key)["Body"]
+    return open(get_local_data_file(manifest['location'], data_key), "rb")
+
+def iter_csv_rows(manifest, data_key):
+    fields = [field.strip() for field in manifest['fileSchema'].split(",")]
+    with open_data_file(manifest, data_key) as f:
+        with io.TextIOWrapper(gzip.GzipFile(fileobj=f), encoding="utf-8", newline="") as text:
+            for row in csv.reader(text):
+                row = dict(zip(fields, row))
+                # keys are URL encoded in CSV reports
+                row['Key'] = urllib.parse.unquote_plus(row['Key'])
+                yield row
+
+def iter_parquet_rows(manifest, data_key):
+    if pyarrow is None:
+        raise ValueError("Parquet inventory reports require the pyarrow package")
+    if manifest['location'].startswith("s3://"):
+        # Parquet readers need random access, so the data file is downloaded to a temporary file
+        bucket = manifest['destinationBucket'].split(":::")[-1]
+        with tempfile.NamedTemporaryFile(suffix=".parquet") as f:
+            S3.download_fileobj(bucket, data_key, f)
+            f.flush()
+            yield from iter_parquet_file_rows(f.name)
+    else:
+        yield from iter_parquet_file_rows(get_local_data_file(manifest['location'], data_key))
+
+def iter_parquet_file_rows(path):
+    parquet_file = pyarrow.parquet.ParquetFile(path)
+    columns = [column for column in parquet_file.schema_arrow.names if column in PARQUET_FIELDS]
+    for batch in parquet_file.iter_batches(columns=columns):
+        for row in batch.to_pylist():
+            yield {PARQUET_FIELDS[column]: value for column, value in row.items()}
+
+def get_last_modified(value):
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=datetime.timezone.utc)
+
+def iter_inventory_objects(manifest, prefix=""):
+    # Yields the current objects listed in the report with keys starting with prefix, in report order
+    # (data file by data file), in the same form as list_objects_v2 'Contents' entries
+    file_format = manifest.get('fileFormat', 'CSV').upper()
+    if file_format == 'CSV':
+        iter_rows = iter_csv_rows
+    elif file_format == 'PARQUET':
+        iter_rows = iter_parquet_rows
+    else:
+        raise ValueError(f"Inventory report format {manifest.get('fileFormat')} is not supported - use CSV or Parquet")
+    for data_file in manifest['files']:
+        logger.info(f"Read inventory data file: {data_file['key']}")
+        for row in iter_rows(manifest, data_file['key']):
+            if not row['Key'].startswith(prefix):
+                continue
+            # skip noncurrent versions and delete markers in reports that include all object versions
+            if str(row.get('IsLatest', 'true')).lower() != 'true' or str(row.get('IsDeleteMarker', 'false')).lower() == 'true':
+                continue
+            if row.get('LastModifiedDate') in [None, ""]:
+                raise ValueError("Inventory report must include the Size and LastModifiedDate fields")
+            s3object = {
+                'Key': row['Key'],
+                'LastModified': get_last_modified(row['LastModifiedDate']),
+                'Size': int(row['Size']) if row.get('Size') not in [None, ""] else 0
+            }
+            if row.get('ETag'):
+                s3object['ETag'] = row['ETag']
+            yield s3object
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    manifest = read_manifest(sys.argv[1])
+    for s3object in iter_inventory_objects(manifest, sys.argv[2] if len(sys.argv) > 2 else ""):
+        print(f"s3://{manifest['sourceBucket']}/{s3object['Key']}\t{s3object['Size']}\t{s3object['LastModified'].isoformat()}")
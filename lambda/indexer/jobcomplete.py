@@ -3,82 +3,86 @@
 
 import os
 import json
-import textwrap
+import time
+import hashlib
 import urllib
-import dateutil.parser
+import contextlib
+import gzip
 
 from common import logger
 from common import INDEX_ID, DS_ID
-from common import S3, TRANSCRIBE, KENDRA
+from common import S3, KENDRA
 from common import stop_kendra_sync_job_when_all_done
-from common import get_file_status, put_file_status
-from common import get_transcription_job
+from common import get_file_status, update_file_status
+from common import get_transcription_job, get_transcript_s3url, parse_transcript_uri
+from common import TRANSCRIPT_BUCKET
 from common import parse_s3url, get_s3jsondata
+from common import STACK_NAME
+from transcription import TRANSCRIBE_ROLE, MAX_TRANSCRIBE_JOBS_IN_FLIGHT
+from transcription import release_transcription_slot, drain_transcription_backlog
+from common import map_concurrently, batches
+from transcript import prepare_transcript_text, prepare_transcript_segments, TRANSCRIPT_LINE_WIDTH
+from common import KENDRA_RETRYABLE_ERRORS, get_backoff_secs, delete_kendra_doc_batch
+from common import get_segment_document_id
+from botocore.exceptions import ClientError
+from cache import Cache, log_cache_stats
+from metadata import AttributeConverter
+from common import get_index_metadata_configurations
+
+# Number of transcription job events in a batch that are processed in parallel
+JOBCOMPLETE_CONCURRENCY = int(os.environ.get('JOBCOMPLETE_CONCURRENCY', '5'))
+# Kendra BatchPutDocument limits - documents per call, and total size of the documents in a call
+KENDRA_BATCH_MAX_DOCS = int(os.environ.get('KENDRA_BATCH_MAX_DOCS', '10'))
+KENDRA_BATCH_MAX_BYTES = int(os.environ.get('KENDRA_BATCH_MAX_BYTES', str(5 * 1024 * 1024)))
+# Number of times a throttled or failed BatchPutDocument call is retried, with exponential backoff
+KENDRA_PUT_MAX_RETRIES = int(os.environ.get('KENDRA_PUT_MAX_RETRIES', '6'))
+# Length in seconds of the time windows a transcript is split into, each indexed as its own Kendra document
+# (0 - index each media file as a single document)
+TRANSCRIPT_SEGMENT_SECS = int(os.environ.get('TRANSCRIPT_SEGMENT_SECS', '0'))
+# Prepared transcript text is kept in the transcript bucket, gzip compressed, as <PREPARED_TEXT_PREFIX><job name>.json.gz,
+# so a file is indexed again (e.g. with new metadata) without downloading and parsing its transcript (empty - not kept)
+PREPARED_TEXT_PREFIX = os.environ.get('PREPARED_TEXT_PREFIX', 'prepared/')
+
+BUCKET_REGION_CACHE = Cache("bucket_region", max_entries=1000, ttl_secs=24 * 3600)
+# [index configurations, AttributeConverter] - see get_attribute_converter()
+ATTRIBUTE_CONVERTER = None
 
 def get_bucket_region(bucket):
     # get bucket location.. buckets in us-east-1 return None, otherwise region is identified in LocationConstraint
+    # (cached, since the region of a bucket does not change)
+    def get_bucket_location():
+        return S3.get_bucket_location(Bucket=bucket)["LocationConstraint"] or 'us-east-1'
     try:
-        region = S3.get_bucket_location(Bucket=bucket)["LocationConstraint"] or 'us-east-1' 
+        region = BUCKET_REGION_CACHE.get(bucket, get_bucket_location)
     except Exception as e:
         logger.info(f"Unable to retrieve bucket region (bucket owned by another account?).. defaulting to us-east-1. Bucket: {bucket} - Message: " + str(e))
         region = 'us-east-1'
     return region
     
 
-def iso8601_datetime(value):
+def get_attribute_converter():
+    # Converter for the field types of the index - rebuilt only when the cached index configuration is refreshed
+    global ATTRIBUTE_CONVERTER
     try:
-        dt = dateutil.parser.isoparse(value)
+        configurations = get_index_metadata_configurations(INDEX_ID)
     except Exception as e:
-        return False
-    return dt
+        logger.error("Unable to read index field types - metadata attribute types are inferred: " + str(e))
+        configurations = []
+    if ATTRIBUTE_CONVERTER is None or ATTRIBUTE_CONVERTER[0] is not configurations:
+        ATTRIBUTE_CONVERTER = [configurations, AttributeConverter.from_index_configurations(configurations)]
+    return ATTRIBUTE_CONVERTER[1]
 
-def get_kendra_type_and_value(key, value):
-    kendra_type = ""
-    kendra_value = value
-    if type(value) is int:
-        kendra_type = "LongValue"
-    elif type(value) is list:
-        kendra_type = "StringListValue"
-        kendra_value = list(map(lambda x: str(x), value))
-    elif type(value) is str:
-        kendra_type = "StringValue"
-        if iso8601_datetime(value):
-            kendra_type = "DateValue"
-            kendra_value = iso8601_datetime(value)
-    else:
-        logger.error(f"Metadata attribute {key} has invalid type {type(value)} - convert to string")
-        kendra_type = "StringValue"
-        kendra_value = str(value)
-    return [kendra_type, kendra_value]
-    
 def get_metadata_attributes(metadata):
-    kendra_metadata_attributes=[]
     meta_attributes = metadata.get("Attributes")
-    if meta_attributes:
-        if type(meta_attributes) is dict:
-            for key, value in meta_attributes.items():
-                # if ytsource exists then it must accept _source_uri from metadata
-                if 'ytsource' in meta_attributes:
-                    reserved_attributes = ["_data_source_id", "_data_source_sync_job_execution_id"]
-                else:
-                    reserved_attributes = ["_data_source_id", "_data_source_sync_job_execution_id", "_source_uri"]
-                logger.info("reserved_attributes")
-                logger.info(reserved_attributes)
-                if key not in reserved_attributes:
-                    kendra_type, kendra_value = get_kendra_type_and_value(key, value)
-                    kendra_attr = {
-                        'Key': key,
-                        'Value': {
-                            kendra_type: kendra_value
-                        }
-                    }
-                    kendra_metadata_attributes.append(kendra_attr)
-                else:
-                    logger.error(f"Metadata may not override reserved attribute: {key}")
-        else:
-            logger.error(f"Metadata 'Attributes' is not dict type: {type(meta_attributes)}")
-    else:
+    if not meta_attributes:
         logger.info(f"Metadata does not contain 'Attributes'")
+        return []
+    if type(meta_attributes) is not dict:
+        logger.error(f"Metadata 'Attributes' is not dict type: {type(meta_attributes)}")
+        return []
+    kendra_metadata_attributes, conflicts = get_attribute_converter().get_attributes(meta_attributes)
+    if conflicts:
+        logger.error(f"Metadata attribute conflicts ({len(conflicts)}): " + "; ".join(conflicts))
     return kendra_metadata_attributes
     
 def get_document(dsId, indexId, s3url, item, text):
@@ -110,7 +114,7 @@ def get_document(dsId, indexId, s3url, item, text):
         "Blob": text
     }
     # merge metadata
-    metadata = get_s3jsondata(item['metadata_url'])
+    metadata = get_s3jsondata(item['metadata_url'], version=item.get('metadata_lastModified'))
     if metadata.get("DocumentId"):
         logger.error(f"Metadata may not override: DocumentId")
     if metadata.get("ContentType"):
@@ -136,44 +140,203 @@ def get_document(dsId, indexId, s3url, item, text):
         document["AccessControlList"] = metadata['AccessControlList']
     return document
     
-def put_document(dsId, indexId, s3url, item, text):
-    logger.info(f"put_document(dsId={dsId}, indexId={indexId}, s3url={s3url}, text='{text[0:100]}...')")
-    document = get_document(dsId, indexId, s3url, item, text)
-    documents = [document]
-    logger.info("KENDRA.batch_put_document: " + json.dumps(documents, default=str)[0:1000] + "...")
-    result = KENDRA.batch_put_document(
-        IndexId = indexId,
-        Documents = documents
-    )
-    if 'FailedDocuments' in result and len(result['FailedDocuments']) > 0:
-        logger.error("Failed to index document: " + result['FailedDocuments'][0]['ErrorMessage'])
-    logger.info("result: " + json.dumps(result))
-    return True
+def format_offset(secs):
+    return f"{secs // 3600}:{secs % 3600 // 60:02d}:{secs % 60:02d}"
+
+def get_segment_documents(dsId, indexId, s3url, item, segments):
+    # One document per transcript segment (see prepare_transcript_segments), keyed by window number. Each segment
+    # has its own id, and the title, attributes and access control list of the media file, with the start of
+    # its time window added to the title.
+    document = get_document(dsId, indexId, s3url, item, "")
+    documents = {}
+    for window, text in sorted(segments.items()):
+        segment = dict(document)
+        segment['Id'] = get_segment_document_id(s3url, window)
+        segment['Title'] = f"{document['Title']} ({format_offset(window * TRANSCRIPT_SEGMENT_SECS)})"
+        segment['Blob'] = text
+        documents[str(window)] = segment
+    return documents
+
+def get_segment_hash(document):
+    # Hash of the content of a segment document, to find the segments that changed since the file was last indexed.
+    # The sync job id attribute changes every time, so it is left out.
+    content = dict(document)
+    content['Attributes'] = [attr for attr in document['Attributes'] if attr['Key'] != '_data_source_sync_job_execution_id']
+    return hashlib.md5(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def get_document_size(document):
+    # approximate size of the document in a BatchPutDocument request
+    return len(json.dumps(document, default=str).encode("utf-8"))
+
+def get_document_batches(documents):
+    # Groups documents into batches of at most KENDRA_BATCH_MAX_DOCS documents and KENDRA_BATCH_MAX_BYTES
+    # (a document larger than KENDRA_BATCH_MAX_BYTES is sent on its own)
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        size = get_document_size(document)
+        if batch and (len(batch) >= KENDRA_BATCH_MAX_DOCS or batch_bytes + size > KENDRA_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def put_document_batch(indexId, documents):
+    # Indexes a batch of documents. Throttled calls, and documents that failed with an internal error, are retried
+    # with backoff. Returns a dict mapping the id of each document that could not be indexed to the reason.
+    pending = list(documents)
+    failures = {}
+    for attempt in range(KENDRA_PUT_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(get_backoff_secs(attempt))
+        logger.info(f"KENDRA.batch_put_document - {len(pending)} documents: {[document['Id'] for document in pending]}")
+        try:
+            result = KENDRA.batch_put_document(
+                IndexId = indexId,
+                Documents = pending
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in KENDRA_RETRYABLE_ERRORS and attempt < KENDRA_PUT_MAX_RETRIES:
+                logger.info(f"KENDRA.batch_put_document - retry after {e.response['Error']['Code']}")
+                continue
+            logger.error("Exception in KENDRA.batch_put_document: " + str(e))
+            failures.update({document['Id']: str(e) for document in pending})
+            return failures
+        logger.info("result: " + json.dumps(result))
+        retry_ids = []
+        for failedDocument in result.get('FailedDocuments', []):
+            if failedDocument.get('ErrorCode') == 'InternalError' and attempt < KENDRA_PUT_MAX_RETRIES:
+                retry_ids.append(failedDocument['Id'])
+            else:
+                failures[failedDocument['Id']] = f"{failedDocument.get('ErrorCode')}: {failedDocument.get('ErrorMessage')}"
+        pending = [document for document in pending if document['Id'] in retry_ids]
+        if not pending:
+            break
+    return failures
+
+def delete_documents(dsId, indexId, kendra_sync_job_id, document_ids):
+    # Deletes documents that are no longer part of a media file, e.g. segments of a transcript that got shorter.
+    # Returns a dict mapping the id of each document that could not be deleted to the reason.
+    failures = {}
+    for deletion_batch in batches(document_ids, 10):
+        failures.update(delete_kendra_doc_batch(dsId, indexId, kendra_sync_job_id, deletion_batch)[0])
+    for document_id, reason in failures.items():
+        logger.error(f"Failed to delete document: {document_id} - {reason}")
+    return failures
+
+def put_documents(dsId, indexId, documents):
+    # Indexes documents in as few BatchPutDocument calls as the API limits allow. Returns a dict mapping the id
+    # of each document that could not be indexed to the reason.
+    logger.info(f"put_documents(dsId={dsId}, indexId={indexId}, documents[{len(documents)}])")
+    failures = {}
+    for batch in get_document_batches(documents):
+        failures.update(put_document_batch(indexId, batch))
+    for document_id, reason in failures.items():
+        logger.error(f"Failed to index document: {document_id} - {reason}")
+    return failures
+
+def open_transcript(transcript_uri):
+    # Returns a stream of the transcript - read with the shared S3 client (and its pool of open connections) from
+    # an s3:// url, or downloaded from the presigned url of a transcript kept by Transcribe
+    if transcript_uri.startswith("s3://"):
+        bucket, key, file_name = parse_s3url(transcript_uri)
+        return contextlib.closing(S3.get_object(Bucket=bucket, Key=key)['Body'])
+    return urllib.request.urlopen(transcript_uri)
 
 def prepare_transcript(transcript_uri):
     logger.info(f"prepare_transcript(transcript_uri={transcript_uri[0:100]}...)")
-    duration_secs=0
-    response = urllib.request.urlopen(transcript_uri)
-    transcript = json.loads(response.read())
-    items = transcript["results"]["items"]
-    txt = ""
-    sentence = ""
-    for i in items:
-        if (i["type"] == 'punctuation'):
-            sentence = sentence + i["alternatives"][0]["content"]
-            if (i["alternatives"][0]["content"] == '.'):
-                #sentence completed
-                txt = txt + " " + sentence + " "
-                sentence = ""
-        else: 
-            if (sentence == ''):
-                sentence = "[" + i["start_time"] + "]"
-            sentence = sentence + " " + i["alternatives"][0]["content"]
-            duration_secs = i["end_time"]
-    if (sentence != ""):
-        txt = txt + " " + sentence + " "
-    out = textwrap.fill(txt, width=70)
-    return [duration_secs, out]
+    # the transcript is streamed and parsed incrementally, so long recordings don't need to fit in memory
+    with open_transcript(transcript_uri) as response:
+        return prepare_transcript_text(response)
+
+def prepare_segmented_transcript(transcript_uri):
+    logger.info(f"prepare_segmented_transcript(transcript_uri={transcript_uri[0:100]}..., segment_secs={TRANSCRIPT_SEGMENT_SECS})")
+    with open_transcript(transcript_uri) as response:
+        return prepare_transcript_segments(response, TRANSCRIPT_SEGMENT_SECS)
+
+def get_prepared_text_s3url(job_name):
+    if not (TRANSCRIPT_BUCKET and PREPARED_TEXT_PREFIX):
+        return None
+    return f"s3://{TRANSCRIPT_BUCKET}/{PREPARED_TEXT_PREFIX}{job_name}.json.gz"
+
+def get_prepared_text_settings():
+    # prepared text is only used with the settings it was prepared with
+    return {'line_width': TRANSCRIPT_LINE_WIDTH, 'segment_secs': max(TRANSCRIPT_SEGMENT_SECS, 0)}
+
+def load_prepared_transcript(job_name):
+    # Returns [duration_secs, text] (or [duration_secs, segments] if segments are enabled) kept for a job, or None
+    prepared_s3url = get_prepared_text_s3url(job_name)
+    if not prepared_s3url:
+        return None
+    bucket, key, file_name = parse_s3url(prepared_s3url)
+    try:
+        data = S3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        prepared = json.loads(gzip.decompress(data))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            logger.error(f"Unable to read prepared text {prepared_s3url}: " + str(e))
+        return None
+    except Exception as e:
+        logger.error(f"Prepared text {prepared_s3url} is not valid - ignoring: " + str(e))
+        return None
+    if prepared.get('settings') != get_prepared_text_settings():
+        logger.info(f"Prepared text {prepared_s3url} was prepared with other settings ({prepared.get('settings')}) - ignoring")
+        return None
+    logger.info(f"Using prepared text {prepared_s3url}")
+    if 'segments' in prepared:
+        return [prepared['duration_secs'], {int(window): text for window, text in prepared['segments'].items()}]
+    return [prepared['duration_secs'], prepared['text']]
+
+def save_prepared_transcript(job_name, duration_secs, text_or_segments):
+    # Keeps the prepared text of a job - a failure is logged, since the text can be prepared again
+    prepared_s3url = get_prepared_text_s3url(job_name)
+    if not prepared_s3url:
+        return
+    bucket, key, file_name = parse_s3url(prepared_s3url)
+    prepared = {'settings': get_prepared_text_settings(), 'duration_secs': duration_secs}
+    if TRANSCRIPT_SEGMENT_SECS > 0:
+        prepared['segments'] = {str(window): text for window, text in text_or_segments.items()}
+    else:
+        prepared['text'] = text_or_segments
+    try:
+        S3.put_object(Bucket=bucket, Key=key, Body=gzip.compress(json.dumps(prepared).encode('utf-8')), ContentType='application/gzip')
+    except Exception as e:
+        logger.error(f"Unable to save prepared text {prepared_s3url}: " + str(e))
+
+def get_prepared_transcript(job_name, transcript_uri):
+    # Returns [duration_secs, text or segments], prepared from the transcript, and kept for the next time the file is indexed
+    if TRANSCRIPT_SEGMENT_SECS <= 0:
+        prepared = prepare_transcript(transcript_uri)
+    else:
+        prepared = prepare_segmented_transcript(transcript_uri)
+    save_prepared_transcript(job_name, *prepared)
+    return prepared
+
+def get_indexing_changes(s3url, item, prepared):
+    # Makes the documents of a media file from its prepared transcript, and works out which to send to Kendra, and
+    # which to delete. Returns [duration_secs, documents, deletions, segment_hashes] - segment_hashes is None if
+    # segments are not enabled.
+    previous_hashes = item.get('segment_hashes') or {}
+    if TRANSCRIPT_SEGMENT_SECS <= 0:
+        [duration_secs, text] = prepared
+        documents = [get_document(DS_ID, INDEX_ID, s3url, item, text)]
+        # segments indexed while segments were enabled
+        deletions = [get_segment_document_id(s3url, window) for window in previous_hashes]
+        return [duration_secs, documents, deletions, None]
+    [duration_secs, segments] = prepared
+    segment_documents = get_segment_documents(DS_ID, INDEX_ID, s3url, item, segments)
+    segment_hashes = {window: get_segment_hash(document) for window, document in segment_documents.items()}
+    # only new and changed segments are sent to Kendra
+    documents = [document for window, document in segment_documents.items() if previous_hashes.get(window) != segment_hashes[window]]
+    deletions = [get_segment_document_id(s3url, window) for window in previous_hashes if window not in segment_hashes]
+    if not previous_hashes and item.get('status') != "ACTIVE-NEW":
+        # indexed as a single document before segments were enabled
+        deletions.append(s3url)
+    logger.info(f"{s3url}: {len(segment_documents)} segments, {len(documents)} new or changed, {len(deletions)} to delete")
+    return [duration_secs, documents, deletions, segment_hashes]
 
 def get_transcription_job_duration(transcription_job):
     start_time = transcription_job['TranscriptionJob']['StartTime']
@@ -181,74 +344,207 @@ def get_transcription_job_duration(transcription_job):
     delta = completion_time - start_time
     return delta.seconds
 
-# jobcompete handler - this lambda processes and indexes a single media file transcription
-# invoked by EventBridge trigger as the Amazon Transcribe job for each media file (started by the crawler lambda) completes
-def lambda_handler(event, context):
-    logger.info("Received event: %s" % json.dumps(event))
-    
+def release_job_slot(event):
+    # A job started by the indexer has finished - free its slot. Returns True if a slot was released.
+    job_name = event['detail']['TranscriptionJobName']
+    if MAX_TRANSCRIBE_JOBS_IN_FLIGHT > 0 and event.get('source') == 'aws.transcribe' and job_name.startswith(STACK_NAME + "__"):
+        release_transcription_slot()
+        return True
+    return False
+
+def get_completion_condition(job_name, item):
+    # A file moves from transcribing (sync_state RUNNING) to indexed or failed once, and only for its current job.
+    # The metadata file must also be unchanged, since a crawl that finds new metadata while the transcription is in
+    # progress updates it in place, to be used by this job.
+    return {
+        'transcribe_job_id': job_name,
+        'sync_state': "RUNNING",
+        'metadata_lastModified': item.get('metadata_lastModified')
+    }
+
+def process_job_event(event):
+    """Prepares the transcript of a finished transcription job for indexing, with one read of the file status.
+    Returns [outcome, changes]:
+    INDEX - changes is a dict with the changes to make to the index, and the status to write once they are made
+    FINISHED - the job or its transcript failed, and the file status was updated
+    DUPLICATE - the file status already records the outcome of the job (e.g. a repeated EventBridge delivery)
+    IGNORED - the job is unknown, or no longer the current job of its file"""
     job_name = event['detail']['TranscriptionJobName']
     logger.info(f"Transcription job name: {job_name}")
-    
-    # get results of Amazon Transcribe job
-    logger.info("** Retrieve transcription job **")
-    transcription_job = get_transcription_job(job_name)
-    
-    if transcription_job == None or ('TranscriptionJob' not in transcription_job):
-        logger.error("Unable to retrieve transcription from job.")
-    else:
-        job_status = transcription_job['TranscriptionJob']['TranscriptionJobStatus']
+    # the crawler sets MediaS3Url to index an existing transcription again - with new metadata, or for an identical
+    # copy of the transcribed media file
+    media_s3url = event['detail'].get('MediaS3Url')
+    transcription_job = None
+    if not media_s3url:
+        # get results of Amazon Transcribe job
+        logger.info("** Retrieve transcription job **")
+        transcription_job = get_transcription_job(job_name)
+        if transcription_job == None or ('TranscriptionJob' not in transcription_job):
+            logger.error("Unable to retrieve transcription from job.")
+            return ["IGNORED", None]
         media_s3url = transcription_job['TranscriptionJob']['Media']['MediaFileUri']
-        item = get_file_status(media_s3url)
-        if item == None:
-            logger.info("Transcription job for media file not tracked in Indexer Media File table.. possibly this is a job that is not started by MediaSearch indexer")
-            return
-        if job_status == "FAILED":
+    item = get_file_status(media_s3url)
+    if item == None:
+        logger.info("Transcription job for media file not tracked in Indexer Media File table.. possibly this is a job that is not started by MediaSearch indexer")
+        return ["IGNORED", None]
+    # only the current transcription job of the file may change its status - e.g. not a job for a previous
+    # version of a file that has since been modified and submitted again
+    if item.get('transcribe_job_id') != job_name:
+        logger.info(f"Transcription job {job_name} is no longer the current job for {media_s3url} ({item.get('transcribe_job_id')}) - ignoring")
+        return ["IGNORED", None]
+    if item.get('sync_state') != "RUNNING":
+        logger.info(f"Transcription job {job_name} for {media_s3url} is already complete (sync_state {item.get('sync_state')}) - skipping duplicate event")
+        return ["DUPLICATE", None]
+    expected = get_completion_condition(job_name, item)
+    transcribe_secs = item.get('transcribe_secs')
+    # a transcript that was indexed before is indexed again from its prepared text, if it was kept, without
+    # retrieving the job or the transcript
+    prepared = load_prepared_transcript(job_name) if item.get('transcribe_state') == "DONE" else None
+    if prepared == None:
+        if transcription_job == None:
+            logger.info("** Retrieve transcription job **")
+            transcription_job = get_transcription_job(job_name)
+            if transcription_job == None or ('TranscriptionJob' not in transcription_job):
+                # the crawler reindexes transcripts kept in the output bucket after Transcribe has deleted their job
+                if not get_transcript_s3url(job_name):
+                    logger.error("Unable to retrieve transcription from job.")
+                    return ["IGNORED", None]
+                logger.info(f"Transcription job {job_name} no longer exists - using its transcript in the output bucket")
+                transcription_job = None
+        if transcription_job and transcription_job['TranscriptionJob']['TranscriptionJobStatus'] == "FAILED":
             # job failed
             failure_reason = transcription_job['TranscriptionJob']['FailureReason']
-            logger.error(f"Transcribe job failed: {job_status} - Reason {failure_reason}")
-            put_file_status(
-                media_s3url, lastModified=item['lastModified'], size_bytes=item['size_bytes'], duration_secs=None, status=item['status'],
-                metadata_url=item['metadata_url'], metadata_lastModified=item['metadata_lastModified'],
-                transcribeopts_url=item['transcribeopts_url'], transcribeopts_lastModified=item['transcribeopts_lastModified'],
-                transcribe_job_id=item['transcribe_job_id'], transcribe_state="FAILED", transcribe_secs=None,
-                sync_job_id=item['sync_job_id'], sync_state="NOT_SYNCED"
-                )            
-        else:
-            # job completed
-            transcript_uri = transcription_job['TranscriptionJob']['Transcript']['TranscriptFileUri']
+            logger.error(f"Transcribe job failed: FAILED - Reason {failure_reason}")
+            if not update_file_status(media_s3url, expected=expected, transcribe_state="FAILED", sync_state="NOT_SYNCED"):
+                return ["DUPLICATE", None]
+            return ["FINISHED", None]
+        # job completed - transcribe_state is recorded with the outcome of indexing, in the same write
+        if transcription_job:
+            transcript_file_uri = transcription_job['TranscriptionJob']['Transcript']['TranscriptFileUri']
+            # transcripts in an output bucket are read with the S3 client rather than downloaded from their https url
+            transcript_uri = parse_transcript_uri(transcript_file_uri) or transcript_file_uri
             transcribe_secs = get_transcription_job_duration(transcription_job)
-            # Update transcribe_state
-            put_file_status(
-                media_s3url, lastModified=item['lastModified'], size_bytes=item['size_bytes'], duration_secs=None, status=item['status'], 
-                metadata_url=item['metadata_url'], metadata_lastModified=item['metadata_lastModified'],
-                transcribeopts_url=item['transcribeopts_url'], transcribeopts_lastModified=item['transcribeopts_lastModified'],
-                transcribe_job_id=item['transcribe_job_id'], transcribe_state="DONE", transcribe_secs=transcribe_secs,
-                sync_job_id=item['sync_job_id'], sync_state=item['sync_state']
-                )
-            try:
-                logger.info("** Process transcription and prepare for indexing **")
-                [duration_secs, text] = prepare_transcript(transcript_uri)
-                logger.info("** Index transcription document in Kendra **")
-                put_document(dsId=DS_ID, indexId=INDEX_ID, s3url=media_s3url, item=item, text=text)
-                # Update sync_state
-                put_file_status(
-                    media_s3url, lastModified=item['lastModified'], size_bytes=item['size_bytes'], duration_secs=duration_secs, status=item['status'], 
-                    metadata_url=item['metadata_url'], metadata_lastModified=item['metadata_lastModified'],
-                    transcribeopts_url=item['transcribeopts_url'], transcribeopts_lastModified=item['transcribeopts_lastModified'],
-                    transcribe_job_id=item['transcribe_job_id'], transcribe_state="DONE", transcribe_secs=transcribe_secs,
-                    sync_job_id=item['sync_job_id'], sync_state="DONE"
+        else:
+            transcript_uri = get_transcript_s3url(job_name)
+    try:
+        if prepared == None:
+            logger.info("** Process transcription and prepare for indexing **")
+            prepared = get_prepared_transcript(job_name, transcript_uri)
+        [duration_secs, documents, deletions, segment_hashes] = get_indexing_changes(media_s3url, item, prepared)
+    except Exception as e:
+        logger.error("Exception thrown during indexing: " + str(e))
+        if not update_file_status(media_s3url, expected=expected, transcribe_state="DONE", transcribe_secs=transcribe_secs, sync_state="FAILED"):
+            return ["DUPLICATE", None]
+        return ["FINISHED", None]
+    return ["INDEX", {
+        's3url': media_s3url,
+        'expected': expected,
+        'transcribe_secs': transcribe_secs,
+        'sync_job_id': item.get('sync_job_id'),
+        'duration_secs': duration_secs,
+        'documents': documents,
+        'deletions': deletions,
+        'segment_hashes': segment_hashes,
+        'previous_hashes': item.get('segment_hashes') or {}
+    }]
+
+def is_completion_pending(s3url, job_name):
+    # True if the file is still waiting for the outcome of the job, e.g. after the completion write failed because
+    # the metadata file changed while the transcript was being indexed
+    item = get_file_status(s3url)
+    return item != None and item.get('transcribe_job_id') == job_name and item.get('sync_state') == "RUNNING"
+
+def get_job_events(event):
+    # Returns [record_id, event, first_delivery] for each transcription job event - from SQS messages (transcription
+    # job state changes queued by EventBridge), or a single event invoked directly (e.g. by the crawler, to reindex
+    # an existing transcription). Events repeated in the same batch are only returned once.
+    if 'Records' not in event:
+        return [[None, event, True]]
+    job_events = []
+    seen = set()
+    for record in event['Records']:
+        job_event = json.loads(record['body'])
+        key = (job_event.get('source'), job_event['detail'].get('TranscriptionJobName'), job_event['detail'].get('MediaS3Url'))
+        if key in seen:
+            logger.info(f"Skipping repeated event for transcription job {key[1]}")
+            continue
+        seen.add(key)
+        first_delivery = record.get('attributes', {}).get('ApproximateReceiveCount', '1') == '1'
+        job_events.append([record['messageId'], job_event, first_delivery])
+    return job_events
+
+# jobcompete handler - this lambda processes and indexes media file transcriptions
+# invoked as the Amazon Transcribe job for each media file (started by the crawler lambda) completes - EventBridge
+# queues the job state change events, so transcripts that complete together are indexed together in batches.
+# Each job costs one read and one conditional write of its file status, so repeated or out of order events are
+# skipped, and a job's transcription slot is released once, when its outcome is recorded.
+def lambda_handler(event, context):
+    logger.info("Received event: %s" % json.dumps(event))
+    job_events = get_job_events(event)
+    failed_records = []
+    to_index = []
+    duplicates = 0
+    released = 0
+    for job_event, result, exception in map_concurrently(lambda job_event: process_job_event(job_event[1]), job_events, JOBCOMPLETE_CONCURRENCY):
+        [record_id, event, first_delivery] = job_event
+        if exception:
+            logger.error(f"Exception processing transcription job event {event['detail'].get('TranscriptionJobName')}: " + str(exception))
+            failed_records.append(record_id)
+            continue
+        [outcome, changes] = result
+        if outcome == "INDEX":
+            to_index.append([job_event, changes])
+        elif outcome == "FINISHED":
+            released += release_job_slot(event)
+        elif outcome == "DUPLICATE":
+            duplicates += 1
+        elif outcome == "IGNORED" and first_delivery:
+            # a superseded job still held a slot - only released once, not again if the message is retried
+            released += release_job_slot(event)
+    
+    if to_index:
+        logger.info(f"** Index {len(to_index)} transcriptions in Kendra **")
+        failures = put_documents(DS_ID, INDEX_ID, [document for job_event, changes in to_index for document in changes['documents']])
+        for job_event, changes in to_index:
+            [record_id, event, first_delivery] = job_event
+            s3url = changes['s3url']
+            if changes['deletions']:
+                failures.update(delete_documents(DS_ID, INDEX_ID, changes['sync_job_id'], changes['deletions']))
+            failed = any(document['Id'] in failures for document in changes['documents']) or any(document_id in failures for document_id in changes['deletions'])
+            # segments that failed to index or delete are recorded with an empty hash, so they are sent or deleted again
+            segment_hashes = {}
+            for window, segment_hash in (changes['segment_hashes'] or {}).items():
+                segment_hashes[window] = "" if get_segment_document_id(s3url, window) in failures else segment_hash
+            for window in changes['previous_hashes']:
+                if get_segment_document_id(s3url, window) in failures:
+                    segment_hashes[window] = ""
+            # Move the file from transcribing to indexed (or failed) in one write
+            if failed:
+                completed = update_file_status(
+                    s3url, expected=changes['expected'], transcribe_state="DONE", transcribe_secs=changes['transcribe_secs'],
+                    sync_state="FAILED", segment_hashes=segment_hashes or None
                     )
-            except Exception as e:
-                logger.error("Exception thrown during indexing: " + str(e))
-                put_file_status(
-                    media_s3url, lastModified=item['lastModified'], size_bytes=item['size_bytes'], duration_secs=None, status=item['status'], 
-                    metadata_url=item['metadata_url'], metadata_lastModified=item['metadata_lastModified'],
-                    transcribeopts_url=item['transcribeopts_url'], transcribeopts_lastModified=item['transcribeopts_lastModified'],
-                    transcribe_job_id=item['transcribe_job_id'], transcribe_state="DONE", transcribe_secs=transcribe_secs, 
-                    sync_job_id=item['sync_job_id'], sync_state="FAILED"
+            else:
+                completed = update_file_status(
+                    s3url, expected=changes['expected'], transcribe_state="DONE", transcribe_secs=changes['transcribe_secs'],
+                    duration_secs=changes['duration_secs'], sync_state="DONE", segment_hashes=segment_hashes or None
                     )
-    # Finally, in all cases stop sync job if not more transcription jobs are pending.
-    stop_kendra_sync_job_when_all_done(dsId=DS_ID, indexId=INDEX_ID)
+            if completed:
+                released += release_job_slot(event)
+            elif record_id and is_completion_pending(s3url, changes['expected']['transcribe_job_id']):
+                # indexed with metadata that has since changed - the message is retried, to index it again
+                logger.info(f"Metadata of {s3url} changed while it was indexed - retrying")
+                failed_records.append(record_id)
+    if released:
+        logger.info("** Start queued transcription jobs **")
+        drain_transcription_backlog(STACK_NAME, TRANSCRIBE_ROLE)
+    # Finally, stop sync job if no more transcription jobs are pending - unless every event was a duplicate, and
+    # nothing has changed
+    if duplicates < len(job_events):
+        stop_kendra_sync_job_when_all_done(dsId=DS_ID, indexId=INDEX_ID)
+    log_cache_stats()
+    # failed SQS messages are returned to the queue and retried
+    return {'batchItemFailures': [{'itemIdentifier': record_id} for record_id in failed_records if record_id]}
 
 if __name__ == "__main__":
     import logging
@@ -0,0 +1,202 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Converts the 'Attributes' of a metadata file to Kendra document attributes. The Kendra type of each attribute
+# key comes from the field configuration of the index (describe_index) when the key is an index field, or is
+# inferred from the value (int - LongValue, list - StringListValue, ISO 8601 date string - DateValue, other
+# strings - StringValue). Each value is parsed at most once - only strings that start with a year are parsed as
+# dates - and values that don't match the type of their index field are converted if possible, or left out, and
+# reported together.
+# This module has no dependency on the other indexer modules, so it can be run locally, e.g.
+#   python metadata.py benchmark [1000 5000]   - conversion time for metadata files with thousands of attributes
+
+import re
+import sys
+import time
+import dateutil.parser
+
+import logging
+logger = logging.getLogger()
+
+# Kendra index field types, and the document attribute value type for each
+VALUE_TYPES = {
+    'STRING_VALUE': 'StringValue',
+    'STRING_LIST_VALUE': 'StringListValue',
+    'LONG_VALUE': 'LongValue',
+    'DATE_VALUE': 'DateValue'
+}
+
+RESERVED_ATTRIBUTES = ["_data_source_id", "_data_source_sync_job_execution_id", "_source_uri"]
+# YouTube media metadata (see ytindexer) sets the _source_uri of the video
+YOUTUBE_RESERVED_ATTRIBUTES = ["_data_source_id", "_data_source_sync_job_execution_id"]
+
+INTEGER = re.compile(r'^[+-]?\d+$')
+
+# every ISO 8601 date starts with a four digit year, so other strings are not parsed as dates
+ISO_DATE_START = re.compile(r'^[0-9]{4}')
+
+def parse_date(value):
+    # Returns the datetime for an ISO 8601 date string, or None
+    try:
+        return dateutil.parser.isoparse(value)
+    except Exception:
+        return None
+
+class AttributeConverter:
+    def __init__(self, field_types=None):
+        # field_types maps index field names to Kendra value types, e.g. {'_category': 'StringValue'}
+        self.field_types = field_types or {}
+
+    @classmethod
+    def from_index_configurations(cls, configurations):
+        # from the DocumentMetadataConfigurations of describe_index
+        return cls({config['Name']: VALUE_TYPES[config['Type']] for config in configurations if config.get('Type') in VALUE_TYPES})
+
+    def infer(self, key, value):
+        # Returns [kendra_type, kendra_value] for an attribute that is not an index field
+        if type(value) is int:
+            return ["LongValue", value]
+        if type(value) is list:
+            return ["StringListValue", [str(x) for x in value]]
+        if type(value) is str:
+            dt = parse_date(value) if ISO_DATE_START.match(value) else None
+            return ["DateValue", dt] if dt else ["StringValue", value]
+        return [None, str(value)]
+
+    def convert(self, key, value, kendra_type):
+        # Returns the value converted to the type of an index field, or None if it can't be converted
+        if kendra_type == "StringValue":
+            if type(value) in [str, int, float, bool]:
+                return value if type(value) is str else str(value)
+        elif kendra_type == "LongValue":
+            if type(value) is int:
+                return value
+            if type(value) is float and value.is_integer():
+                return int(value)
+            if type(value) is str and INTEGER.match(value):
+                return int(value)
+        elif kendra_type == "DateValue":
+            if type(value) is str:
+                return parse_date(value)
+        elif kendra_type == "StringListValue":
+            if type(value) is list:
+                return [str(x) for x in value]
+            if type(value) in [str, int, float]:
+                return [str(value)]
+        return None
+
+    def get_attributes(self, meta_attributes):
+        """Returns [kendra_attributes, conflicts] for the 'Attributes' dict of a metadata file. conflicts lists a
+        description of each attribute that was converted to the type of its index field, or left out."""
+        kendra_attributes = []
+        conflicts = []
+        # if ytsource exists then it must accept _source_uri from metadata
+        reserved_attributes = YOUTUBE_RESERVED_ATTRIBUTES if 'ytsource' in meta_attributes else RESERVED_ATTRIBUTES
+        for key, value in meta_attributes.items():
+            if key in reserved_attributes:
+                conflicts.append(f"{key}: reserved attribute - ignored")
+                continue
+            kendra_type = self.field_types.get(key)
+            if kendra_type:
+                kendra_value = self.convert(key, value, kendra_type)
+                if kendra_value is None:
+                    conflicts.append(f"{key}: {type(value).__name__} value is not a valid {kendra_type} - ignored")
+                    continue
+                if type(value) is not type(kendra_value) and not (kendra_type == "DateValue" or type(value) is list):
+                    conflicts.append(f"{key}: {type(value).__name__} value converted to {kendra_type}")
+            else:
+                kendra_type, kendra_value = self.infer(key, value)
+                if kendra_type is None:
+                    conflicts.append(f"{key}: invalid type {type(value).__name__} - converted to string")
+                    kendra_type = "StringValue"
+            kendra_attributes.append({
+                'Key': key,
+                'Value': {
+                    kendra_type: kendra_value
+                }
+            })
+        return [kendra_attributes, conflicts]
+
+def get_kendra_type_and_value_unconverted(key, value):
+    # Reference implementation - infers the type of every value, parsing date strings twice
+    kendra_type = ""
+    kendra_value = value
+    if type(value) is int:
+        kendra_type = "LongValue"
+    elif type(value) is list:
+        kendra_type = "StringListValue"
+        kendra_value = list(map(lambda x: str(x), value))
+    elif type(value) is str:
+        kendra_type = "StringValue"
+        if parse_date(value):
+            kendra_type = "DateValue"
+            kendra_value = parse_date(value)
+    else:
+        kendra_type = "StringValue"
+        kendra_value = str(value)
+    return [kendra_type, kendra_value]
+
+def get_metadata_attributes_unconverted(meta_attributes):
+    # Reference implementation - the reserved attributes are worked out and logged for every key
+    kendra_metadata_attributes = []
+    for key, value in meta_attributes.items():
+        if 'ytsource' in meta_attributes:
+            reserved_attributes = ["_data_source_id", "_data_source_sync_job_execution_id"]
+        else:
+            reserved_attributes = ["_data_source_id", "_data_source_sync_job_execution_id", "_source_uri"]
+        logger.info("reserved_attributes")
+        logger.info(reserved_attributes)
+        if key not in reserved_attributes:
+            kendra_type, kendra_value = get_kendra_type_and_value_unconverted(key, value)
+            kendra_metadata_attributes.append({'Key': key, 'Value': {kendra_type: kendra_value}})
+    return kendra_metadata_attributes
+
+def make_synthetic_metadata(count):
+    # Returns [attributes, index configurations] - attributes of mixed types, half of them index fields
+    attributes = {}
+    configurations = []
+    for n in range(count):
+        kind = n % 4
+        key = f"attr{n}"
+        if kind == 0:
+            attributes[key] = f"speaker {n} on topic {n % 17}"
+            field_type = 'STRING_VALUE'
+        elif kind == 1:
+            attributes[key] = f"2024-{n % 12 + 1:02d}-{n % 28 + 1:02d}T10:{n % 60:02d}:00Z"
+            field_type = 'DATE_VALUE'
+        elif kind == 2:
+            attributes[key] = n
+            field_type = 'LONG_VALUE'
+        else:
+            attributes[key] = [f"tag{n}", f"tag{n + 1}"]
+            field_type = 'STRING_LIST_VALUE'
+        if n % 2 == 0:
+            configurations.append({'Name': key, 'Type': field_type})
+    return [attributes, configurations]
+
+def benchmark(counts, files=20):
+    print(f"{'attributes':>10} {'implementation':>15} {'ms/file':>9} {'attributes/sec':>15}")
+    for count in counts:
+        attributes, configurations = make_synthetic_metadata(count)
+        converter = AttributeConverter.from_index_configurations(configurations)
+        runs = [
+            ["unconverted", lambda: get_metadata_attributes_unconverted(attributes)],
+            ["converter", lambda: converter.get_attributes(attributes)[0]]
+        ]
+        results = {}
+        for name, run in runs:
+            start = time.perf_counter()
+            for i in range(files):
+                results[name] = run()
+            secs = time.perf_counter() - start
+            print(f"{count:>10} {name:>15} {secs / files * 1000:>9.2f} {count * files / secs:>15.0f}")
+        if results["converter"] != results["unconverted"]:
+            raise AssertionError(f"Converted attributes differ from unconverted attributes for {count} attributes")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        logging.basicConfig(level=logging.WARNING)
+        benchmark([int(n) for n in sys.argv[2:]] or [1000, 5000])
+    else:
+        print("Usage: python metadata.py benchmark [attributes ...]", file=sys.stderr)
+        sys.exit(1)
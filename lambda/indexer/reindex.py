@@ -0,0 +1,211 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Bulk reindex command line tool - repopulates a Kendra index (e.g. a recreated index, or one in another edition or
+# region) with the media files in the status table, from their existing transcripts. No transcription jobs are
+# started: each file is indexed from its prepared text, or its transcript in the transcript bucket, or from
+# Transcribe while it still keeps the job. Files without a transcript are reported. For example:
+#   python reindex.py --table <MediaFileTable> --index-id <IndexId> --data-source-id <DataSourceId> \
+#       --transcript-bucket <TranscriptBucket> --max-tps 5
+#   python reindex.py ... --region <Region>  - the index is in another region than the stack
+#   python reindex.py ... --resume           - continue an interrupted run from its checkpoint file
+# The status table is read with a parallel scan, and transcripts are prepared in parallel (--concurrency). Documents
+# are sent with BatchPutDocument, at most --max-tps calls per second. Each file is recorded in the checkpoint file
+# (JSON lines) once its documents are sent, and progress is reported every --progress-secs. The status of the files
+# is not changed - only the schema record of the target index (reindex-<IndexId>#index_schema) is written. The
+# settings of the jobcomplete function (e.g. TRANSCRIPT_SEGMENT_SECS, TRANSCRIPT_LINE_WIDTH) are read from the
+# environment.
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+# waiting for a finishing sync job of the data source to end before starting another
+SYNC_JOB_ATTEMPTS = 30
+SYNC_JOB_WAIT_SECS = 10
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Index the media files in the status table from their existing transcripts")
+    parser.add_argument("--table", default=os.environ.get('MEDIA_FILE_TABLE'), help="status table name (default: $MEDIA_FILE_TABLE)")
+    parser.add_argument("--index-id", default=os.environ.get('INDEX_ID'), help="target Kendra index (default: $INDEX_ID)")
+    parser.add_argument("--data-source-id", default=os.environ.get('DS_ID'), help="target data source of the index (default: $DS_ID)")
+    parser.add_argument("--region", help="region of the target index, if not the region of the status table and transcript bucket")
+    parser.add_argument("--transcript-bucket", default=os.environ.get('TRANSCRIPT_BUCKET', ''), help="transcript bucket of the stack (default: $TRANSCRIPT_BUCKET)")
+    parser.add_argument("--prefix", help="only media files with s3urls starting with prefix, e.g. s3://bucket/folder/")
+    parser.add_argument("--segments", type=int, default=8, help="parallel scan segments (default: 8)")
+    parser.add_argument("--concurrency", type=int, default=8, help="files prepared in parallel (default: 8)")
+    parser.add_argument("--max-tps", type=float, default=5, help="BatchPutDocument calls per second (default: 5)")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: reindex-<index id>.jsonl)")
+    parser.add_argument("--resume", action="store_true", help="skip the files the checkpoint file records as indexed")
+    parser.add_argument("--progress-secs", type=int, default=30, help="seconds between progress reports (default: 30)")
+    parser.add_argument("--category-facetable", action="store_true", help="make _category facetable in the index schema")
+    parser.add_argument("--youtube", action="store_true", help="add the YouTube fields to the index schema")
+    args = parser.parse_args(argv)
+    for arg in ['table', 'index_id', 'data_source_id']:
+        if not getattr(args, arg):
+            parser.error(f"--{arg.replace('_', '-')} is required")
+    args.checkpoint = args.checkpoint or f"reindex-{args.index_id}.jsonl"
+    if os.path.exists(args.checkpoint) and not args.resume:
+        parser.error(f"checkpoint file {args.checkpoint} exists - use --resume to continue, or remove it")
+    return args
+
+def read_checkpoint(path):
+    # s3urls of the files recorded as indexed
+    indexed = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry.get('result') == "INDEXED":
+                        indexed.add(entry['id'])
+    return indexed
+
+class Progress:
+    def __init__(self, interval_secs):
+        self.interval_secs = interval_secs
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.counts = {'INDEXED': 0, 'FAILED': 0, 'NO_TRANSCRIPT': 0, 'SKIPPED': 0, 'documents': 0}
+
+    def add(self, result, documents=0):
+        self.counts[result] += 1
+        self.counts['documents'] += documents
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval_secs:
+            return
+        self.last_report = now
+        secs = max(now - self.start, 0.001)
+        done = self.counts['INDEXED'] + self.counts['FAILED'] + self.counts['NO_TRANSCRIPT']
+        print(f"{secs:.0f}s: {self.counts} - {done / secs:.1f} files/s", file=sys.stderr, flush=True)
+
+def main(argv):
+    args = parse_args(argv)
+    # the indexer modules read their settings from the Lambda environment
+    os.environ['MEDIA_FILE_TABLE'] = args.table
+    os.environ['INDEX_ID'] = args.index_id
+    os.environ['DS_ID'] = args.data_source_id
+    os.environ.setdefault('STACK_NAME', 'reindex')
+    os.environ['TRANSCRIPT_BUCKET'] = args.transcript_bucket
+    import boto3
+    from boto3.dynamodb.conditions import Attr
+    from botocore.exceptions import ClientError
+    import common
+    import jobcomplete
+    # common sets the log level for the Lambda functions
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.region:
+        # only the index is in another region - the status table and the transcript bucket are read from the default region
+        common.KENDRA = jobcomplete.KENDRA = boto3.client('kendra', region_name=args.region)
+
+    def get_transcript_uri(job_name):
+        # The transcript in the transcript bucket, or kept by Transcribe, or None
+        transcript_s3url = common.get_transcript_s3url(job_name)
+        if transcript_s3url:
+            bucket, key, file_name = common.parse_s3url(transcript_s3url)
+            if common.head_s3_object(bucket, key):
+                return transcript_s3url
+        transcription_job = common.get_transcription_job(job_name)
+        if not transcription_job or transcription_job['TranscriptionJob']['TranscriptionJobStatus'] != 'COMPLETED':
+            return None
+        transcript_file_uri = transcription_job['TranscriptionJob']['Transcript']['TranscriptFileUri']
+        return common.parse_transcript_uri(transcript_file_uri) or transcript_file_uri
+
+    def get_file_documents(item):
+        # Returns the documents of a media file, or None if it has no transcript
+        job_name = item['transcribe_job_id']
+        prepared = jobcomplete.load_prepared_transcript(job_name)
+        if prepared is None:
+            transcript_uri = get_transcript_uri(job_name)
+            if not transcript_uri:
+                return None
+            prepared = jobcomplete.get_prepared_transcript(job_name, transcript_uri)
+        if jobcomplete.TRANSCRIPT_SEGMENT_SECS <= 0:
+            return [jobcomplete.get_document(args.data_source_id, args.index_id, item['id'], item, prepared[1])]
+        return list(jobcomplete.get_segment_documents(args.data_source_id, args.index_id, item['id'], item, prepared[1]).values())
+
+    def get_sync_job():
+        # Returns [sync job id, started] - documents sent with a data source must belong to a running sync job of
+        # the data source, so start one, or use the one already syncing. A job that is finishing (SYNCING_INDEXING,
+        # STOPPING) takes no more documents, so wait for it to end and start another.
+        for attempt in range(SYNC_JOB_ATTEMPTS):
+            try:
+                return [common.KENDRA.start_data_source_sync_job(Id=args.data_source_id, IndexId=args.index_id)['ExecutionId'], True]
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ['ConflictException', 'ResourceInUseException']:
+                    raise
+            sync_job_id = common.get_running_kendra_sync_job_id(args.data_source_id, args.index_id)
+            if sync_job_id:
+                return [sync_job_id, False]
+            print(f"A sync job of data source {args.data_source_id} is finishing - waiting {SYNC_JOB_WAIT_SECS}s to start another", file=sys.stderr)
+            time.sleep(SYNC_JOB_WAIT_SECS)
+        sys.exit(f"Unable to start a sync job of data source {args.data_source_id}, and no sync job of it is syncing - try again later")
+
+    # the schema record is kept per target index, so the record of the stack that indexes the media files is left alone
+    common.reconcile_index_schema(f"reindex-{args.index_id}", args.index_id, common.get_index_schema(args.category_facetable, args.youtube))
+    [sync_job_id, started] = get_sync_job()
+    print(f"Indexing into index {args.index_id}, data source {args.data_source_id}, sync job {sync_job_id}", file=sys.stderr)
+
+    indexed = read_checkpoint(args.checkpoint) if args.resume else set()
+    progress = Progress(args.progress_secs)
+    limiter = common.RateLimiter(args.max_tps)
+    conditions = Attr('status').exists() & Attr('status').ne('DELETED') & Attr('transcribe_state').eq('DONE')
+    if args.prefix:
+        conditions = conditions & Attr('id').begins_with(args.prefix)
+
+    def iter_items():
+        for item in common.scan_status_items(filter_expression=conditions, segments=args.segments):
+            if item['id'] in indexed:
+                progress.add('SKIPPED')
+                continue
+            yield dict(item, sync_job_id=sync_job_id)
+
+    checkpoint = open(args.checkpoint, "a")
+    pending = []
+    def flush():
+        # sends the documents of the pending files, and records each file in the checkpoint file
+        failures = {}
+        for batch in jobcomplete.get_document_batches([document for s3url, documents in pending for document in documents]):
+            limiter.acquire()
+            failures.update(jobcomplete.put_document_batch(args.index_id, batch))
+        for s3url, documents in pending:
+            reasons = [failures[document['Id']] for document in documents if document['Id'] in failures]
+            result = "FAILED" if reasons else "INDEXED"
+            entry = {'id': s3url, 'result': result, 'documents': len(documents)}
+            if reasons:
+                entry['reason'] = reasons[0]
+            checkpoint.write(json.dumps(entry) + "\n")
+            progress.add(result, len(documents))
+        checkpoint.flush()
+        pending.clear()
+
+    try:
+        for item, documents, exception in common.map_concurrently(get_file_documents, iter_items(), args.concurrency):
+            if exception or documents is None:
+                result = "FAILED" if exception else "NO_TRANSCRIPT"
+                entry = {'id': item['id'], 'result': result}
+                if exception:
+                    entry['reason'] = str(exception)
+                checkpoint.write(json.dumps(entry) + "\n")
+                progress.add(result)
+            else:
+                pending.append([item['id'], documents])
+                if sum(len(documents) for s3url, documents in pending) >= jobcomplete.KENDRA_BATCH_MAX_DOCS * 10:
+                    flush()
+            progress.report()
+        flush()
+    finally:
+        checkpoint.close()
+        if started:
+            common.KENDRA.stop_data_source_sync_job(Id=args.data_source_id, IndexId=args.index_id)
+    progress.report(force=True)
+    return 1 if progress.counts['FAILED'] else 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
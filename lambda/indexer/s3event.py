@@ -0,0 +1,147 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import urllib
+
+from common import logger
+from common import INDEX_ID, DS_ID, STACK_NAME
+from common import head_s3_object
+from common import get_crawler_state, get_file_status, delete_files
+from common import get_crawl_generation
+from common import get_or_start_kendra_sync_job, stop_kendra_sync_job_when_all_done
+from common import map_concurrently
+from crawler import MEDIA_BUCKET, YTMEDIA_BUCKET, MEDIA_FOLDER_PREFIX, METADATA_FOLDER_PREFIX, TRANSCRIBEOPTS_FOLDER_PREFIX
+from crawler import TRANSCRIBE_ROLE, CRAWLER_CONCURRENCY
+from crawler import process_s3_media_object
+from transcription import MAX_TRANSCRIBE_JOBS_IN_FLIGHT, is_priority_scheduling, drain_transcription_backlog
+from crawler import is_supported_media_file, is_supported_metadata_file, is_supported_transcribeopts_file
+from crawler import get_metadata_ref_file_key, get_transcribeopts_ref_file_key
+from crawler import get_metadata_file_key, get_transcribeopts_file_key
+from cache import log_cache_stats
+
+def get_bucket_list():
+    if (MEDIA_BUCKET):
+        return [MEDIA_BUCKET, YTMEDIA_BUCKET]
+    return [YTMEDIA_BUCKET]
+
+def get_s3_notifications(event):
+    # Returns a list of (record_id, bucket, key) for the S3 objects referenced by the event.
+    # The event can be an SQS batch of S3 event notifications (record_id is the SQS messageId),
+    # or an S3 event notification or EventBridge S3 event delivered directly (record_id is None).
+    notifications = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                body = json.loads(record['body'])
+            except Exception as e:
+                logger.error(f"SQS message {record['messageId']} is not valid JSON - ignoring: " + str(e))
+                continue
+            notifications += get_s3_notifications_from_message(record['messageId'], body)
+        elif record.get('eventSource') == 'aws:s3':
+            notifications += get_s3_notifications_from_message(None, {'Records': [record]})
+    if event.get('source') == 'aws.s3':
+        notifications += get_s3_notifications_from_message(None, event)
+    return notifications
+
+def get_s3_notifications_from_message(record_id, message):
+    notifications = []
+    if message.get('source') == 'aws.s3' and 'detail' in message:
+        # EventBridge event - key is not URL encoded
+        notifications.append((record_id, message['detail']['bucket']['name'], message['detail']['object']['key']))
+    for s3record in message.get('Records', []):
+        if 's3' in s3record:
+            # S3 event notification - key is URL encoded
+            key = urllib.parse.unquote_plus(s3record['s3']['object']['key'])
+            notifications.append((record_id, s3record['s3']['bucket']['name'], key))
+    if not notifications:
+        logger.info(f"No S3 object references in message (e.g. s3:TestEvent) - ignoring: {json.dumps(message)[0:500]}")
+    return notifications
+
+def get_media_key(key):
+    # Returns the key of the media file affected by a change to key, or None if key is not a media file,
+    # or a metadata or Transcribe options file, in the locations crawled by the indexer
+    media_key = None
+    if is_supported_media_file(key):
+        media_key = key
+    elif is_supported_metadata_file(key):
+        if (METADATA_FOLDER_PREFIX == "" and key.startswith(MEDIA_FOLDER_PREFIX)) or (METADATA_FOLDER_PREFIX and key.startswith(METADATA_FOLDER_PREFIX)):
+            media_key = get_metadata_ref_file_key(key, MEDIA_FOLDER_PREFIX, METADATA_FOLDER_PREFIX)
+    elif is_supported_transcribeopts_file(key):
+        if (TRANSCRIBEOPTS_FOLDER_PREFIX == "" and key.startswith(MEDIA_FOLDER_PREFIX)) or (TRANSCRIBEOPTS_FOLDER_PREFIX and key.startswith(TRANSCRIBEOPTS_FOLDER_PREFIX)):
+            media_key = get_transcribeopts_ref_file_key(key, MEDIA_FOLDER_PREFIX, TRANSCRIBEOPTS_FOLDER_PREFIX)
+    if media_key and media_key.startswith(MEDIA_FOLDER_PREFIX):
+        return media_key
+    return None
+
+def process_media_file(bucket, media_key, kendra_sync_job_id, crawl_generation=None):
+    # Events may arrive out of order, so the current state of the media file and its metadata and options
+    # files is read from S3 rather than inferred from the event type.
+    s3url = f"s3://{bucket}/{media_key}"
+    s3object = head_s3_object(bucket, media_key)
+    if s3object == None:
+        item = get_file_status(s3url)
+        if item and item.get('status') not in [None, 'DELETED']:
+            logger.info("DELETED:" + s3url)
+            delete_files(DS_ID, INDEX_ID, kendra_sync_job_id, [s3url])
+            return "DELETED"
+        logger.info("Media file does not exist and is not indexed - ignoring: " + s3url)
+        return "IGNORED"
+    s3metadataobject = head_s3_object(bucket, get_metadata_file_key(media_key, METADATA_FOLDER_PREFIX))
+    s3transcribeoptsobject = head_s3_object(bucket, get_transcribeopts_file_key(media_key, TRANSCRIBEOPTS_FOLDER_PREFIX))
+    return process_s3_media_object(STACK_NAME, bucket, s3url, s3object, s3metadataobject, s3transcribeoptsobject, kendra_sync_job_id, TRANSCRIBE_ROLE, crawl_generation=crawl_generation)
+
+# s3event handler - this lambda incrementally indexes media files as they are created, modified or deleted
+# invoked by an SQS queue subscribed to S3 ObjectCreated and ObjectRemoved event notifications for the media buckets
+def lambda_handler(event, context):
+    logger.info("Received event: %s" % json.dumps(event))
+
+    # group notifications by media file, so several events for the same file (e.g. media file and
+    # metadata file uploaded together) are processed once
+    media_files = {}
+    bucket_list = get_bucket_list()
+    for record_id, bucket, key in get_s3_notifications(event):
+        media_key = get_media_key(key) if bucket in bucket_list else None
+        if media_key == None:
+            logger.info(f"Not a media, metadata or options file crawled by the indexer - ignoring: s3://{bucket}/{key}")
+            continue
+        media_files.setdefault((bucket, media_key), []).append(record_id)
+
+    failed_records = set()
+    if media_files:
+        logger.info(f"Process {len(media_files)} media files")
+        try:
+            kendra_sync_job_id = get_or_start_kendra_sync_job(dsId=DS_ID, indexId=INDEX_ID)
+        except Exception as e:
+            # e.g. previous sync job is still stopping - retry the whole batch later
+            logger.error("Unable to get or start data source sync job: " + str(e))
+            raise
+        # stamp files with the generation of the current (or last) crawl, so a crawl that has already listed
+        # past a new file does not treat it as deleted
+        crawl_generation = get_crawl_generation(STACK_NAME)
+        def process(media_file):
+            return process_media_file(media_file[0], media_file[1], kendra_sync_job_id, crawl_generation)
+        for media_file, result, exception in map_concurrently(process, list(media_files.keys()), CRAWLER_CONCURRENCY):
+            if exception:
+                logger.error(f"Exception processing s3://{media_file[0]}/{media_file[1]}: " + str(exception))
+                failed_records.update(media_files[media_file])
+            else:
+                logger.info(f"{result}: s3://{media_file[0]}/{media_file[1]}")
+        if is_priority_scheduling():
+            # new files were queued by the priority policy - start the highest priority queued files
+            drain_transcription_backlog(STACK_NAME, TRANSCRIBE_ROLE, max_jobs=MAX_TRANSCRIBE_JOBS_IN_FLIGHT)
+        # leave the sync job running while a crawl is in progress - the crawler stops it when it is done
+        if get_crawler_state(STACK_NAME) != "RUNNING":
+            stop_kendra_sync_job_when_all_done(dsId=DS_ID, indexId=INDEX_ID)
+
+    log_cache_stats()
+    # failed SQS messages are returned to the queue and retried
+    batch_item_failures = [{'itemIdentifier': record_id} for record_id in failed_records if record_id]
+    if batch_item_failures:
+        logger.error(f"Failed to process {len(batch_item_failures)} messages")
+    return {'batchItemFailures': batch_item_failures}
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    lambda_handler({"source": "aws.s3", "detail": {"bucket": {"name": MEDIA_BUCKET}, "object": {"key": MEDIA_FOLDER_PREFIX + "test.mp3"}}}, {})
@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Admin command line tool for the indexer media file status table. Counts, lists or exports (as JSON lines)
+# the status items of media files, using a parallel scan. For example:
+#   python statusadmin.py --table <MediaFileTable> count --sync-state RUNNING
+#   python statusadmin.py --table <MediaFileTable> list --transcribe-state FAILED
+#   python statusadmin.py --table <MediaFileTable> export --prefix s3://bucket/folder/ --output status.jsonl
+# The table name is the MediaDynamoTable resource of the indexer stack (or set MEDIA_FILE_TABLE).
+
+import os
+import sys
+import json
+import argparse
+import logging
+
+FILTERS = {
+    'status': 'status',
+    'sync_state': 'sync_state',
+    'transcribe_state': 'transcribe_state'
+}
+
+def get_filter_expression(args):
+    from boto3.dynamodb.conditions import Attr
+    # only items that track a media file - not the crawler state and counter items
+    conditions = [Attr('status').exists()]
+    for arg, attr in FILTERS.items():
+        if getattr(args, arg):
+            conditions.append(Attr(attr).eq(getattr(args, arg)))
+    if args.prefix:
+        conditions.append(Attr('id').begins_with(args.prefix))
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Count, list or export media file status items")
+    parser.add_argument("--table", default=os.environ.get('MEDIA_FILE_TABLE'), help="status table name (default: $MEDIA_FILE_TABLE)")
+    parser.add_argument("--segments", type=int, default=8, help="parallel scan segments (default: 8)")
+    parser.add_argument("command", choices=["count", "list", "export"])
+    parser.add_argument("--status", help="e.g. ACTIVE-NEW, DELETED")
+    parser.add_argument("--sync-state", help="e.g. RUNNING, DONE, FAILED")
+    parser.add_argument("--transcribe-state", help="e.g. QUEUED, RUNNING, DONE, FAILED")
+    parser.add_argument("--prefix", help="only media files with s3urls starting with prefix, e.g. s3://bucket/folder/")
+    parser.add_argument("--attributes", help="comma separated attributes to export (default: all)")
+    parser.add_argument("--output", help="export to file (default: stdout)")
+    args = parser.parse_args(argv)
+    if not args.table:
+        parser.error("--table is required if MEDIA_FILE_TABLE is not set")
+    return args
+
+def main(argv):
+    args = parse_args(argv)
+    # common reads its settings from the Lambda environment - only the table name is used here
+    os.environ['MEDIA_FILE_TABLE'] = args.table
+    for name in ['INDEX_ID', 'DS_ID', 'STACK_NAME']:
+        os.environ.setdefault(name, '')
+    import common
+    filter_expression = get_filter_expression(args)
+    if args.command == "count":
+        print(common.count_status_items(filter_expression, segments=args.segments))
+        return
+    attributes = ['id'] if args.command == "list" else (args.attributes.split(",") if args.attributes else None)
+    items = common.scan_status_items(attributes=attributes, filter_expression=filter_expression, segments=args.segments)
+    if args.command == "list":
+        for item in items:
+            print(item['id'])
+        return
+    out = open(args.output, "w") if args.output else sys.stdout
+    count = 0
+    try:
+        for item in items:
+            out.write(json.dumps(item, default=str) + "\n")
+            count += 1
+    finally:
+        if args.output:
+            out.close()
+    logging.getLogger().info(f"Exported {count} status items")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main(sys.argv[1:])
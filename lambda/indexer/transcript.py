@@ -0,0 +1,481 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Streaming parser for Amazon Transcribe output files. The results.items array is read incrementally from the
+# transcript file (never loaded as a whole), sentences are assembled in list buffers, and the text is line wrapped
+# as it is produced - so time and memory grow linearly with the length of the recording. The prepared text is
+# identical to wrapping the whole transcript with textwrap.fill.
+# The prepared text can also be split into time window segments, each indexed as its own Kendra document.
+# This module has no dependency on the other indexer modules, so it can be run locally, e.g.
+#   python transcript.py ./asrOutput.json      - print the prepared text of a transcript
+#   python transcript.py benchmark [1 4 10]    - throughput on synthetic 1h, 4h and 10h transcripts (after checking
+#                                                that line wrapping matches textwrap.fill)
+
+import os
+import re
+import sys
+import json
+import time
+import bisect
+import codecs
+import textwrap
+import itertools
+
+# Width of the lines of prepared transcript text - 0 for no line wrapping
+TRANSCRIPT_LINE_WIDTH = int(os.environ.get('TRANSCRIPT_LINE_WIDTH', '70'))
+READ_CHUNK_SIZE = 256 * 1024
+
+WHITESPACE = re.compile(r'\s*')
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+STRUCTURE = re.compile(r'["\[\]{}]')
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]+\Z')
+
+# Line wrapping rules of textwrap.TextWrapper with its default options (as of Python 3.11), kept here so that
+# StreamingWrapper doesn't depend on TextWrapper internals, and wraps the same way on every Python version
+WRAP_WHITESPACE = '\t\n\x0b\x0c\r '
+WRAP_WHITESPACE_TRANS = dict.fromkeys(map(ord, WRAP_WHITESPACE), ord(' '))
+WRAP_TABSIZE = 8
+WRAP_WORD_SEPARATOR = re.compile(r'''
+    ( # any whitespace
+      %(ws)s+
+    | # em-dash between words
+      (?<=%(wp)s) -{2,} (?=\w)
+    | # word, possibly hyphenated
+      %(nws)s+? (?:
+        # hyphenated word
+          -(?: (?<=%(lt)s{2}-) | (?<=%(lt)s-%(lt)s-))
+          (?= %(lt)s -? %(lt)s)
+        | # end of word
+          (?=%(ws)s|\Z)
+        | # em-dash
+          (?<=%(wp)s) (?=-{2,}\w)
+        )
+    )''' % {'wp': r'[\w!"\'&.,?]', 'lt': r'[^\d\W]', 'ws': r'[%s]' % re.escape(WRAP_WHITESPACE),
+            'nws': r'[^%s]' % re.escape(WRAP_WHITESPACE)},
+    re.VERBOSE)
+
+class JsonStream:
+    # Reads JSON values one at a time from a file object (bytes or text), keeping only unread data in memory
+    def __init__(self, fileobj, chunk_size=READ_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.batches = True
+
+    def fill(self, min_size=0):
+        # Appends at least min_size more characters to the buffer (or up to the end of the file)
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        target = len(self.buf) + max(min_size, 1)
+        while not self.eof and len(self.buf) < target:
+            data = self.fileobj.read(max(self.chunk_size, min_size))
+            if not data:
+                self.eof = True
+                self.buf += self.decoder.decode(b"", final=True)
+            elif isinstance(data, str):
+                self.buf += data
+            else:
+                self.buf += self.decoder.decode(data)
+        return not self.eof or self.pos < len(self.buf)
+
+    def peek(self):
+        # Returns the next non whitespace character, without consuming it
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON data")
+            self.fill()
+
+    def expect(self, chars):
+        if self.pos < len(self.buf) and self.buf[self.pos] in chars:
+            # fast path - e.g. the comma that directly follows an array value
+            c = self.buf[self.pos]
+            self.pos += 1
+            return c
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f"Expected one of '{chars}' at '{self.buf[self.pos:self.pos+20]}'")
+        self.pos += 1
+        return c
+
+    def read_value(self):
+        # Decodes the next complete JSON value. Values that may continue past the end of the buffer
+        # (e.g. a number, or a truncated string) are decoded again once more data has been read.
+        if self.pos >= len(self.buf) or self.buf[self.pos].isspace():
+            self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+                # a number is only complete once it is followed by a character that can't be part of it
+                if self.eof or (end < len(self.buf) and not NUMBER_TAIL.match(self.buf, end)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(len(self.buf) - self.pos)
+
+    def skip_value(self):
+        # Skips the next JSON value without decoding it - containers are scanned for their closing bracket
+        if self.peek() not in "[{":
+            self.read_value()
+            return
+        depth = 0
+        while True:
+            m = STRUCTURE.search(self.buf, self.pos)
+            if not m:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON data")
+                continue
+            c = m.group()
+            if c == '"':
+                s = STRING.match(self.buf, m.start())
+                if not s:
+                    # string continues past the end of the buffer
+                    self.pos = m.start()
+                    if self.eof:
+                        raise ValueError("Unterminated JSON string")
+                    self.fill(len(self.buf) - self.pos)
+                    continue
+                self.pos = s.end()
+                continue
+            self.pos = m.end()
+            depth += 1 if c in "[{" else -1
+            if depth == 0:
+                return
+
+    def iter_object_keys(self):
+        # Iterates the keys of the next JSON object - the caller reads or skips the value of each key
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def read_object_batch(self):
+        # Decodes the array values in the buffer up to the last object followed by a comma with a single call, or
+        # returns None. If that '},' is past the end of the array, or inside a string or a nested value, the batch
+        # is not valid JSON and the previous '},' is tried - if none of the last few is valid, batches are not
+        # tried again.
+        end = len(self.buf)
+        for attempt in range(3):
+            end = self.buf.rfind("},", self.pos, end)
+            if end < 0:
+                return None
+            try:
+                values = self.json_decoder.decode("[" + self.buf[self.pos:end + 1] + "]")
+            except json.JSONDecodeError:
+                continue
+            self.pos = end + 1
+            return values
+        self.batches = False
+        return None
+
+    def iter_array(self):
+        # Iterates the values of the next JSON array. Runs of objects (e.g. transcript items) are decoded in
+        # batches of up to a buffer full, the rest one at a time.
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            values = self.read_object_batch() if self.batches else None
+            if values:
+                yield from values
+            else:
+                yield self.read_value()
+            if self.expect(",]") == "]":
+                return
+
+def iter_transcript_items(fileobj):
+    # Iterates results.items of an Amazon Transcribe output file, reading the file incrementally. Other fields
+    # (e.g. results.transcripts and speaker_labels) are skipped.
+    stream = JsonStream(fileobj)
+    for key in stream.iter_object_keys():
+        if key != "results":
+            stream.skip_value()
+            continue
+        for results_key in stream.iter_object_keys():
+            if results_key != "items":
+                stream.skip_value()
+                continue
+            yield from stream.iter_array()
+            return
+    raise KeyError("items")
+
+def iter_sentences(items):
+    # Assembles transcript items into sentences, each starting with the start time of its first word, e.g.
+    # "[12.34] Hello world." Yields [start_time, sentence] (start_time is None if the sentence starts with
+    # punctuation). Returns the end time of the last word (or 0) as the generator's return value.
+    duration_secs = 0
+    start_time = None
+    sentence = []
+    sentence_len = 0
+    for i in items:
+        content = i["alternatives"][0]["content"]
+        if (i["type"] == 'punctuation'):
+            sentence.append(content)
+            sentence_len += len(content)
+            if (content == '.'):
+                #sentence completed
+                yield [start_time, "".join(sentence)]
+                start_time = None
+                sentence = []
+                sentence_len = 0
+        else:
+            if (sentence_len == 0):
+                start_time = i["start_time"]
+                sentence = ["[" + start_time + "]"]
+                sentence_len = len(sentence[0])
+            sentence.append(" ")
+            sentence.append(content)
+            sentence_len += 1 + len(content)
+            duration_secs = i["end_time"]
+    if (sentence_len != 0):
+        yield [start_time, "".join(sentence)]
+    return duration_secs
+
+class StreamingWrapper:
+    # Line wraps text that is appended piece by piece, with the same result as textwrap.fill of the whole text
+    # (default TextWrapper options). Text is split into chunks with TextWrapper's rules, in blocks that end at
+    # whitespace, and lines are only completed once the chunk that ends them has been seen.
+    def __init__(self, width, block_size=64 * 1024):
+        self.width = width
+        self.block_size = block_size
+        self.pending = []
+        self.pending_len = 0
+        self.column = 0
+        self.chunks = []
+        self.lines = []
+
+    def append(self, text):
+        if '\t' in text:
+            # tabs expand to the next tab stop, counted from the start of the (whole text) line
+            text = (" " * self.column + text).expandtabs(WRAP_TABSIZE)[self.column:]
+        newline = max(text.rfind("\n"), text.rfind("\r"))
+        self.column = len(text) - newline - 1 if newline >= 0 else self.column + len(text)
+        self.pending.append(text)
+        self.pending_len += len(text)
+        if self.pending_len >= self.block_size:
+            self.split_pending(final=False)
+            self.wrap_chunks(final=False)
+
+    def split_pending(self, final):
+        text = "".join(self.pending)
+        end = len(text)
+        if not final:
+            # keep the last whitespace run, and anything after it, for the next block
+            end = max(map(text.rfind, WRAP_WHITESPACE))
+            while end > 0 and text[end - 1] in WRAP_WHITESPACE:
+                end -= 1
+            if end <= 0:
+                return
+        self.chunks.extend(filter(None, WRAP_WORD_SEPARATOR.split(text[:end].translate(WRAP_WHITESPACE_TRANS))))
+        rest = text[end:]
+        self.pending = [rest] if rest else []
+        self.pending_len = len(rest)
+
+    def wrap_chunks(self, final):
+        # Same as TextWrapper._wrap_chunks (no indents, max_lines or placeholder), but chunks are read forward,
+        # and a line that reaches the last chunk is left for the next block unless this is the end of the text.
+        # The chunks that fit on a line are found with a binary search of the offsets of the chunks in the block,
+        # rather than one chunk at a time.
+        chunks = self.chunks
+        width = self.width
+        lines = self.lines
+        offsets = list(itertools.accumulate(map(len, chunks), initial=0))
+        i = 0
+        n = len(chunks)
+        while i < n:
+            start = i
+            if chunks[i].strip() == '' and lines:
+                i += 1
+            end_chunk = bisect.bisect_right(offsets, offsets[i] + width, i) - 1
+            cur_line = chunks[i:end_chunk]
+            cur_len = offsets[end_chunk] - offsets[i]
+            i = end_chunk
+            if i == n and not final:
+                # more chunks may fit on this line
+                i = start
+                break
+            if i < n and len(chunks[i]) > width:
+                # a word longer than a line - put as much of it on this line as fits, breaking after a hyphen
+                # if there is one (with non-hyphens before it)
+                chunk = chunks[i]
+                end = width - cur_len
+                hyphen = chunk.rfind('-', 0, end)
+                if hyphen > 0 and any(c != '-' for c in chunk[:hyphen]):
+                    end = hyphen + 1
+                cur_line.append(chunk[:end])
+                chunks[i] = chunk[end:]
+                cur_len += end
+                # the chunk is shorter now, so the offsets of the chunks from here on change
+                offsets[i:] = itertools.accumulate(map(len, chunks[i:]), initial=offsets[i])
+            if cur_line and cur_line[-1].strip() == '':
+                cur_len -= len(cur_line[-1])
+                del cur_line[-1]
+            if cur_line:
+                lines.append(''.join(cur_line))
+        self.chunks = chunks[i:]
+
+    def getvalue(self):
+        self.split_pending(final=True)
+        self.wrap_chunks(final=True)
+        return "\n".join(self.lines)
+
+class TextWriter:
+    # Collects text without line wrapping - same interface as StreamingWrapper
+    def __init__(self):
+        self.parts = []
+
+    def append(self, text):
+        self.parts.append(text)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+def get_text_writer(width):
+    return StreamingWrapper(width) if width else TextWriter()
+
+def iter_transcript_sentences(fileobj):
+    # Yields [start_time, sentence] for each sentence of an Amazon Transcribe output file, and returns duration_secs
+    return iter_sentences(iter_transcript_items(fileobj))
+
+def prepare_transcript_text(fileobj, width=TRANSCRIPT_LINE_WIDTH):
+    # Returns [duration_secs, text] for an Amazon Transcribe output file - the text of each sentence, prefixed
+    # by its start time, line wrapped to width characters (if width is not 0)
+    sentences = iter_transcript_sentences(fileobj)
+    out = get_text_writer(width)
+    while True:
+        try:
+            start_time, sentence = next(sentences)
+        except StopIteration as e:
+            duration_secs = e.value
+            break
+        out.append(" " + sentence + " ")
+    return [duration_secs, out.getvalue()]
+
+def prepare_transcript_segments(fileobj, segment_secs, width=TRANSCRIPT_LINE_WIDTH):
+    # Returns [duration_secs, segments] for an Amazon Transcribe output file, with the transcript split into time
+    # windows of segment_secs. segments maps the number of each window with speech (start time // segment_secs) to
+    # its text, prepared as by prepare_transcript_text. Sentences are not split - a sentence belongs to the window
+    # it starts in (a sentence without a start time to the window of the sentence before it).
+    sentences = iter_transcript_sentences(fileobj)
+    writers = {}
+    window = 0
+    while True:
+        try:
+            start_time, sentence = next(sentences)
+        except StopIteration as e:
+            duration_secs = e.value
+            break
+        if start_time is not None:
+            window = int(float(start_time) // segment_secs)
+        if window not in writers:
+            writers[window] = get_text_writer(width)
+        writers[window].append(" " + sentence + " ")
+    return [duration_secs, {window: writer.getvalue() for window, writer in writers.items()}]
+
+def prepare_transcript_text_unbuffered(transcript, width=TRANSCRIPT_LINE_WIDTH):
+    # Reference implementation - the whole transcript is decoded, and the text built by concatenation
+    items = transcript["results"]["items"]
+    duration_secs = 0
+    txt = ""
+    sentence = ""
+    for i in items:
+        if (i["type"] == 'punctuation'):
+            sentence = sentence + i["alternatives"][0]["content"]
+            if (i["alternatives"][0]["content"] == '.'):
+                txt = txt + " " + sentence + " "
+                sentence = ""
+        else:
+            if (sentence == ''):
+                sentence = "[" + i["start_time"] + "]"
+            sentence = sentence + " " + i["alternatives"][0]["content"]
+            duration_secs = i["end_time"]
+    if (sentence != ""):
+        txt = txt + " " + sentence + " "
+    return [duration_secs, textwrap.fill(txt, width=width) if width else txt]
+
+def make_synthetic_transcript(hours, words_per_minute=150, words_per_sentence=12):
+    # Returns the JSON of a synthetic Transcribe output file for a recording of the given length
+    words = ["media", "search", "transcribe", "kendra", "index", "well-known", "the", "a", "meeting", "customer"]
+    items = []
+    secs_per_word = 60.0 / words_per_minute
+    for n in range(int(hours * 60 * words_per_minute)):
+        start = n * secs_per_word
+        items.append({"start_time": "%.2f" % start, "end_time": "%.2f" % (start + secs_per_word * 0.8),
+            "alternatives": [{"confidence": "0.99", "content": words[n % len(words)]}], "type": "pronunciation"})
+        if n % words_per_sentence == words_per_sentence - 1:
+            items.append({"alternatives": [{"confidence": "0.0", "content": "."}], "type": "punctuation"})
+        elif n % 5 == 4:
+            items.append({"alternatives": [{"confidence": "0.0", "content": ","}], "type": "punctuation"})
+    transcript = " ".join(i["alternatives"][0]["content"] for i in items)
+    return json.dumps({"jobName": "benchmark", "accountId": "0", "results": {"transcripts": [{"transcript": transcript}],
+        "items": items}, "status": "COMPLETED"}).encode("utf-8"), len(items)
+
+def check_wrapping(width=20):
+    # Compares StreamingWrapper with textwrap.fill for text with the cases its line wrapping rules handle, appended
+    # in small pieces so that chunks and lines span blocks
+    text = ("Look, goof-ball -- use the -b option!  A well-known\tstate-of-the-art word: " + "x" * 45 +
+        " then\nnew\rlines,\x0bvertical\x0cfeeds and\ttabs\t\there; em--dash, ---, a-b-c, 1-2-3, e-mail. ") * 5
+    for piece_size in [1, 7, 64]:
+        wrapper = StreamingWrapper(width, block_size=16)
+        for i in range(0, len(text), piece_size):
+            wrapper.append(text[i:i + piece_size])
+        if wrapper.getvalue() != textwrap.fill(text, width=width):
+            raise AssertionError(f"Streaming line wrapping differs from textwrap.fill for pieces of {piece_size} characters")
+
+def benchmark(hours_list):
+    import io
+    import tracemalloc
+    print(f"{'transcript':>10} {'items':>9} {'implementation':>15} {'secs':>8} {'items/sec':>11} {'peak MB':>8}")
+    for hours in hours_list:
+        data, count = make_synthetic_transcript(hours)
+        runs = [
+            ["unbuffered", lambda: prepare_transcript_text_unbuffered(json.loads(io.BytesIO(data).read()))],
+            ["streaming", lambda: prepare_transcript_text(io.BytesIO(data))],
+            ["no wrapping", lambda: prepare_transcript_text(io.BytesIO(data), width=0)]
+        ]
+        results = {}
+        for name, run in runs:
+            # best of 3 runs, as single runs of short transcripts are noisy
+            secs = None
+            for i in range(3):
+                start = time.perf_counter()
+                results[name] = run()
+                secs = min(secs or float("inf"), time.perf_counter() - start)
+            # memory is measured in a second run, as tracing allocations slows the code down
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+            print(f"{str(hours) + 'h':>10} {count:>9} {name:>15} {secs:>8.2f} {count / secs:>11.0f} {peak:>8.1f}")
+        if results["streaming"] != results["unbuffered"]:
+            raise AssertionError(f"Streaming output differs from unbuffered output for the {hours}h transcript")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        check_wrapping()
+        benchmark([float(h) for h in sys.argv[2:]] or [1, 4, 10])
+    elif len(sys.argv) == 2:
+        with open(sys.argv[1], "rb") as f:
+            [duration_secs, text] = prepare_transcript_text(f)
+        print(text)
+        print(f"duration_secs: {duration_secs}", file=sys.stderr)
+    else:
+        print("Usage: python transcript.py <transcript.json> | benchmark [hours ...]", file=sys.stderr)
+        sys.exit(1)
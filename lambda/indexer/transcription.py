@@ -0,0 +1,335 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Starts Amazon Transcribe jobs for media files, with optional admission control. When a cap on jobs in
+# flight is set, files that can't be started straight away are queued in a backlog in the media file table,
+# and the jobcomplete function starts the next queued file each time a job finishes.
+
+import os
+import re
+import time
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key, Attr
+
+from common import logger
+from common import STACK_NAME
+from common import TRANSCRIBE
+from common import DYNAMODB_LIMITER, RateLimiter, get_status_table
+from common import get_s3jsondata
+from common import TRANSCRIPT_BUCKET, TRANSCRIPT_PREFIX
+from common import update_file_status, count_status_items
+
+TRANSCRIBE_ROLE = os.environ.get('TRANSCRIBE_ROLE')
+# Cap on StartTranscriptionJob calls per second, shared by all threads (0 = no limit)
+TRANSCRIBE_MAX_TPS = float(os.environ.get('TRANSCRIBE_MAX_TPS', '5'))
+TRANSCRIBE_LIMITER = RateLimiter(TRANSCRIBE_MAX_TPS)
+# Cap on transcription jobs in flight, e.g. the account's concurrent job quota (0 = no cap - start every job immediately)
+MAX_TRANSCRIBE_JOBS_IN_FLIGHT = int(os.environ.get('MAX_TRANSCRIBE_JOBS_IN_FLIGHT', '0'))
+# Maximum number of queued files started by one call to drain_transcription_backlog()
+BACKLOG_DRAIN_BATCH = int(os.environ.get('BACKLOG_DRAIN_BATCH', '25'))
+# Order in which queued files are transcribed: FIFO (order found), SMALLEST_FIRST (file size, a proxy for duration)
+# or NEWEST_FIRST (S3 LastModified). Any policy other than FIFO queues every file, so the order applies to all new
+# files, not just those that found no free slot. Requires MAX_TRANSCRIBE_JOBS_IN_FLIGHT.
+TRANSCRIBE_PRIORITY_POLICY = os.environ.get('TRANSCRIBE_PRIORITY_POLICY', 'FIFO').upper()
+PRIORITY_POLICIES = ['FIFO', 'SMALLEST_FIRST', 'NEWEST_FIRST']
+# Optional per file 'Priority' field in the metadata or Transcribe options file - 0 (lowest) to 9 (highest), or
+# LOW, NORMAL, HIGH. Higher priority files are transcribed first, whatever the policy.
+PRIORITY_FIELD = "Priority"
+PRIORITY_NAMES = {'LOW': 1, 'NORMAL': 5, 'HIGH': 9}
+DEFAULT_PRIORITY = PRIORITY_NAMES['NORMAL']
+
+# Queued files are status items with transcribe_state QUEUED, 'backlog' set to QUEUED, and 'backlog_rank'.
+# The sparse backlog index returns them in backlog_rank order.
+BACKLOG_INDEX = "backlog-index"
+# Status table item holding the count of transcription jobs in flight
+ADMISSION_ITEM_ID = f"{STACK_NAME}#transcribe_admission"
+# StartTranscriptionJob errors that mean 'try again later' - the file is queued rather than failed
+RETRYABLE_ERRORS = ['LimitExceededException', 'ThrottlingException', 'TooManyRequestsException', 'InternalFailureException']
+
+# generate a unique job name for transcribe satisfying the naming regex requirements
+def transcribe_job_name(*args):
+    timestamp=time.time()
+    job_name = "__".join(args) + "_" + str(timestamp)
+    job_name = re.sub(r"[^0-9a-zA-Z._-]+","--",job_name)
+    return job_name
+
+def get_transcribe_args(job_name, job_uri, role, transcribeopts_url):
+    transcribeopts = None
+    args = {
+        'TranscriptionJobName':job_name,
+        'Media':{'MediaFileUri': job_uri},
+        'IdentifyLanguage':True,
+        'JobExecutionSettings':{
+            'AllowDeferredExecution': True,
+            'DataAccessRoleArn': role
+        }
+    }
+    reserved = ['TranscriptionJobName', 'Media']
+    if TRANSCRIPT_BUCKET:
+        # transcripts are kept in our own bucket, at a location known from the job name - see get_transcript_s3url()
+        args['OutputBucketName'] = TRANSCRIPT_BUCKET
+        args['OutputKey'] = f"{TRANSCRIPT_PREFIX}{job_name}.json"
+        reserved += ['OutputBucketName', 'OutputKey']
+    if transcribeopts_url:
+        logger.info(f"Merging Transcribe options data from: {transcribeopts_url}")
+        opts = get_s3jsondata(transcribeopts_url)
+        for key, value in opts.items():
+            if key in reserved:
+                logger.error(f"Transcribe options may not override reserved argument: {key}")
+            elif key == PRIORITY_FIELD:
+                # scheduling hint for the indexer, not a Transcribe argument
+                continue
+            else:
+                # all other options are assigned as arguments
+                args[key] = value
+            if key == 'LanguageCode':
+                args['IdentifyLanguage'] = False
+    return args
+
+def start_transcription(job_name, job_uri, role, transcribeopts_url):
+    # Starts the job - exceptions are raised to the caller
+    args = get_transcribe_args(job_name, job_uri, role, transcribeopts_url)
+    logger.info(f"Starting media transcription job: {job_name} - Arguments {args}")
+    TRANSCRIBE_LIMITER.acquire()
+    return TRANSCRIBE.start_transcription_job(**args)
+
+def start_media_transcription(name, job_uri, role, transcribeopts_url):
+    logger.info(f"start_media_transcription(name={name}, job_uri={job_uri}, role={role}, transcribeopts_url={transcribeopts_url})")
+    job_name = transcribe_job_name(name, job_uri)
+    try:
+        start_transcription(job_name, job_uri, role, transcribeopts_url)
+    except Exception as e:
+        logger.error("Exception while starting: " + job_name)
+        logger.error(e)
+        return False
+    return job_name
+
+def is_retryable_error(e):
+    return isinstance(e, ClientError) and e.response['Error']['Code'] in RETRYABLE_ERRORS
+
+def submit_media_transcription(name, job_uri, role, transcribeopts_url, metadata_url=None, s3object=None):
+    # Starts a transcription job if there is a free slot, otherwise queues the file in the backlog.
+    # Returns [job_name, transcribe_state, backlog_rank] for the media file status item:
+    # [job_name, "RUNNING", None] if the job was started, [None, "QUEUED", backlog_rank] if the file must be
+    # queued, or [False, None, None] if the job could not be started and should be retried by the next crawl.
+    # With a priority policy, every file is queued - the caller starts the queued files in priority order.
+    logger.info(f"submit_media_transcription(name={name}, job_uri={job_uri}, role={role}, transcribeopts_url={transcribeopts_url})")
+    if MAX_TRANSCRIBE_JOBS_IN_FLIGHT <= 0:
+        job_name = start_media_transcription(name, job_uri, role, transcribeopts_url)
+        return [job_name, "RUNNING" if job_name else None, None]
+    if not is_priority_scheduling() and acquire_transcription_slot():
+        job_name = transcribe_job_name(name, job_uri)
+        try:
+            start_transcription(job_name, job_uri, role, transcribeopts_url)
+            return [job_name, "RUNNING", None]
+        except Exception as e:
+            release_transcription_slot()
+            if not is_retryable_error(e):
+                logger.error("Exception while starting: " + job_name)
+                logger.error(e)
+                return [False, None, None]
+            logger.info(f"Transcribe is throttling requests - queue file: {job_uri} - {e}")
+    priority = get_transcription_priority(metadata_url, transcribeopts_url)
+    backlog_rank = get_backlog_rank(priority, s3object)
+    logger.info(f"Queue file: {job_uri}, backlog_rank={backlog_rank}")
+    return [None, "QUEUED", backlog_rank]
+
+def is_priority_scheduling():
+    return MAX_TRANSCRIBE_JOBS_IN_FLIGHT > 0 and get_priority_policy() != 'FIFO'
+
+def get_priority_policy():
+    if TRANSCRIBE_PRIORITY_POLICY not in PRIORITY_POLICIES:
+        logger.error(f"Unknown TRANSCRIBE_PRIORITY_POLICY {TRANSCRIBE_PRIORITY_POLICY} - using FIFO. Valid policies: {PRIORITY_POLICIES}")
+        return 'FIFO'
+    return TRANSCRIBE_PRIORITY_POLICY
+
+def parse_priority(value):
+    # Returns priority 0-9 from a 'Priority' field value, or None if it is not valid
+    if isinstance(value, str) and value.upper() in PRIORITY_NAMES:
+        return PRIORITY_NAMES[value.upper()]
+    try:
+        priority = int(value)
+    except (TypeError, ValueError):
+        return None
+    return min(max(priority, 0), 9)
+
+def get_transcription_priority(metadata_url, transcribeopts_url):
+    # 'Priority' from the Transcribe options file, or else the metadata file, or DEFAULT_PRIORITY
+    for s3json_url in [transcribeopts_url, metadata_url]:
+        if not s3json_url:
+            continue
+        try:
+            value = get_s3jsondata(s3json_url).get(PRIORITY_FIELD)
+        except Exception as e:
+            logger.error(f"Unable to read priority from {s3json_url}: {e}")
+            continue
+        if value is None:
+            continue
+        priority = parse_priority(value)
+        if priority is None:
+            logger.error(f"Invalid {PRIORITY_FIELD} value in {s3json_url}: {value} - use 0-9 or {list(PRIORITY_NAMES.keys())}")
+            continue
+        return priority
+    return DEFAULT_PRIORITY
+
+def get_backlog_rank(priority=DEFAULT_PRIORITY, s3object=None):
+    # Queued files are started in backlog_rank order: higher priority first, then in the order given by the
+    # priority policy, then oldest first. Ranks are strings, so each part is zero padded to a fixed width.
+    policy = get_priority_policy()
+    policy_key = ""
+    if s3object and policy == 'SMALLEST_FIRST':
+        policy_key = "%015d" % s3object['Size']
+    elif s3object and policy == 'NEWEST_FIRST':
+        policy_key = "%012d" % (10**12 - int(s3object['LastModified'].timestamp()))
+    return "%d#%s#%020.6f" % (9 - priority, policy_key, time.time())
+
+# Jobs in flight counter
+
+def acquire_transcription_slot():
+    # Atomically increment the jobs in flight count, unless it has reached the cap. Returns True if a slot was acquired.
+    try:
+        DYNAMODB_LIMITER.acquire()
+        get_status_table().update_item(
+            Key={'id': ADMISSION_ITEM_ID},
+            UpdateExpression="ADD jobs_in_flight :one",
+            ConditionExpression="attribute_not_exists(jobs_in_flight) OR jobs_in_flight < :max",
+            ExpressionAttributeValues={':one': 1, ':max': MAX_TRANSCRIBE_JOBS_IN_FLIGHT}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+def release_transcription_slot():
+    try:
+        DYNAMODB_LIMITER.acquire()
+        get_status_table().update_item(
+            Key={'id': ADMISSION_ITEM_ID},
+            UpdateExpression="ADD jobs_in_flight :minus_one",
+            ConditionExpression="jobs_in_flight > :zero",
+            ExpressionAttributeValues={':minus_one': -1, ':zero': 0}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Jobs in flight count is already zero")
+    return True
+
+def get_transcription_slots():
+    # Jobs in flight count, or None if there is no counter yet
+    DYNAMODB_LIMITER.acquire()
+    response = get_status_table().get_item(Key={'id': ADMISSION_ITEM_ID}, ConsistentRead=True)
+    if 'jobs_in_flight' not in response.get('Item', {}):
+        return None
+    return int(response['Item']['jobs_in_flight'])
+
+def reset_transcription_slots(jobs_in_flight, previous_jobs_in_flight):
+    # Set the jobs in flight count from the status of the media files, correcting any drift (e.g. from a jobcomplete
+    # invocation that failed before releasing its slot) - only if the counter still holds previous_jobs_in_flight, the
+    # value read before the files were counted, so that slots claimed or released meanwhile are not lost.
+    # Returns False if the counter changed.
+    logger.info(f"reset_transcription_slots(jobs_in_flight={jobs_in_flight}, previous_jobs_in_flight={previous_jobs_in_flight})")
+    update_args = {
+        "Key": {'id': ADMISSION_ITEM_ID},
+        "UpdateExpression": "SET jobs_in_flight = :count",
+        "ConditionExpression": "attribute_not_exists(jobs_in_flight)",
+        "ExpressionAttributeValues": {':count': jobs_in_flight}
+    }
+    if previous_jobs_in_flight is not None:
+        update_args["ConditionExpression"] = "jobs_in_flight = :previous"
+        update_args["ExpressionAttributeValues"][':previous'] = previous_jobs_in_flight
+    try:
+        DYNAMODB_LIMITER.acquire()
+        get_status_table().update_item(**update_args)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        logger.info("Jobs in flight count changed while the files were counted - not reset")
+        return False
+    return True
+
+def count_running_transcriptions(status_items=None):
+    # Number of media files with a transcription job in flight, from preloaded status items or a table scan
+    if status_items is not None:
+        return sum(1 for item in status_items.values() if item.get('transcribe_state') == 'RUNNING')
+    return count_status_items(Attr('transcribe_state').eq('RUNNING'))
+
+# Backlog
+
+def claim_next_queued_file(job_name_prefix):
+    # Claims the first queued file in backlog order, by setting its transcription job name and state RUNNING with
+    # a conditional update, so a file is only claimed once when the backlog is drained concurrently.
+    # Returns the claimed status item, or None if the backlog is empty.
+    for attempt in range(3):
+        DYNAMODB_LIMITER.acquire()
+        response = get_status_table().query(
+            IndexName=BACKLOG_INDEX,
+            KeyConditionExpression=Key('backlog').eq('QUEUED'),
+            Limit=10
+        )
+        if not response['Items']:
+            return None
+        for candidate in response['Items']:
+            job_name = transcribe_job_name(job_name_prefix, candidate['id'])
+            try:
+                DYNAMODB_LIMITER.acquire()
+                response = get_status_table().update_item(
+                    Key={'id': candidate['id']},
+                    UpdateExpression="SET transcribe_job_id = :job_name, transcribe_state = :running REMOVE backlog, backlog_rank",
+                    ConditionExpression="transcribe_state = :queued AND backlog_rank = :backlog_rank",
+                    ExpressionAttributeValues={
+                        ':job_name': job_name, ':running': 'RUNNING',
+                        ':queued': 'QUEUED', ':backlog_rank': candidate['backlog_rank']
+                    },
+                    ReturnValues="ALL_OLD"
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                    # claimed by another invocation, or the file was modified or deleted since it was queued
+                    continue
+                raise
+            item = response['Attributes']
+            item['transcribe_job_id'] = job_name
+            return item
+        # the index is eventually consistent - query again for files that have not been claimed yet
+    return None
+
+def requeue_file(item, transcribe_state="QUEUED"):
+    # Return a claimed file to the backlog in its original position, or set it to FAILED
+    logger.info(f"requeue_file({item['id']}, transcribe_state={transcribe_state})")
+    # unless the file has been modified (and submitted again) since it was claimed
+    expected = {'transcribe_job_id': item['transcribe_job_id']}
+    if transcribe_state == "QUEUED":
+        return update_file_status(
+            item['id'], expected=expected,
+            transcribe_state="QUEUED", backlog="QUEUED", backlog_rank=item['backlog_rank'], transcribe_job_id=None
+            )
+    return update_file_status(item['id'], expected=expected, transcribe_state="FAILED", sync_state="NOT_SYNCED")
+
+def drain_transcription_backlog(name, role, max_jobs=BACKLOG_DRAIN_BATCH):
+    # Start transcription jobs for queued files while there are free slots. Returns the number of jobs started.
+    if MAX_TRANSCRIBE_JOBS_IN_FLIGHT <= 0:
+        return 0
+    started = 0
+    while started < max_jobs:
+        if not acquire_transcription_slot():
+            break
+        item = claim_next_queued_file(name)
+        if item == None:
+            release_transcription_slot()
+            break
+        try:
+            start_transcription(item['transcribe_job_id'], item['id'], role, item.get('transcribeopts_url'))
+        except Exception as e:
+            release_transcription_slot()
+            if is_retryable_error(e):
+                logger.info(f"Transcribe is throttling requests - stop draining backlog: {e}")
+                requeue_file(item)
+                break
+            logger.error(f"Exception while starting queued file: {item['id']} - {e}")
+            requeue_file(item, transcribe_state="FAILED")
+            continue
+        started += 1
+    logger.info(f"Started {started} transcription jobs from backlog")
+    return started